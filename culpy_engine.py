@@ -0,0 +1,517 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy array-backed state engine shared by the 0-d and 1-d configurations """
+
+
+import copy
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from culpy_kmc import stack_kmc
+from culpy_output import StateChunks, CheckpointWriter, load_checkpoint
+
+
+# =========================================================================== #
+# ========================== State array layout \ =========================== #
+# The state is held as one contiguous array of shape (n_iter+1, n_boxes, 11),
+# the last axis follows the fixed variable-to-column map below.
+state_vars = ("Cpy",
+              "Cpoc", "Cpon", "Cpop",
+              "Cdoc", "Cdon", "Cdop",
+              "Cam",  "Cni",  "Cph",
+              "Cox")
+var_index = {var: i for i, var in enumerate(state_vars)}
+n_vars = len(state_vars)
+
+
+def state_array(*state_vars_init_dicts):
+    # initial state (n_boxes, 11) from one initial concentration dict per box
+    C_init = np.zeros((len(state_vars_init_dicts), n_vars))
+    for box, init_dict in enumerate(state_vars_init_dicts):
+        for var in state_vars:
+            C_init[box, var_index[var]] = init_dict[var]
+    return C_init
+
+
+def boundary_array(boundary_input):
+    # boundary concentrations (n_iter+1, 11) from the interpolated input columns
+    return np.column_stack([np.asarray(boundary_input[var], dtype=float) for var in state_vars])
+
+
+def state_dict(C, box):
+    # {var: series} view of a single box, as written by save_C_to_csv
+    return {var: C[:, box, var_index[var]] for var in state_vars}
+
+# ========================== State array layout / =========================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================ Forcing matrix \ ============================= #
+# All forcing series are packed into one contiguous (n_iter+1, n_columns)
+# float64 matrix before the time loop, so that a time step reads a single row.
+# A named series of shape (n_iter+1,) takes one column, a series of shape
+# (n_iter+1, k) takes k adjacent columns (e.g. one per box or per variable).
+
+class ForcingMatrix:
+
+    def __init__(self, series):
+        n_rows = len(next(iter(series.values())))
+        self.index = {}
+        self.shapes = {}
+        n_columns = 0
+        for name, values in series.items():
+            shape = np.shape(values)[1:]
+            size = int(np.prod(shape))
+            # scalar series are addressed by an integer column, others by a slice
+            self.index[name] = n_columns if shape == () else slice(n_columns, n_columns + size)
+            self.shapes[name] = shape
+            n_columns += size
+
+        self.values = np.empty((n_rows, n_columns))
+        for name, values in series.items():
+            self.values[:, self.index[name]] = np.reshape(values, (n_rows,) + ((-1,) if self.shapes[name] else ()))
+
+    def __getitem__(self, name):
+        return self.values[:, self.index[name]].reshape((-1,) + self.shapes[name])
+
+    def __contains__(self, name):
+        return name in self.index
+
+# ============================ Forcing matrix / ============================= #
+# =========================================================================== #
+
+# =========================================================================== #
+# ===================== Temperature correction tables \ ===================== #
+# theta**(T-20) factors and the O2 saturation depend on the forcing only. The
+# tables keep T-20 and the O2 saturation of the whole series (one value per
+# row and box); the theta factors depend on the kmc of a run and are computed
+# for blocks of theta_block_rows rows as a run reaches them (ThetaFactors), so
+# neither the tables of a long-lived model nor a stacked ensemble hold factor
+# series of the full run.
+theta_names = ('theta_mortality', 'theta_growth', 'theta_resipration', 'theta_excration',
+               'theta_c_decomp', 'theta_n_decomp', 'theta_p_decomp',
+               'theta_c_mnr_ox', 'theta_n_mnr_ox', 'theta_p_mnr_ox',
+               'theta_c_mnr_ni', 'theta_n_mnr_ni', 'theta_p_mnr_ni',
+               'theta_nitr', 'theta_denitr')
+
+def libm_power(x, p):
+    # scalar ** p goes through libm pow, NumPy arrays swap x**2 for x*x
+    return np.power(x, np.full(np.shape(x), float(p)))
+
+
+def calculate_O2_saturation(T, salinity, Altitude):
+    TKelvin = T + 273.15
+    AltEffect = (100 - (0.0035 * 3.28083 * Altitude)) / 100
+    ln_stemp = (-139.34411 + (1.575701E+5 / TKelvin) -
+                (6.642308E+7 / libm_power(TKelvin, 2)) + (1.243800E+10 / (TKelvin ** 3))
+                - (8.621949E+11 / (TKelvin ** 4)))
+    ln_ssalt = (salinity * ((1.7674E-2) - (1.754E+1 / TKelvin)
+                        + (2.1407E+3 / libm_power(TKelvin, 2))))
+    O2_sat_fresh = np.exp(ln_stemp)
+    O2_sat_salt = np.exp(ln_ssalt)
+
+    return AltEffect * (O2_sat_fresh - O2_sat_salt)
+
+
+class TemperatureTables:
+
+    def __init__(self, T, salinity, Altitude):
+        self.dT = T - 20
+        self.O2_sat = calculate_O2_saturation(T, salinity, Altitude)
+
+    def theta_factors(self, kmc, rows=slice(None)):
+        # (n_rows, 15, n_boxes), or (n_rows, 15, N, n_boxes) for a stacked
+        # kmc, of the given rows with the factors in theta_names order
+        dT = self.dT[rows]
+        thetas = [np.asarray(getattr(kmc, name), dtype=float) for name in theta_names]
+        if thetas[0].ndim == 0:
+            return np.stack([float(theta)**dT for theta in thetas], axis=1)
+        return np.stack([np.stack([float(theta)**dT for theta in theta_N.ravel()], axis=1)
+                         for theta_N in thetas], axis=1)
+
+
+theta_block_rows = 1024
+
+class ThetaFactors:
+    # theta_factors of a run indexed by row, one block of rows held at a time
+
+    def __init__(self, tables, kmc, block_rows=theta_block_rows):
+        self.tables = tables
+        self.kmc = kmc
+        self.block_rows = block_rows
+        self.first = 0
+        self.block = tables.theta_factors(kmc, slice(0, block_rows))
+
+    def __getitem__(self, t):
+        if not self.first <= t < self.first + len(self.block):
+            # the block starts one row early, interpolating steppers read
+            # rows t and t+1
+            self.first = max(t - 1, 0)
+            self.block = self.tables.theta_factors(self.kmc, slice(self.first, self.first + self.block_rows))
+        return self.block[t - self.first]
+
+# ===================== Temperature correction tables / ===================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# =================== Pelagic process rates calculation \ =================== #
+# kmc is a CompiledKMC (see culpy_kmc), theta_T the step's row of
+# TemperatureTables.theta_factors and O2_sat the step's O2 saturation.
+# Every argument may be an array over boxes (and the kmc values arrays over
+# realisations, see stack_kmc); the expressions keep the order of operations
+# of the scalar dict version, runs agree with it to rounding (about 1e-13
+# relative, see tests/test_engine.py): the flow matrices sum the fluxes of a
+# box in another order, and NumPy builds with AVX-512 dispatch their own
+# vectorized exp/pow, which may differ from libm in the last bit.
+
+def pelagic_process_rates(C_t, theta_T, O2_sat, H, I_a, salinity, f_day, kmc):
+
+    Cpy, Cpoc, Cpon, Cpop, Cdoc, Cdon, Cdop, Cam, Cni, Cph, Cox = np.moveaxis(C_t, -1, 0)
+    (f_mortality, f_growth, f_resipration, f_excration,
+     f_c_decomp, f_n_decomp, f_p_decomp,
+     f_c_mnr_ox, f_n_mnr_ox, f_p_mnr_ox,
+     f_c_mnr_ni, f_n_mnr_ni, f_p_mnr_ni,
+     f_nitr, f_denitr) = theta_T
+
+
+    def calculate_light_limitation(ChlA, H, kmc, I_a):
+        K_e = kmc.K_be + (0.0088*ChlA) + (0.054*(ChlA**(2/3)))
+        constant_e = 2.718
+        I_ratio = -I_a/kmc.I_s
+        X_I = (((constant_e*f_day)/(K_e*H)) *
+                (np.exp(I_ratio*np.exp(-K_e*H)) -
+                 np.exp(I_ratio)))
+        return X_I
+
+    def calculate_nutrient_limitation(Cni, Cam, Cph, kmc):
+        X_N_N = (Cni+Cam)/(kmc.K_SN+Cni+Cam)
+        X_N_P = Cph/(kmc.K_SP+Cph)
+        return X_N_N*X_N_P
+
+    ChlA = (Cpy / kmc.a_C_chl) * 1000  # biomass as chlorophyll-a (µg/L)
+    X_I = calculate_light_limitation(ChlA, H, kmc, I_a)
+    X_N = calculate_nutrient_limitation(Cni, Cam, Cph, kmc)
+    # Cpy: Phytoplankton-Carbon processes
+    r_Phyto_Death_Mortality = kmc.k_mortality * f_mortality * Cpy
+    r_Phyto_Death_Salinity = kmc.k_salt_death * (salinity/(salinity+kmc.K_Sl_salt)) * Cpy
+    R_Cpy_Growth = (kmc.k_growth * f_growth
+                     *(Cox/(Cox+kmc.K_Sl_ox_Cpy)) * X_I * X_N * Cpy)
+    R_Cpy_Respiration = kmc.k_resipration * f_resipration * Cpy
+    R_Cpy_Excration = kmc.k_excration * f_excration * Cpy
+    R_Cpy_Death = (r_Phyto_Death_Mortality + r_Phyto_Death_Salinity)
+    R_Cpy_Settling = (kmc.v_set_Cpy/H) * Cpy
+    R_Cpy = (+R_Cpy_Growth
+             -R_Cpy_Respiration
+             -R_Cpy_Excration
+             -R_Cpy_Death
+             -R_Cpy_Settling)
+
+    # Cpoc: Particulate organic carbon processes
+    R_Cpoc_Decomposition = kmc.k_c_decomp * f_c_decomp * (Cpoc/(Cpoc+kmc.K_Sl_Cpoc_decomp)) * Cpoc
+    R_Cpoc_Settling = (kmc.v_set_Cpoc/H) * Cpoc
+    R_Cpoc = (+R_Cpy_Death
+              -R_Cpoc_Decomposition
+              -R_Cpoc_Settling)
+
+    # Cpon: Particulate organic nitrogen processes
+    R_Cpon_Decomposition = kmc.k_n_decomp * f_n_decomp * (Cpon/(Cpon+kmc.K_Sl_Cpon_decomp)) * Cpon
+    R_Cpon_Settling = (kmc.v_set_Cpon/H) * Cpon
+    R_Cpon = (+kmc.a_N_C*R_Cpy_Death
+             -R_Cpon_Decomposition
+             -R_Cpon_Settling)
+
+    # Cpop: Particulate organic phosphorous processes
+    R_Cpop_Decomposition = kmc.k_p_decomp * f_p_decomp * (Cpop/(Cpop+kmc.K_Sl_Cpop_decomp)) * Cpop
+    R_Cpop_Settling = (kmc.v_set_Cpop/H) * Cpop
+    R_Cpop = (+kmc.a_P_C*R_Cpy_Death
+             -R_Cpop_Decomposition
+             -R_Cpop_Settling)
+
+    # Mineralization of dissolved organic maters by using oxygen
+    def mineralization_by_ox(k_mnr, f_mnr, K_Sl_ox, K_Sl_var, var):
+        return k_mnr * f_mnr * \
+            Cox/(K_Sl_ox+Cox) *\
+                (var/(var+K_Sl_var)) * var
+
+    # Mineralization of dissolved organic maters by using nitrate
+    def mineralization_by_ni(k_mnr, f_mnr, K_Si_ox, K_Sl_ni, K_Sl_var, var):
+        return k_mnr * f_mnr * \
+            (1 - Cox/(K_Si_ox+Cox)) * \
+                Cni/(K_Sl_ni+Cni) * \
+                    (var/(var+K_Sl_var)) * var
+
+    # Cdoc: Dissolved organic carbon processes
+    R_Cdoc_Mineralization_ox = mineralization_by_ox(kmc.k_c_mnr_ox, f_c_mnr_ox, kmc.K_Sl_ox_mnr_c, kmc.K_Sl_c_mnr_ox, Cdoc)
+    R_Cdoc_Mineralization = (R_Cdoc_Mineralization_ox +
+                             mineralization_by_ni(kmc.k_c_mnr_ni, f_c_mnr_ni, kmc.K_Si_ox_mnr_c, kmc.K_Sl_ni_mnr_c, kmc.K_Sl_c_mnr_ni, Cdoc))
+    R_Cdoc = (+R_Cpy_Excration
+             +R_Cpoc_Decomposition
+             -R_Cdoc_Mineralization)
+
+    # Cdon: Dissolved organic nitrogen processes
+    R_Cdon_Mineralization = (mineralization_by_ox(kmc.k_n_mnr_ox, f_n_mnr_ox, kmc.K_Sl_ox_mnr_n, kmc.K_Sl_n_mnr_ox, Cdon) +
+                             mineralization_by_ni(kmc.k_n_mnr_ni, f_n_mnr_ni, kmc.K_Si_ox_mnr_n, kmc.K_Sl_ni_mnr_n, kmc.K_Sl_n_mnr_ni, Cdon))
+    R_Cdon = (+kmc.a_N_C*R_Cpy_Excration
+             +R_Cpon_Decomposition
+             -R_Cdon_Mineralization)
+
+    # Cdop: Dissolved organic phosphorous processes
+    R_Cdop_Mineralization = (mineralization_by_ox(kmc.k_p_mnr_ox, f_p_mnr_ox, kmc.K_Sl_ox_mnr_p, kmc.K_Sl_p_mnr_ox, Cdop) +
+                             mineralization_by_ni(kmc.k_p_mnr_ni, f_p_mnr_ni, kmc.K_Si_ox_mnr_p, kmc.K_Sl_ni_mnr_p, kmc.K_Sl_p_mnr_ni, Cdop))
+    R_Cdop = (+kmc.a_P_C*R_Cpy_Excration
+             +R_Cpop_Decomposition
+             -R_Cdop_Mineralization)
+
+    # Cam: Ammonia processes
+    prefam = (Cam * (Cni / ((kmc.K_SN+Cam)*(kmc.K_SN+Cni))) + Cam * (kmc.K_SN / ((Cam+Cni)*(kmc.K_SN+Cni))))
+    R_Nitrification = (kmc.k_nitrification * f_nitr * (Cox/(Cox+kmc.K_Sl_nitr_ox)) * (Cam/(Cam+kmc.K_Sl_nitr))) * Cam
+    R_Cam = (+R_Cdon_Mineralization
+             +kmc.a_N_C*R_Cpy_Respiration
+             -kmc.a_N_C*prefam*R_Cpy_Growth
+             -R_Nitrification)
+
+    # Cni: Nitrate processes
+    R_Denitrification = ((kmc.k_denitrification * f_denitr *
+                          (kmc.K_Si_denitr_ox/(Cox+kmc.K_Si_denitr_ox)) * (Cni/(Cni+kmc.K_Sl_denitr))) * Cni)
+    R_Cni = (+R_Nitrification
+             -R_Denitrification
+             -kmc.a_N_C*(1-prefam)*R_Cpy_Growth)
+
+    # Cph: Phosphate processes
+    R_Cph = (+R_Cdop_Mineralization
+             +kmc.a_P_C*R_Cpy_Respiration
+             -kmc.a_P_C*R_Cpy_Growth)
+
+    # Cox: Dissolved oxygen processes
+    R_Reaeration = kmc.k_raer_theta_rear * (O2_sat-Cox)
+    R_Cox = (+R_Reaeration
+            +kmc.a_O2_C*R_Cpy_Growth
+            -kmc.a_O2_C*R_Cpy_Respiration
+            -(32/12)*R_Cdoc_Mineralization_ox
+            -(64/14)*R_Nitrification
+            +(5/4)*(32/14)*R_Denitrification)
+
+    # rates in the same column order as the state array
+    return np.stack((R_Cpy, R_Cpoc, R_Cpon, R_Cpop,
+                     R_Cdoc, R_Cdon, R_Cdop,
+                     R_Cam, R_Cni, R_Cph,
+                     R_Cox), axis=-1)
+
+# =================== Pelagic process rates calculation / =================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================ Reaction blocks \ ============================ #
+# Boxes are coupled by transport only, so the reaction rates of a step can be
+# evaluated for blocks of boxes independently. BlockRates spreads the blocks
+# over a thread pool (NumPy releases the GIL in its array loops); every block
+# is one vectorized pelagic_process_rates call on contiguous box slices and
+# writes its own slice of the rates, the result equals the single call. The
+# pools are kept per thread count and shared by all runs of a process.
+
+reaction_pools = {}
+
+
+class BlockRates:
+
+    def __init__(self, n_boxes, threads):
+        n_blocks = min(int(threads), n_boxes)
+        bounds = np.linspace(0, n_boxes, n_blocks + 1).round().astype(int)
+        self.blocks = [slice(lower, upper) for lower, upper in zip(bounds[:-1], bounds[1:])]
+        if n_blocks not in reaction_pools:
+            reaction_pools[n_blocks] = ThreadPoolExecutor(n_blocks, thread_name_prefix='culpy_rates')
+        self.pool = reaction_pools[n_blocks]
+
+    def __call__(self, C_t, theta_T, O2_sat, H, I_a, salinity, f_day, kmc):
+        R_t = np.empty(np.shape(C_t))
+        H = np.broadcast_to(H, np.shape(O2_sat))
+
+        def block(b):
+            R_t[..., b, :] = pelagic_process_rates(C_t[..., b, :], theta_T[..., b], O2_sat[b], H[b],
+                                                   I_a[b], salinity[b], f_day[b], kmc)
+
+        for future in [self.pool.submit(block, b) for b in self.blocks]:
+            future.result()
+        return R_t
+
+
+def process_rates(n_boxes, threads=None):
+    # rates function of a run: one call for all boxes, or BlockRates for
+    # threads > 1
+    if threads and threads > 1 and n_boxes > 1:
+        return BlockRates(n_boxes, threads)
+    return pelagic_process_rates
+
+# ============================ Reaction blocks / ============================ #
+# =========================================================================== #
+
+# =========================================================================== #
+# =================== Numerical Solution for C array \ ====================== #
+# forcing  : ForcingMatrix with (n_iter+1, n_boxes) series T, I_a, salinity
+#            and f_day, plus the network series "exchange", "inflow" and
+#            "boundary" (see BoxNetwork.forcing_series)
+# network  : culpy_network.BoxNetwork, advection of all boxes is computed as
+#            exchange @ C + inflow @ C_boundary with sparse flow matrices
+# tables   : optional TemperatureTables of the forcing, to be shared by runs
+# backend  : "python" or "numba" (compiled, see culpy_jit), numba falls back
+#            to python with a RuntimeWarning when it is not installed
+# integrator: "euler" (explicit, fixed dt) or "rk4", "rk45" (adaptive),
+#            "imex" (implicit transport) and "lie", "strang" (operator
+#            splitting, exact transport), see culpy_solvers; step, rtol,
+#            atol and reaction_step are passed on to culpy_solvers.integrate
+# threads  : reaction rates of blocks of boxes in a pool of this many
+#            threads (python backend, for large box networks), see BlockRates
+# output   : optional output(first_row, C_chunk), called with chunks of at
+#            most chunk_rows rows as the run advances (see culpy_output); the
+#            full state array is then not kept and None is returned
+# checkpoint: optional checkpoint file name, the state is saved every
+#            checkpoint_interval days and at the end of the run (see
+#            culpy_output.CheckpointWriter), with the numba backend too
+# restart  : optional checkpoint file, the run continues from its row with
+#            its state in place of C_init; the result (and output) holds the
+#            rows from the checkpoint row to n_iter, output rows are counted
+#            from the start of the run. An euler run restarted from a
+#            checkpoint gives the rows of the run it was saved by.
+# C_init may carry leading ensemble axes, see simulate_C_ensemble.
+
+def box_product(matrix, X):
+    # sparse (n_boxes, n) matrix times X (..., n, 11) over the box axis
+    X_boxes = np.moveaxis(X, -2, 0)
+    product = matrix @ X_boxes.reshape(X_boxes.shape[0], -1)
+    return np.moveaxis(product.reshape((matrix.shape[0],) + X_boxes.shape[1:]), 0, -2)
+
+
+def restart_rows(restart, C_init, n_iter, dt, forcing, tables):
+    # state and row of a checkpoint with the forcing and tables from that row
+    C, row, checkpoint_dt = load_checkpoint(restart)
+    if abs(checkpoint_dt - dt) > 1e-12:
+        raise ValueError(f"checkpoint {restart} has dt {checkpoint_dt}, the run dt is {dt}")
+    if row > n_iter:
+        raise ValueError(f"checkpoint {restart} is at row {row}, after the end of the run (row {n_iter})")
+    if np.shape(C) != np.shape(C_init)[-np.ndim(C):]:
+        raise ValueError(f"checkpoint {restart} has a state of shape {np.shape(C)}, "
+                         f"the run has {np.shape(C_init)}")
+    forcing = copy.copy(forcing)
+    forcing.values = forcing.values[row:]
+    tables = copy.copy(tables)
+    tables.dT, tables.O2_sat = tables.dT[row:], tables.O2_sat[row:]
+    return np.broadcast_to(C, np.shape(C_init)), row, forcing, tables
+
+
+def jit_segments(n_iter, segment_rows, checkpoint=None):
+    # (first, last) rows of the compiled runs of a streamed or checkpointed
+    # numba run, at most segment_rows steps each and ending at checkpoint rows
+    first = 0
+    while first < n_iter:
+        last = min(first + segment_rows, n_iter)
+        if checkpoint and checkpoint.interval:
+            row = checkpoint.first_row + first
+            last = min(last, (row // checkpoint.interval + 1) * checkpoint.interval - checkpoint.first_row)
+        yield first, last
+        first = last
+
+
+def simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, tables=None, backend="python",
+               integrator="euler", step=None, rtol=1e-6, atol=1e-8, output=None, chunk_rows=10000,
+               checkpoint=None, checkpoint_interval=None, restart=None, threads=None, reaction_step=None):
+
+    if tables is None:
+        tables = TemperatureTables(forcing['T'], forcing['salinity'], Altitude)
+
+    first_row = 0
+    if restart:
+        C_init, first_row, forcing, tables = restart_rows(restart, C_init, n_iter, dt, forcing, tables)
+        n_iter -= first_row
+        if output is not None and first_row:
+            run_output = output
+            output = lambda row, C_chunk: run_output(first_row + row, C_chunk)
+    if checkpoint:
+        checkpoint = CheckpointWriter(checkpoint, dt, checkpoint_interval, first_row + n_iter, first_row)
+
+    if integrator != "euler":
+        import culpy_solvers
+        if integrator not in culpy_solvers.integrators:
+            raise ValueError(f"unknown integrator: {integrator}")
+        if backend != "python":
+            raise ValueError(f"integrator {integrator} is only available with the python backend")
+        return culpy_solvers.integrate(C_init, n_iter, dt, forcing, H, network, kmc, tables, integrator,
+                                       step, rtol, atol, output, chunk_rows, checkpoint or None,
+                                       process_rates(np.shape(C_init)[-2], threads), reaction_step)
+
+    if backend == "numba":
+        import culpy_jit
+        if culpy_jit.jit_available:
+            if output is None and not checkpoint:
+                return culpy_jit.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, tables)
+            # the compiled loop runs in segments, each continuing from the
+            # last state of the one before, so that output chunks and
+            # checkpoints are written as the run advances
+            chunks = StateChunks(n_iter, np.shape(C_init), output, chunk_rows, checkpoint or None)
+            chunks.C[0] = C_init
+            chunks.stored(0)
+            for first, last in jit_segments(n_iter, chunks.n_rows, checkpoint):
+                C = culpy_jit.simulate_C(chunks.C[chunks.row(first)], last - first, dt, forcing, H, network,
+                                         kmc, tables, first)
+                for t in range(first + 1, last + 1):
+                    chunks.C[chunks.row(t)] = C[t - first]
+                    chunks.stored(t)
+            return chunks.result()
+        # shown once per process with the default warning filters
+        warnings.warn("numba is not installed, the python backend is used", RuntimeWarning)
+    elif backend != "python":
+        raise ValueError(f"unknown backend: {backend}")
+
+    chunks = StateChunks(n_iter, C_init.shape, output, chunk_rows, checkpoint or None)
+    C = chunks.C
+    C[0] = C_init
+    chunks.stored(0)
+
+    theta_T = ThetaFactors(tables, kmc)
+    O2_sat = tables.O2_sat
+    rates = process_rates(np.shape(C_init)[-2], threads)
+
+    F = forcing.values
+    I_a = forcing.index['I_a']
+    salinity = forcing.index['salinity']
+    f_day = forcing.index['f_day']
+    # flow matrices with a fixed pattern, their data is refilled every step
+    exchange = network.exchange.copy()
+    inflow = network.inflow.copy()
+    exchange_data = forcing.index['exchange']
+    inflow_data = forcing.index['inflow']
+    boundary = forcing.index['boundary']
+    n_boundaries = len(network.boundaries)
+
+    for t in range(1, n_iter + 1):
+
+        C_t = C[chunks.row(t-1)]
+        F_t = F[t-1]
+        R_t = rates(C_t, theta_T[t-1], O2_sat[t-1], H, F_t[I_a], F_t[salinity], F_t[f_day], kmc)
+
+        exchange.data[:] = F_t[exchange_data]
+        inflow.data[:] = F_t[inflow_data]
+        dC = box_product(exchange, C_t) + inflow @ F_t[boundary].reshape(n_boundaries, n_vars)
+
+        C[chunks.row(t)] = C_t + (dC + R_t) * dt
+        chunks.stored(t)
+
+    return chunks.result()
+
+
+def simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude, tables=None, backend="python",
+                        integrator="euler", step=None, rtol=1e-6, atol=1e-8, output=None, chunk_rows=10000,
+                        checkpoint=None, checkpoint_interval=None, restart=None, threads=None,
+                        reaction_step=None):
+    # C_init is either shared (n_boxes, 11) or per realisation (N, n_boxes, 11),
+    # as is the state of a restart checkpoint
+    C_init = np.broadcast_to(C_init, (len(kmc_list),) + np.shape(C_init)[-2:])
+    return simulate_C(C_init, n_iter, dt, forcing, H, network, stack_kmc(kmc_list), Altitude, tables, backend,
+                      integrator, step, rtol, atol, output, chunk_rows, checkpoint, checkpoint_interval, restart,
+                      threads, reaction_step)
+
+# =================== Numerical Solution for C array / ====================== #
+# =========================================================================== #
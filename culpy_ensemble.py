@@ -0,0 +1,227 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy parallel ensemble executor with the forcing in shared memory """
+
+
+import os
+import copy
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool, shared_memory
+from culpy_engine import simulate_C, simulate_C_ensemble, state_vars, TemperatureTables
+from culpy_kmc import kmc_names
+from culpy_output import PeriodMean, TimeSampler
+
+
+# =========================================================================== #
+# ============================ Shared arrays \ ============================== #
+# The forcing matrix and the forcing parts of the temperature tables (T-20 and
+# the O2 saturation) are copied once into shared memory blocks. Workers map
+# them as read-only arrays, a realisation sends its kmc overrides only.
+
+class SharedArrays:
+
+    def __init__(self, arrays):
+        # arrays: {name: array}, specs: {name: (block name, shape)}
+        self.blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array, dtype=float)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=float, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.specs[name] = (block.name, array.shape)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach_shared_arrays(specs):
+    blocks, arrays = [], {}
+    for name, (block_name, shape) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=float, buffer=block.buf)
+        arrays[name].flags.writeable = False
+        blocks.append(block)
+    return blocks, arrays
+
+# ============================ Shared arrays / ============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ========================== Ensemble reductions \ ========================== #
+# A reduction is copied for every realisation and called with the output
+# chunks (first_row, C_chunk) of its run; values() then gives one row of the
+# results table, with a name per entry in columns.
+#   RunMean            : mean of every variable of every box over the run
+#   ObservationReduction: one box at the observation times, "instant" state
+#                        or "daily"/"monthly" mean (as OutputStage samples)
+#   ObservationValues  : the observations of a culpy_metrics.ObservationIndex
+#                        (daily means of one box), in pest.out order
+
+class RunMean:
+
+    def __init__(self, boxes):
+        self.columns = [f'{var}_{box}' for box in boxes for var in state_vars]
+        self.sum = 0.0
+        self.count = 0
+
+    def __call__(self, first_row, C_chunk):
+        self.sum = self.sum + C_chunk.sum(axis=0)
+        self.count += len(C_chunk)
+
+    def values(self):
+        return np.ravel(self.sum / self.count)
+
+
+def time_label(time):
+    return time.strftime('%Y-%m-%d' if time == time.normalize() else '%Y-%m-%dT%H:%M')
+
+
+class ObservationReduction:
+
+    def __init__(self, sim_start_date, dt, times, sampling="instant", box=0):
+        self.sim_start_date = sim_start_date
+        self.dt = dt
+        self.times = pd.DatetimeIndex(times).unique().sort_values()
+        self.sampling = sampling
+        self.box = box
+        self.columns = [f'{var}_{time_label(time)}' for var in state_vars for time in self.times]
+        self.sample = None
+        self.rows = {}
+
+    def collect(self, times, values):
+        for time, row in zip(times, values):
+            self.rows.setdefault(time, row)
+
+    def __call__(self, first_row, C_chunk):
+        if self.sample is None:
+            if self.sampling == "instant":
+                self.sample = TimeSampler(self.sim_start_date, self.dt, self.times, self.collect)
+            else:
+                self.sample = PeriodMean(self.sim_start_date, self.dt, self.sampling, self.collect, self.times)
+        self.sample(first_row, C_chunk[:, self.box])
+
+    def values(self):
+        if self.sample is not None:
+            self.sample.close()
+        # times outside the simulation stay NaN
+        values = np.full((len(self.times), len(state_vars)), np.nan)
+        for i, time in enumerate(self.times):
+            if time in self.rows:
+                values[i] = self.rows[time]
+        return values.T.ravel()
+
+
+class ObservationValues:
+
+    def __init__(self, index, box=0):
+        self.index = index
+        self.box = box
+        self.columns = index.observation_names
+        self.daily = None
+
+    def __call__(self, first_row, C_chunk):
+        if self.daily is None:
+            self.daily = self.index.reduction()
+        self.daily(first_row, C_chunk[:, self.box])
+
+    def values(self):
+        return self.index.pest_values(self.daily.means())
+
+# ========================== Ensemble reductions / ========================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================ Ensemble runs \ ============================== #
+# Realisations are independent runs of the same model with kmc overrides;
+# they are spread over a process pool and every worker process holds the
+# model once (state, flow network, shared forcing and temperature tables).
+
+worker_model = {}
+
+
+def init_worker(specs, model):
+    blocks, arrays = attach_shared_arrays(specs)
+    forcing = copy.copy(model['forcing'])
+    forcing.values = arrays['forcing']
+    tables = copy.copy(model['tables'])
+    tables.dT, tables.O2_sat = arrays['dT'], arrays['O2_sat']
+    worker_model.update(model, forcing=forcing, tables=tables, blocks=blocks)
+
+
+def run_realisation(task):
+    i, overrides = task
+    m = worker_model
+    kmc = m['kmc'].replace(**overrides)
+    reduce = copy.deepcopy(m['reduction'])
+    simulate_C(m['C_init'], m['n_iter'], m['dt'], m['forcing'], m['H'], m['network'], kmc, m['Altitude'],
+               m['tables'], m['backend'], m['integrator'], m['step'], output=reduce,
+               chunk_rows=m['chunk_rows'], restart=m['restart'], reaction_step=m['reaction_step'])
+    return i, reduce.values()
+
+
+def run_ensemble(parameter_table, C_init, n_iter, dt, forcing, H, network, kmc, Altitude, reduction,
+                 backend="python", integrator="euler", step=None, processes=None, chunk_rows=10000, restart=None,
+                 reaction_step=None):
+    # parameter_table: DataFrame with one realisation per row (index is its
+    # name) and kmc overrides as columns, as read by kmc_ensemble_reader
+    # reduction: RunMean, ObservationReduction or an object of the same form
+    # processes: size of the pool (None: one per core), 0 steps all
+    # realisations together in this process as one stacked simulation
+    # restart: optional checkpoint all realisations continue from (e.g. a
+    # shared spin-up), the reduction then sees the rows after it only
+    # reaction_step: lie/strang reaction sub-step, see culpy_solvers
+    # returns the results table, one row per realisation in the table order
+    unknown = [name for name in parameter_table.columns if name not in kmc_names]
+    if unknown:
+        raise ValueError(f"unknown kmc parameter(s) in the parameter table: {', '.join(unknown)}")
+    tasks = list(enumerate(parameter_table.to_dict(orient='records')))
+
+    if processes == 0:
+        reductions = [copy.deepcopy(reduction) for _ in tasks]
+        def output(first_row, C_chunk):
+            for i, reduce in enumerate(reductions):
+                reduce(first_row, C_chunk[:, i])
+        simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network,
+                            [kmc.replace(**overrides) for _, overrides in tasks], Altitude, None, backend,
+                            integrator, step, output=output, chunk_rows=chunk_rows, restart=restart,
+                            reaction_step=reaction_step)
+        return results_table(parameter_table, [reduce.values() for reduce in reductions], reduction.columns)
+
+    processes = min(processes or os.cpu_count() or 1, max(len(tasks), 1))
+    tables = TemperatureTables(forcing['T'], forcing['salinity'], Altitude)
+    shared = SharedArrays({'forcing': forcing.values, 'dT': tables.dT, 'O2_sat': tables.O2_sat})
+    # the model without its large arrays, they are mapped from shared memory
+    model_forcing = copy.copy(forcing)
+    model_forcing.values = None
+    model_tables = copy.copy(tables)
+    model_tables.dT = model_tables.O2_sat = None
+    model = {'C_init': C_init, 'n_iter': n_iter, 'dt': dt, 'forcing': model_forcing, 'H': H,
+             'network': network, 'kmc': kmc, 'Altitude': Altitude, 'tables': model_tables,
+             'backend': backend, 'integrator': integrator, 'step': step, 'reduction': reduction,
+             'chunk_rows': chunk_rows, 'restart': restart, 'reaction_step': reaction_step}
+    try:
+        with Pool(processes, initializer=init_worker, initargs=(shared.specs, model)) as pool:
+            rows = dict(pool.imap_unordered(run_realisation, tasks))
+    finally:
+        shared.close()
+
+    return results_table(parameter_table, [rows[i] for i in range(len(tasks))], reduction.columns)
+
+
+def results_table(parameter_table, rows, columns):
+    return pd.DataFrame(np.array(rows).reshape(len(rows), len(columns)),
+                        index=pd.Index(parameter_table.index.astype(str),
+                                       name=parameter_table.index.name or 'realisation'),
+                        columns=columns)
+
+# ============================ Ensemble runs / ============================== #
+# =========================================================================== #
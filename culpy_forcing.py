@@ -0,0 +1,122 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy forcing input reading, interpolation and binary forcing cache """
+
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# =========================================================================== #
+# ============================ Forcing cache \ ============================== #
+# Interpolated inputs are stored as <key>.npy (memory-mappable values, one
+# contiguous row per column) and <key>.json (column names). The key hashes the
+# csv file content together with the simulation dates, the Julian day start
+# and the time step, so a changed input or grid never hits a stale entry.
+# Later runs open the values with mmap_mode='r' and skip csv parsing and
+# interpolation.
+forcing_cache_version = 2
+
+def forcing_cache_key(file_name, sim_start_date, sim_end_date, JDay_start_date, time_step_per_day):
+    file_hash = hashlib.sha256()
+    with open(f'{file_name}.csv', 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+    key = (f'{forcing_cache_version}|{file_hash.hexdigest()}|{sim_start_date}|{sim_end_date}|'
+           f'{JDay_start_date}|{time_step_per_day!r}')
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def read_forcing_cache(cache_dir, key):
+    values_path = os.path.join(cache_dir, f'{key}.npy')
+    columns_path = os.path.join(cache_dir, f'{key}.json')
+    if not (os.path.exists(values_path) and os.path.exists(columns_path)):
+        return None
+    with open(columns_path, 'r') as f:
+        columns = json.load(f)['columns']
+    return columns, np.load(values_path, mmap_mode='r')
+
+
+def write_forcing_cache(cache_dir, key, columns, values):
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to temporary files first, PEST agents may share one cache folder
+    tmp = f'.{key}.{os.getpid()}'
+    np.save(os.path.join(cache_dir, f'{tmp}.npy'), np.ascontiguousarray(values, dtype=float))
+    with open(os.path.join(cache_dir, f'{tmp}.json'), 'w') as f:
+        json.dump({'columns': list(columns)}, f)
+    os.replace(os.path.join(cache_dir, f'{tmp}.npy'), os.path.join(cache_dir, f'{key}.npy'))
+    os.replace(os.path.join(cache_dir, f'{tmp}.json'), os.path.join(cache_dir, f'{key}.json'))
+
+# ============================ Forcing cache / ============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ========================= Read/Interpolate Data \ ========================= #
+# All input files are interpolated onto one dt grid in a single pass. Times
+# are handled as int64 nanoseconds: the "time" column is either a date
+# (boundary concentrations) or a Julian day counted from JDay_start_date.
+
+def time_grid(sim_start_date, sim_end_date, time_step_per_day):
+    dt_minutes = 24 * 60 / time_step_per_day
+    return pd.date_range(start=sim_start_date, end=sim_end_date, freq=f'{int(dt_minutes)}min')
+
+
+def read_input_times(time_column, JDay_start_date):
+    if JDay_start_date is None:
+        times = pd.to_datetime(time_column)
+    else:
+        # rounded to microseconds as datetime + timedelta(days=x) did before
+        times = pd.Timestamp(JDay_start_date) + pd.to_timedelta(time_column, unit='D').round('us')
+    return times.to_numpy(dtype='datetime64[ns]').astype(np.int64)
+
+
+def interpolate_input(file_name, JDay_start_date, grid_ns):
+    # (columns, values) with one row of values per column, values before the
+    # first valid input stay NaN and the last valid input is held afterwards
+    inputF = pd.read_csv(f'{file_name}.csv')
+    input_ns = read_input_times(inputF.pop('time'), JDay_start_date)
+    order = np.argsort(input_ns, kind='stable')
+    input_ns = input_ns[order]
+
+    columns = list(inputF.columns)
+    values = np.full((len(columns), len(grid_ns)), np.nan)
+    for j, column in enumerate(columns):
+        column_values = inputF[column].to_numpy(dtype=float)[order]
+        valid = ~np.isnan(column_values)
+        if valid.any():
+            values[j] = np.interp(grid_ns, input_ns[valid], column_values[valid], left=np.nan)
+    return columns, values
+
+
+def load_forcing(sim_start_date, sim_end_date, JDay_start_date, time_step_per_day,
+                 wDate_files=None, wJDay_files=None, cache_dir=None):
+    # wDate_files / wJDay_files: {input name: csv file name without extension}
+    # returns {input name: {column: float array on the dt grid}}
+    grid_ns = time_grid(sim_start_date, sim_end_date, time_step_per_day).asi8
+
+    files = [(name, file_name, None) for name, file_name in (wDate_files or {}).items()]
+    files += [(name, file_name, JDay_start_date) for name, file_name in (wJDay_files or {}).items()]
+
+    inputs = {}
+    for name, file_name, JDay_start in files:
+        cached = None
+        if cache_dir:
+            key = forcing_cache_key(file_name, sim_start_date, sim_end_date, JDay_start, time_step_per_day)
+            cached = read_forcing_cache(cache_dir, key)
+        if cached is None:
+            cached = interpolate_input(file_name, JDay_start, grid_ns)
+            if cache_dir:
+                write_forcing_cache(cache_dir, key, *cached)
+        columns, values = cached
+        inputs[name] = {column: values[j] for j, column in enumerate(columns)}
+    return inputs
+
+# ========================= Read/Interpolate Data / ========================= #
+# =========================================================================== #
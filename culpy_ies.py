@@ -0,0 +1,172 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy ensemble smoother calibration of the kmc parameters (ES-MDA) """
+
+# The parameter ensemble is run as one ensemble of the model (see
+# culpy_ensemble), compared with observation.csv through its
+# ObservationIndex (see culpy_metrics) and updated by ensemble smoother steps
+# with multiple data assimilation (Emerick and Reynolds, 2013), all in one
+# process without file exchange.
+#
+# usage, from the folder of the model script, its inputs and observation.csv:
+#   python culpy_ies.py CuLPy_0d ies_bounds.csv --reals 100 --iterations 4
+# writes, in the layout of PEST++ IES (first column real_name):
+#   culpy.obs+noise.csv       observations plus noise
+#   culpy.<i>.par.csv         parameter ensemble of iteration i (0 is the prior)
+#   culpy.<i>.obs.csv         simulated observation ensemble of iteration i
+#   culpy.phi.csv             objective function summary per iteration
+# as read by culpy_pest/plot_predictive_uncertainty_pestpp_ies.py
+
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from culpy_kmc import kmc_bounds_reader
+from culpy_metrics import read_observations, ObservationIndex
+from culpy_model import load_model
+from culpy_ensemble import run_ensemble, ObservationValues
+
+
+# =========================================================================== #
+# =========================== Parameter ensemble \ ========================== #
+# Parameters are updated in their transformed space (log10 for transform
+# "log") and kept within their bounds. The prior is Gaussian around the base
+# kmc value with a standard deviation of a quarter of the bound range, as the
+# PEST++ default prior.
+
+def transform(values, bounds):
+    log = (bounds['transform'] == 'log').values
+    return np.where(log, np.log10(np.where(log, values, 1.0)), values)
+
+
+def back_transform(X, bounds):
+    log = (bounds['transform'] == 'log').values
+    return np.where(log, 10 ** np.where(log, X, 0.0), X)
+
+
+def prior_ensemble(kmc, bounds, n_reals, rng):
+    lower = transform(bounds['lower'].values, bounds)
+    upper = transform(bounds['upper'].values, bounds)
+    base = np.clip(transform(np.array([getattr(kmc, name) for name in bounds.index], dtype=float), bounds),
+                   lower, upper)
+    X = base + (upper - lower) / 4 * rng.standard_normal((n_reals, len(bounds)))
+    return np.clip(X, lower, upper)
+
+
+def parameter_table(X, bounds, reals):
+    return pd.DataFrame(back_transform(X, bounds), index=pd.Index(reals, name='real_name'),
+                        columns=bounds.index)
+
+# =========================== Parameter ensemble / ========================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================= ES-MDA update \ ============================= #
+
+def es_mda_update(X, D, D_obs, noise_var, alpha):
+    # X (N, n_par) transformed parameters, D (N, n_obs) simulated and D_obs
+    # perturbed observations; returns X + (D_obs - D) K^T with the Kalman
+    # gain K = C_XD (C_DD + alpha C_e)^-1 of the ensemble
+    N = len(X)
+    dX = X - X.mean(axis=0)
+    dD = D - D.mean(axis=0)
+    C_XD = dX.T @ dD / (N - 1)
+    C_DD = dD.T @ dD / (N - 1)
+    K_T = np.linalg.solve(C_DD + alpha * np.diag(noise_var), C_XD.T)
+    return X + (D_obs - D) @ K_T
+
+
+def objective(D, observed, noise_std):
+    # weighted sum of squared residuals (phi) per realisation
+    return np.sum(((D - observed) / noise_std) ** 2, axis=1)
+
+# ============================= ES-MDA update / ============================= #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================= ES-MDA runs \ =============================== #
+
+def run_ies(model, bounds, n_reals=100, n_iterations=4, relative_noise=0.1, noise_floor=1e-3, seed=None,
+            processes=0, box=None, observation_file='observation.csv', case='culpy', directory='.'):
+    # model: the imported model script; the observations are compared with
+    # the daily means of one box (default: the first); runs are stepped
+    # stacked (processes=0) or over a process pool
+    rng = np.random.default_rng(seed)
+    index = ObservationIndex(read_observations(observation_file), model.sim_start_date, model.dt, model.n_iter)
+    reduction = ObservationValues(index, model.network.boxes.index(box) if box is not None else 0)
+    observed = index.observed_values()
+    noise_std = np.maximum(relative_noise * np.abs(observed), noise_floor)
+    names = index.observation_names
+    C_init, forcing, H, network = model.model_arrays()
+
+    def write(table, name):
+        table.to_csv(os.path.join(directory, f'{case}.{name}.csv'))
+
+    reals = [str(i) for i in range(n_reals)]
+    write(pd.DataFrame(observed + noise_std * rng.standard_normal((n_reals, len(observed))),
+                       index=pd.Index(reals, name='real_name'), columns=names), 'obs+noise')
+
+    X = prior_ensemble(model.kmc, bounds, n_reals, rng)
+    lower = transform(bounds['lower'].values, bounds)
+    upper = transform(bounds['upper'].values, bounds)
+    alpha = float(n_iterations)  # equal inflation, sum of 1/alpha is 1
+    phi_rows = []
+    for iteration in range(n_iterations + 1):
+        parameters = parameter_table(X, bounds, reals)
+        D = run_ensemble(parameters, C_init, model.n_iter, model.dt, forcing, H, network, model.kmc,
+                         model.Altitude, reduction, model.backend, model.integrator, model.integrator_step,
+                         processes, model.output_chunk_rows, model.restart_file_name,
+                         reaction_step=model.reaction_step)
+        D.index.name = 'real_name'
+        write(parameters, f'{iteration}.par')
+        write(D, f'{iteration}.obs')
+
+        # failed realisations (non-finite outputs) are dropped
+        ok = np.isfinite(D.values).all(axis=1)
+        phi = objective(D.values[ok], observed, noise_std)
+        stats = [phi.mean(), phi.std(), phi.min(), phi.max()] if len(phi) else [np.nan] * 4
+        phi_rows.append([iteration, len(reals), int((~ok).sum())] + stats)
+        print(f"\titeration {iteration}: mean phi {stats[0]:.6g}, "
+              f"{int(ok.sum())} of {len(reals)} realisations")
+        if iteration == n_iterations:
+            break
+        if ok.sum() < 2:
+            raise RuntimeError(f"ES-MDA: less than two successful realisations in iteration {iteration}")
+
+        X, D, reals = X[ok], D.values[ok], [real for real, keep in zip(reals, ok) if keep]
+        D_obs = observed + np.sqrt(alpha) * noise_std * rng.standard_normal(D.shape)
+        X = np.clip(es_mda_update(X, D, D_obs, noise_std ** 2, alpha), lower, upper)
+
+    phi_table = pd.DataFrame(phi_rows, columns=['iteration', 'total_runs', 'failed_runs',
+                                                'mean', 'standard_deviation', 'min', 'max'])
+    phi_table.to_csv(os.path.join(directory, f'{case}.phi.csv'), index=False)
+    return parameter_table(X, bounds, reals), phi_table
+
+# ============================= ES-MDA runs / =============================== #
+# =========================================================================== #
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CuLPy ensemble smoother calibration (ES-MDA)')
+    parser.add_argument('model', help='model script name without extension, e.g. CuLPy_0d, or a config file')
+    parser.add_argument('bounds', help='csv with the columns parameter, lower, upper (and transform)')
+    parser.add_argument('--reals', type=int, default=100, help='number of realisations')
+    parser.add_argument('--iterations', type=int, default=4, help='number of ES-MDA updates')
+    parser.add_argument('--noise', type=float, default=0.1, help='observation noise relative to the values')
+    parser.add_argument('--noise-floor', type=float, default=1e-3, help='smallest observation noise')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=0,
+                        help='process pool size, 0 (default) steps the runs stacked')
+    parser.add_argument('--box', default=None, help='box compared with the observations (default: first box)')
+    parser.add_argument('--observations', default='observation.csv')
+    parser.add_argument('--case', default='culpy', help='prefix of the output files')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    run_ies(model, kmc_bounds_reader(args.bounds), args.reals, args.iterations, args.noise, args.noise_floor,
+            args.seed, args.processes, args.box, args.observations, args.case)
@@ -0,0 +1,250 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy optional numba (LLVM) compiled backend for simulate_C """
+
+
+import math
+import numpy as np
+from culpy_kmc import kmc_names, kmc_derived_names
+from culpy_engine import theta_block_rows
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+jit_available = numba is not None
+
+
+def njit(function):
+    # compiled with numba when it is installed, left as python otherwise
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+# =========================================================================== #
+# ========================== Compiled parameters \ ========================== #
+# The compiled kernel reads the kmc values from one float vector per
+# realisation, unpacked in the order below (kmc_names + kmc_derived_names).
+jit_kmc_names = kmc_names + kmc_derived_names
+
+
+def kmc_vector(kmc):
+    # (N, n_kmc) parameter matrix, N = 1 for a single (unstacked) kmc
+    values = [np.asarray(getattr(kmc, name), dtype=float).reshape(-1) for name in jit_kmc_names]
+    N = max(len(value) for value in values)
+    return np.column_stack([np.broadcast_to(value, (N,)) for value in values])
+
+# ========================== Compiled parameters / ========================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# =================== Pelagic process rates calculation \ =================== #
+# Scalar form of culpy_engine.pelagic_process_rates for one box, written into
+# R (11,). Expressions follow the array version term by term; LLVM may still
+# contract or reorder floating point operations, so compiled and interpreted
+# results agree to tolerance rather than bit-for-bit.
+
+@njit
+def pelagic_process_rates_jit(C_t, theta_T, O2_sat, H, I_a, salinity, f_day, p, R):
+
+    Cpy, Cpoc, Cpon, Cpop, Cdoc, Cdon, Cdop, Cam, Cni, Cph, Cox = C_t
+    (f_mortality, f_growth, f_resipration, f_excration,
+     f_c_decomp, f_n_decomp, f_p_decomp,
+     f_c_mnr_ox, f_n_mnr_ox, f_p_mnr_ox,
+     f_c_mnr_ni, f_n_mnr_ni, f_p_mnr_ni,
+     f_nitr, f_denitr) = theta_T
+    (K_be, I_s, K_SN, K_SP, a_C_chl,
+     k_mortality, theta_mortality, k_salt_death, K_Sl_salt,
+     k_growth, theta_growth, K_Sl_ox_Cpy,
+     k_resipration, theta_resipration, k_excration, theta_excration,
+     v_set_Cpy,
+     k_c_decomp, theta_c_decomp, K_Sl_Cpoc_decomp, v_set_Cpoc,
+     k_n_decomp, theta_n_decomp, K_Sl_Cpon_decomp, v_set_Cpon,
+     k_p_decomp, theta_p_decomp, K_Sl_Cpop_decomp, v_set_Cpop,
+     a_N_C, a_P_C, a_O2_C,
+     k_c_mnr_ox, theta_c_mnr_ox, K_Sl_ox_mnr_c, K_Sl_c_mnr_ox,
+     k_n_mnr_ox, theta_n_mnr_ox, K_Sl_ox_mnr_n, K_Sl_n_mnr_ox,
+     k_p_mnr_ox, theta_p_mnr_ox, K_Sl_ox_mnr_p, K_Sl_p_mnr_ox,
+     k_c_mnr_ni, theta_c_mnr_ni, K_Si_ox_mnr_c, K_Sl_ni_mnr_c, K_Sl_c_mnr_ni,
+     k_n_mnr_ni, theta_n_mnr_ni, K_Si_ox_mnr_n, K_Sl_ni_mnr_n, K_Sl_n_mnr_ni,
+     k_p_mnr_ni, theta_p_mnr_ni, K_Si_ox_mnr_p, K_Sl_ni_mnr_p, K_Sl_p_mnr_ni,
+     k_nitrification, theta_nitr, K_Sl_nitr_ox, K_Sl_nitr,
+     k_denitrification, theta_denitr, K_Si_denitr_ox, K_Sl_denitr,
+     k_raer, theta_rear,
+     k_raer_theta_rear) = p
+
+    # light and nutrient limitation
+    ChlA = (Cpy / a_C_chl) * 1000  # biomass as chlorophyll-a (µg/L)
+    K_e = K_be + (0.0088*ChlA) + (0.054*(ChlA**(2/3)))
+    constant_e = 2.718
+    I_ratio = -I_a/I_s
+    X_I = (((constant_e*f_day)/(K_e*H)) *
+            (math.exp(I_ratio*math.exp(-K_e*H)) -
+             math.exp(I_ratio)))
+    X_N_N = (Cni+Cam)/(K_SN+Cni+Cam)
+    X_N_P = Cph/(K_SP+Cph)
+    X_N = X_N_N*X_N_P
+
+    # Cpy: Phytoplankton-Carbon processes
+    r_Phyto_Death_Mortality = k_mortality * f_mortality * Cpy
+    r_Phyto_Death_Salinity = k_salt_death * (salinity/(salinity+K_Sl_salt)) * Cpy
+    R_Cpy_Growth = (k_growth * f_growth
+                     *(Cox/(Cox+K_Sl_ox_Cpy)) * X_I * X_N * Cpy)
+    R_Cpy_Respiration = k_resipration * f_resipration * Cpy
+    R_Cpy_Excration = k_excration * f_excration * Cpy
+    R_Cpy_Death = (r_Phyto_Death_Mortality + r_Phyto_Death_Salinity)
+    R_Cpy_Settling = (v_set_Cpy/H) * Cpy
+    R[0] = (+R_Cpy_Growth
+            -R_Cpy_Respiration
+            -R_Cpy_Excration
+            -R_Cpy_Death
+            -R_Cpy_Settling)
+
+    # Cpoc, Cpon, Cpop: Particulate organic matter processes
+    R_Cpoc_Decomposition = k_c_decomp * f_c_decomp * (Cpoc/(Cpoc+K_Sl_Cpoc_decomp)) * Cpoc
+    R_Cpon_Decomposition = k_n_decomp * f_n_decomp * (Cpon/(Cpon+K_Sl_Cpon_decomp)) * Cpon
+    R_Cpop_Decomposition = k_p_decomp * f_p_decomp * (Cpop/(Cpop+K_Sl_Cpop_decomp)) * Cpop
+    R[1] = (+R_Cpy_Death
+            -R_Cpoc_Decomposition
+            -(v_set_Cpoc/H) * Cpoc)
+    R[2] = (+a_N_C*R_Cpy_Death
+            -R_Cpon_Decomposition
+            -(v_set_Cpon/H) * Cpon)
+    R[3] = (+a_P_C*R_Cpy_Death
+            -R_Cpop_Decomposition
+            -(v_set_Cpop/H) * Cpop)
+
+    # Cdoc, Cdon, Cdop: Dissolved organic matter processes
+    R_Cdoc_Mineralization_ox = (k_c_mnr_ox * f_c_mnr_ox * Cox/(K_Sl_ox_mnr_c+Cox) *
+                                (Cdoc/(Cdoc+K_Sl_c_mnr_ox)) * Cdoc)
+    R_Cdoc_Mineralization = (R_Cdoc_Mineralization_ox +
+                             k_c_mnr_ni * f_c_mnr_ni * (1 - Cox/(K_Si_ox_mnr_c+Cox)) *
+                             Cni/(K_Sl_ni_mnr_c+Cni) * (Cdoc/(Cdoc+K_Sl_c_mnr_ni)) * Cdoc)
+    R_Cdon_Mineralization = (k_n_mnr_ox * f_n_mnr_ox * Cox/(K_Sl_ox_mnr_n+Cox) *
+                             (Cdon/(Cdon+K_Sl_n_mnr_ox)) * Cdon +
+                             k_n_mnr_ni * f_n_mnr_ni * (1 - Cox/(K_Si_ox_mnr_n+Cox)) *
+                             Cni/(K_Sl_ni_mnr_n+Cni) * (Cdon/(Cdon+K_Sl_n_mnr_ni)) * Cdon)
+    R_Cdop_Mineralization = (k_p_mnr_ox * f_p_mnr_ox * Cox/(K_Sl_ox_mnr_p+Cox) *
+                             (Cdop/(Cdop+K_Sl_p_mnr_ox)) * Cdop +
+                             k_p_mnr_ni * f_p_mnr_ni * (1 - Cox/(K_Si_ox_mnr_p+Cox)) *
+                             Cni/(K_Sl_ni_mnr_p+Cni) * (Cdop/(Cdop+K_Sl_p_mnr_ni)) * Cdop)
+    R[4] = (+R_Cpy_Excration
+            +R_Cpoc_Decomposition
+            -R_Cdoc_Mineralization)
+    R[5] = (+a_N_C*R_Cpy_Excration
+            +R_Cpon_Decomposition
+            -R_Cdon_Mineralization)
+    R[6] = (+a_P_C*R_Cpy_Excration
+            +R_Cpop_Decomposition
+            -R_Cdop_Mineralization)
+
+    # Cam: Ammonia processes
+    prefam = (Cam * (Cni / ((K_SN+Cam)*(K_SN+Cni))) + Cam * (K_SN / ((Cam+Cni)*(K_SN+Cni))))
+    R_Nitrification = (k_nitrification * f_nitr * (Cox/(Cox+K_Sl_nitr_ox)) * (Cam/(Cam+K_Sl_nitr))) * Cam
+    R[7] = (+R_Cdon_Mineralization
+            +a_N_C*R_Cpy_Respiration
+            -a_N_C*prefam*R_Cpy_Growth
+            -R_Nitrification)
+
+    # Cni: Nitrate processes
+    R_Denitrification = ((k_denitrification * f_denitr *
+                          (K_Si_denitr_ox/(Cox+K_Si_denitr_ox)) * (Cni/(Cni+K_Sl_denitr))) * Cni)
+    R[8] = (+R_Nitrification
+            -R_Denitrification
+            -a_N_C*(1-prefam)*R_Cpy_Growth)
+
+    # Cph: Phosphate processes
+    R[9] = (+R_Cdop_Mineralization
+            +a_P_C*R_Cpy_Respiration
+            -a_P_C*R_Cpy_Growth)
+
+    # Cox: Dissolved oxygen processes
+    R_Reaeration = k_raer_theta_rear * (O2_sat-Cox)
+    R[10] = (+R_Reaeration
+             +a_O2_C*R_Cpy_Growth
+             -a_O2_C*R_Cpy_Respiration
+             -(32/12)*R_Cdoc_Mineralization_ox
+             -(64/14)*R_Nitrification
+             +(5/4)*(32/14)*R_Denitrification)
+
+# =================== Pelagic process rates calculation / =================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# =================== Numerical Solution for C array \ ====================== #
+# The network flow matrices enter as their CSR pattern (indptr, indices), the
+# CSR data of each step is read from the forcing row starting at the first
+# column of "exchange" and "inflow".
+
+@njit
+def simulate_C_loop(C, F, theta_T, O2_sat, H, p, dt, I_a, salinity, f_day,
+                    exchange_indptr, exchange_indices, exchange_data,
+                    inflow_indptr, inflow_indices, inflow_data, boundary):
+
+    n_iter = C.shape[0] - 1
+    N, n_boxes, n_vars = C.shape[1], C.shape[2], C.shape[3]
+    R = np.empty(n_vars)
+
+    for t in range(1, n_iter + 1):
+        for m in range(N):
+            for box in range(n_boxes):
+
+                pelagic_process_rates_jit(C[t-1, m, box], theta_T[t-1, :, m, box], O2_sat[t-1, box],
+                                          H[box], F[t-1, I_a + box], F[t-1, salinity + box], F[t-1, f_day + box],
+                                          p[m], R)
+
+                for i in range(n_vars):
+                    exchange_flux = 0.0
+                    for k in range(exchange_indptr[box], exchange_indptr[box+1]):
+                        exchange_flux += F[t-1, exchange_data + k] * C[t-1, m, exchange_indices[k], i]
+                    inflow_flux = 0.0
+                    for k in range(inflow_indptr[box], inflow_indptr[box+1]):
+                        inflow_flux += F[t-1, inflow_data + k] * F[t-1, boundary + inflow_indices[k]*n_vars + i]
+                    C[t, m, box, i] = C[t-1, m, box, i] + ((exchange_flux + inflow_flux) + R[i]) * dt
+
+
+def first_column(index):
+    return index.start if isinstance(index, slice) else index
+
+
+def simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, tables, first_row=0):
+    # same arguments and result as culpy_engine.simulate_C, with the
+    # TemperatureTables already built; first_row: row of the forcing and
+    # tables C_init is the state at (a segment of a longer run)
+    lead_shape = np.shape(C_init)[:-2]
+    C_init = np.reshape(C_init, (-1,) + np.shape(C_init)[-2:])
+    N, n_boxes = C_init.shape[0], C_init.shape[1]
+
+    p = kmc_vector(kmc)
+    p = np.ascontiguousarray(np.broadcast_to(p, (N, p.shape[1])))
+    C = np.zeros((n_iter + 1, N, n_boxes, C_init.shape[2]))
+    C[0] = C_init
+    # the compiled loop runs over blocks of theta_block_rows steps, each with
+    # the theta factors of its rows only (as ThetaFactors in culpy_engine)
+    for first in range(0, n_iter, theta_block_rows):
+        last = min(first + theta_block_rows, n_iter)
+        rows = slice(first_row + first, first_row + last + 1)
+        theta_T = tables.theta_factors(kmc, rows)
+        theta_T = np.broadcast_to(theta_T.reshape(theta_T.shape[:2] + (-1, n_boxes)),
+                                  theta_T.shape[:2] + (N, n_boxes))
+        O2_sat = np.broadcast_to(tables.O2_sat[rows], (last - first + 1, n_boxes))
+        simulate_C_loop(C[first:last + 1], forcing.values[rows], np.ascontiguousarray(theta_T),
+                        np.ascontiguousarray(O2_sat), np.asarray(H, dtype=float), p, float(dt),
+                        first_column(forcing.index['I_a']), first_column(forcing.index['salinity']),
+                        first_column(forcing.index['f_day']),
+                        network.exchange.indptr.astype(np.int64), network.exchange.indices.astype(np.int64),
+                        first_column(forcing.index['exchange']),
+                        network.inflow.indptr.astype(np.int64), network.inflow.indices.astype(np.int64),
+                        first_column(forcing.index['inflow']),
+                        first_column(forcing.index['boundary']))
+
+    return C.reshape((n_iter + 1,) + lead_shape + C.shape[2:])
+
+# =================== Numerical Solution for C array / ====================== #
+# =========================================================================== #
@@ -0,0 +1,145 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy pelagic model parameters (kmc) compiled to a fixed layout """
+
+
+import numpy as np
+import pandas as pd
+
+
+# =========================================================================== #
+# =========================== kmc parameter names \ ========================= #
+kmc_names = (
+    # light and nutrient limitation
+    'K_be', 'I_s', 'K_SN', 'K_SP', 'a_C_chl',
+    # phytoplankton
+    'k_mortality', 'theta_mortality', 'k_salt_death', 'K_Sl_salt',
+    'k_growth', 'theta_growth', 'K_Sl_ox_Cpy',
+    'k_resipration', 'theta_resipration', 'k_excration', 'theta_excration',
+    'v_set_Cpy',
+    # particulate organic matter
+    'k_c_decomp', 'theta_c_decomp', 'K_Sl_Cpoc_decomp', 'v_set_Cpoc',
+    'k_n_decomp', 'theta_n_decomp', 'K_Sl_Cpon_decomp', 'v_set_Cpon',
+    'k_p_decomp', 'theta_p_decomp', 'K_Sl_Cpop_decomp', 'v_set_Cpop',
+    # stoichiometry
+    'a_N_C', 'a_P_C', 'a_O2_C',
+    # mineralization of dissolved organic matter by oxygen
+    'k_c_mnr_ox', 'theta_c_mnr_ox', 'K_Sl_ox_mnr_c', 'K_Sl_c_mnr_ox',
+    'k_n_mnr_ox', 'theta_n_mnr_ox', 'K_Sl_ox_mnr_n', 'K_Sl_n_mnr_ox',
+    'k_p_mnr_ox', 'theta_p_mnr_ox', 'K_Sl_ox_mnr_p', 'K_Sl_p_mnr_ox',
+    # mineralization of dissolved organic matter by nitrate
+    'k_c_mnr_ni', 'theta_c_mnr_ni', 'K_Si_ox_mnr_c', 'K_Sl_ni_mnr_c', 'K_Sl_c_mnr_ni',
+    'k_n_mnr_ni', 'theta_n_mnr_ni', 'K_Si_ox_mnr_n', 'K_Sl_ni_mnr_n', 'K_Sl_n_mnr_ni',
+    'k_p_mnr_ni', 'theta_p_mnr_ni', 'K_Si_ox_mnr_p', 'K_Sl_ni_mnr_p', 'K_Sl_p_mnr_ni',
+    # nitrification and denitrification
+    'k_nitrification', 'theta_nitr', 'K_Sl_nitr_ox', 'K_Sl_nitr',
+    'k_denitrification', 'theta_denitr', 'K_Si_denitr_ox', 'K_Sl_denitr',
+    # reaeration
+    'k_raer', 'theta_rear',
+)
+
+# constants derived from kmc once per compilation, each one is the exact
+# left-to-right product the rate expressions would otherwise form per step
+kmc_derived_names = (
+    'k_raer_theta_rear',
+)
+# =========================== kmc parameter names / ========================= #
+# =========================================================================== #
+
+
+class CompiledKMC:
+    # Fixed slot layout of the kmc parameters. Values are floats for a single
+    # run or (N, 1) arrays for an ensemble (see stack_kmc).
+
+    __slots__ = kmc_names + kmc_derived_names
+
+    def __init__(self, kmc_dict, source="kmc"):
+        missing = [name for name in kmc_names if name not in kmc_dict]
+        if missing:
+            raise ValueError(f"missing kmc parameter(s) in {source}: {', '.join(missing)}")
+        unknown = [name for name in kmc_dict if name not in kmc_names]
+        if unknown:
+            raise ValueError(f"unknown kmc parameter(s) in {source}: {', '.join(unknown)}")
+
+        for name in kmc_names:
+            setattr(self, name, kmc_dict[name])
+
+        self.k_raer_theta_rear = self.k_raer * self.theta_rear
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in kmc_names}
+
+    def replace(self, **overrides):
+        return CompiledKMC({**self.as_dict(), **overrides})
+
+
+def kmc_values_reader(file_name):
+    # {name: value} of a "name = value" parameter file (all or some of kmc)
+    kmc_dict = {}
+    f = open(file_name, "r+")
+    for line in f:
+        line_ = line.split()
+        if not line_:
+            continue
+        kmc_name = line_[0]
+        kmc_values = float(line_[2])
+        kmc_dict[kmc_name] = kmc_values
+    f.close()
+    return kmc_dict
+
+
+def kmc_reader(file_name):
+    return CompiledKMC(kmc_values_reader(file_name), file_name)
+
+
+# =========================================================================== #
+# ========================== Parameter ensembles \ ========================== #
+# An ensemble run steps N parameter sets at once: every kmc value becomes an
+# (N, 1) array, the trailing axis broadcasts against the box axis, and the
+# state gets a leading ensemble axis (n_iter+1, N, n_boxes, 11).
+
+def kmc_table_reader(file_name):
+    # one realisation per row (first column is the realisation name), the
+    # columns override the matching entries of the base kmc
+    kmc_table = pd.read_csv(file_name, index_col=0)
+    unknown = [name for name in kmc_table.columns if name not in kmc_names]
+    if unknown:
+        raise ValueError(f"unknown kmc parameter(s) in {file_name}: {', '.join(unknown)}")
+    return kmc_table
+
+
+def kmc_ensemble_reader(file_name, kmc):
+    kmc_table = kmc_table_reader(file_name)
+    kmc_list = [kmc.replace(**row) for row in kmc_table.to_dict(orient='records')]
+    return list(kmc_table.index.astype(str)), kmc_list
+
+
+def kmc_bounds_reader(file_name):
+    # bounds of the varied kmc parameters, csv with the columns parameter,
+    # lower, upper and optionally transform ("log" for log10 transformed
+    # parameters, as in PEST; "none" otherwise)
+    bounds = pd.read_csv(file_name)
+    if 'transform' not in bounds:
+        bounds['transform'] = 'none'
+    bounds['transform'] = bounds['transform'].fillna('none').str.strip().str.lower()
+    bounds = bounds.set_index('parameter')[['lower', 'upper', 'transform']]
+    unknown = [name for name in bounds.index if name not in kmc_names]
+    if unknown:
+        raise ValueError(f"unknown kmc parameter(s) in {file_name}: {', '.join(unknown)}")
+    if (bounds['lower'] >= bounds['upper']).any():
+        raise ValueError(f"lower bounds must be below the upper bounds in {file_name}")
+    if ((bounds['transform'] == 'log') & (bounds['lower'] <= 0)).any():
+        raise ValueError(f"log transformed parameters need positive bounds in {file_name}")
+    return bounds
+
+
+def stack_kmc(kmc_list):
+    return CompiledKMC({name: np.array([getattr(kmc, name) for kmc in kmc_list], dtype=float)[:, None]
+                        for name in kmc_names})
+
+# ========================== Parameter ensembles / ========================== #
+# =========================================================================== #
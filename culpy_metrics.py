@@ -0,0 +1,227 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy goodness-of-fit metrics and PEST output files """
+
+
+import os
+import numpy as np
+import pandas as pd
+from culpy_engine import var_index
+from culpy_output import output_dates
+
+
+# observation columns and the state variables they are compared with, in the
+# order of pest.out (columns missing in the observation file are skipped)
+observation_columns = {'NH4': 'Cam', 'NO3': 'Cni', 'PO4': 'Cph', 'DOX': 'Cox'}
+
+metric_names = ('r2', 're', 'pbias', 'rmse', 'nse', 'kge')
+
+
+# =========================================================================== #
+# ========================== Observation alignment \ ======================== #
+# The observation set does not change during a calibration, so it is aligned
+# once with the dt grid of the run: every observation date is compared with
+# the daily mean of its day, the rows [start, stop) of the grid. A run then
+# only sums these windows (ObservationIndex.reduction streams them, as
+# PeriodMean does for daily means) and gathers the compared values with one
+# fancy index. The index holds plain arrays, it is pickled to the workers of
+# a process pool and saved to / loaded from an npz file.
+
+def read_observations(file_name):
+    # Date indexed observation table
+    observation_df = pd.read_csv(file_name)
+    observation_df['Date'] = pd.to_datetime(observation_df['Date'], format='mixed')
+    return observation_df.set_index('Date')
+
+
+class WindowMeans:
+
+    def __init__(self, starts, stops):
+        # non-overlapping windows of grid rows, sorted by start
+        self.starts = starts
+        self.stops = stops
+        self.sum = None
+        self.count = None
+
+    def __call__(self, first_row, C_chunk):
+        n_rows = len(C_chunk)
+        lower = np.clip(self.starts - first_row, 0, n_rows)
+        upper = np.clip(self.stops - first_row, 0, n_rows)
+        bounds = np.column_stack([lower, upper]).ravel()
+        valid = ~np.isnan(C_chunk)
+        # a zero row at the end keeps every bound a valid reduceat index
+        padding = np.zeros((1,) + C_chunk.shape[1:])
+        sums = np.add.reduceat(np.concatenate([np.where(valid, C_chunk, 0.0), padding]), bounds, axis=0)[::2]
+        counts = np.add.reduceat(np.concatenate([valid.astype(float), padding]), bounds, axis=0)[::2]
+        empty = upper <= lower
+        sums[empty] = 0.0
+        counts[empty] = 0.0
+        if self.sum is None:
+            self.sum, self.count = sums, counts
+        else:
+            self.sum += sums
+            self.count += counts
+
+    def means(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.count
+
+
+class ObservationIndex:
+
+    def __init__(self, observation_df, sim_start_date, dt, n_iter, columns=observation_columns):
+        names = [column for column in columns if column in observation_df]
+        days = pd.DatetimeIndex(observation_df.index).normalize()
+        dates = output_dates(sim_start_date, dt, 0, n_iter + 1)
+        window_days = days.unique().sort_values()
+        starts = dates.searchsorted(window_days)
+        stops = dates.searchsorted(window_days + pd.Timedelta(days=1))
+        # observations of days outside the run are left out
+        inside = (stops > starts)[window_days.get_indexer(days)]
+
+        self.sim_start_date = pd.Timestamp(sim_start_date).isoformat()
+        self.dt = float(dt)
+        self.n_iter = int(n_iter)
+        self.names = names
+        self.variables = np.array([var_index[columns[name]] for name in names], dtype=np.int64)
+        self.times = pd.DatetimeIndex(observation_df.index[inside])
+        self.starts = starts.astype(np.int64)
+        self.stops = stops.astype(np.int64)
+        self.rows = window_days.get_indexer(days[inside]).astype(np.int64)
+        self.observed = observation_df.loc[inside, names].to_numpy(dtype=float)
+        # (window, variable) of the valid observations in pest.out order,
+        # column by column in time order
+        columns_, observations = np.nonzero(~np.isnan(self.observed.T))
+        self.pairs = (self.rows[observations], self.variables[columns_])
+        # PEST observation names of the pairs, e.g. nh4_01_28_15
+        self.observation_names = [f'{names[column].lower()}_{self.times[observation]:%m_%d_%y}'
+                                  for column, observation in zip(columns_, observations)]
+
+    def matches(self, sim_start_date, dt, n_iter):
+        return ((self.sim_start_date, self.dt, self.n_iter) ==
+                (pd.Timestamp(sim_start_date).isoformat(), float(dt), int(n_iter)))
+
+    def reduction(self):
+        # streaming daily means of the windows, output(first_row, C_chunk)
+        return WindowMeans(self.starts, self.stops)
+
+    def window_means(self, C):
+        # daily window means (n_windows, 11) of a full (n_iter+1, 11) series
+        reduction = self.reduction()
+        reduction(0, np.asarray(C, dtype=float))
+        return reduction.means()
+
+    def simulated(self, means):
+        # (n_obs, n_columns) compared values from the window means
+        return means[self.rows[:, None], self.variables[None, :]]
+
+    def pest_values(self, means):
+        return means[self.pairs]
+
+    def observed_values(self):
+        # the valid observations in pest.out order
+        return self.observed.T[~np.isnan(self.observed.T)]
+
+    def save(self, file_name):
+        np.savez(file_name, sim_start_date=self.sim_start_date, dt=self.dt, n_iter=self.n_iter,
+                 names=np.array(self.names, dtype=str), variables=self.variables,
+                 times=self.times.asi8, starts=self.starts, stops=self.stops, rows=self.rows,
+                 observed=self.observed, pair_rows=self.pairs[0], pair_variables=self.pairs[1],
+                 observation_names=np.array(self.observation_names, dtype=str))
+
+
+def load_observation_index(file_name):
+    index = ObservationIndex.__new__(ObservationIndex)
+    with np.load(file_name) as data:
+        index.sim_start_date = str(data['sim_start_date'])
+        index.dt = float(data['dt'])
+        index.n_iter = int(data['n_iter'])
+        index.names = [str(name) for name in data['names']]
+        index.times = pd.DatetimeIndex(data['times'])
+        for name in ('variables', 'starts', 'stops', 'rows', 'observed'):
+            setattr(index, name, data[name])
+        index.pairs = (data['pair_rows'], data['pair_variables'])
+        index.observation_names = [str(name) for name in data['observation_names']]
+    return index
+
+# ========================== Observation alignment / ======================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ================================ Metrics \ ================================ #
+# All metrics of all columns (and of all ensemble members, the leading axes of
+# simulated) in one pass over the observation axis; pairs with a NaN on
+# either side are left out.
+#   r2   : squared Pearson correlation (the r**2 of a linear regression)
+#   re   : sum|obs - sim| / sum(obs)
+#   pbias: 100 * sum(obs - sim) / sum(obs)
+#   rmse : root mean squared error
+#   nse  : Nash-Sutcliffe efficiency
+#   kge  : Kling-Gupta efficiency (Gupta et al., 2009)
+
+def metrics(observed, simulated):
+    simulated = np.asarray(simulated, dtype=float)
+    observed = np.broadcast_to(np.asarray(observed, dtype=float), simulated.shape)
+    valid = ~(np.isnan(observed) | np.isnan(simulated))
+    n = valid.sum(axis=-2)
+    o = np.where(valid, observed, 0.0)
+    s = np.where(valid, simulated, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sum_o = o.sum(axis=-2)
+        sum_s = s.sum(axis=-2)
+        mean_o = sum_o / n
+        mean_s = sum_s / n
+        d_o = np.where(valid, o - mean_o[..., None, :], 0.0)
+        d_s = np.where(valid, s - mean_s[..., None, :], 0.0)
+        var_o = (d_o**2).sum(axis=-2)
+        var_s = (d_s**2).sum(axis=-2)
+        r = (d_o * d_s).sum(axis=-2) / np.sqrt(var_o * var_s)
+        squared_error = ((s - o)**2).sum(axis=-2)
+        return {'r2': r**2,
+                're': np.abs(o - s).sum(axis=-2) / sum_o,
+                'pbias': (sum_o - sum_s) / sum_o * 100,
+                'rmse': np.sqrt(squared_error / n),
+                'nse': 1 - squared_error / var_o,
+                'kge': 1 - np.sqrt((r - 1)**2 + (np.sqrt(var_s / var_o) - 1)**2 + (mean_s / mean_o - 1)**2)}
+
+
+def metrics_table(observed, simulated, names, members=None):
+    # one row per column, or per (member, column) for an ensemble
+    # (simulated (N, n_obs, n_columns))
+    values = metrics(observed, simulated)
+    table = pd.DataFrame({name: np.ravel(values[name]) for name in metric_names})
+    if np.ndim(simulated) == 2:
+        table.insert(0, 'column', names)
+        return table
+    members = members if members is not None else range(len(simulated))
+    table.insert(0, 'column', np.tile(names, len(members)))
+    table.insert(0, 'member', np.repeat(list(members), len(names)))
+    return table
+
+# ================================ Metrics / ================================ #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================ PEST output files \ ========================== #
+
+def write_pest_outputs(index, means, directory='.'):
+    # pest.out and the r2/re/pbias files of one run from the daily window
+    # means of its ObservationIndex, each file in one write; metrics.csv
+    # holds all metrics
+    observed, simulated, names = index.observed, index.simulated(means), index.names
+    values = metrics(observed, simulated)
+    files = {'pest.out': ''.join(f'{value!r}\n' for value in index.pest_values(means).tolist())}
+    for name in ('r2', 're', 'pbias'):
+        files[f'{name}_values.txt'] = ''.join(f'{column}: {value!r}\n'
+                                              for column, value in zip(names, values[name].tolist()))
+    for file_name, text in files.items():
+        with open(os.path.join(directory, file_name), 'w') as file:
+            file.write(text)
+    metrics_table(observed, simulated, names).to_csv(os.path.join(directory, 'metrics.csv'), index=False)
+
+# ============================ PEST output files / ========================== #
+# =========================================================================== #
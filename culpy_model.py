@@ -0,0 +1,248 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy model set up from a configuration file, prepared once and run repeatedly """
+
+# The case properties of the model scripts (dates, time step, files, boxes,
+# flows and the connectivity table) are given in a TOML or YAML file, see
+# CuLPy.toml. Model(RunConfig) reads and interpolates the inputs, packs the
+# forcing matrix, builds the box network and the temperature tables once;
+# Model.run(params, initial_state) then only steps the model. A Model has the
+# names of an imported model script (sim_start_date, dt, n_iter, kmc,
+# network, model_arrays(), ...), so it can be passed wherever one is used
+# (culpy_ensemble, culpy_morris, culpy_ies, culpy_scan, the model server).
+#
+# usage, one run with the output written as the model scripts do:
+#   python culpy_model.py CuLPy.toml
+
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import numpy as np
+from fractions import Fraction
+from culpy_engine import state_vars, var_index, state_array, boundary_array, ForcingMatrix
+from culpy_engine import TemperatureTables, simulate_C
+from culpy_kmc import CompiledKMC, kmc_reader
+from culpy_forcing import load_forcing
+from culpy_network import BoxNetwork, read_connections
+from culpy_output import OutputStage, SimulationResult, read_observation_times
+
+
+# box series: model name, per box [input name, column name]
+box_series = ('T', 'I_a', 'salinity', 'f_day', 'V')
+
+
+# =========================================================================== #
+# ============================== Run config \ =============================== #
+
+def load_config(file_name):
+    # nested dict of a .toml, .yaml or .yml file (YAML needs PyYAML)
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.toml':
+        import tomllib
+        with open(file_name, 'rb') as f:
+            return tomllib.load(f)
+    if extension in ('.yaml', '.yml'):
+        import yaml
+        with open(file_name, 'r') as f:
+            return yaml.safe_load(f) or {}
+    raise ValueError(f"unknown config file type: {extension} (.toml, .yaml or .yml)")
+
+
+class RunConfig:
+    # defaults as in the model scripts, None means required
+    defaults = {'sim_start_date': None, 'sim_end_date': None, 'JDay_start_date': None, 'dt': None,
+                'Altitude': None, 'kmc_file_name': None, 'forcing_cache_dir': '', 'backend': 'python',
+                'integrator': 'euler', 'integrator_step': 0, 'reaction_step': 0, 'reaction_threads': 0,
+                'output_format': '.csv', 'output_chunk_rows': 10000, 'output_series': 'dt',
+                'observation_file_name': '', 'observation_sampling': 'instant', 'checkpoint_file_name': '',
+                'checkpoint_interval': 0, 'restart_file_name': '', 'flow_factor': 86400, 'inputs': None,
+                'boxes': None, 'flows': None, 'connections': None}
+
+    def __init__(self, config, directory='.'):
+        # config: {name: value}; relative file names are taken from directory
+        unknown = [name for name in config if name not in self.defaults]
+        if unknown:
+            raise ValueError(f"unknown config entries: {', '.join(unknown)}")
+        missing = [name for name, default in self.defaults.items() if default is None and name not in config]
+        if missing:
+            raise ValueError(f"missing config entries: {', '.join(missing)}")
+        for name, default in self.defaults.items():
+            setattr(self, name, config.get(name, default))
+
+        # dt may be a fraction, e.g. "1/24"
+        self.dt = float(Fraction(self.dt)) if isinstance(self.dt, str) else float(self.dt)
+        self.directory = directory
+        self.wDate_files = dict(self.inputs.get('wDate', {}))
+        self.wJDay_files = dict(self.inputs.get('wJDay', {}))
+        # the connectivity table inline or as a csv file
+        if isinstance(self.connections, str):
+            self.connections = read_connections(self.path(self.connections))
+        self.connections = [tuple(connection) for connection in self.connections]
+
+        for box, properties in self.boxes.items():
+            missing = [name for name in ('H', 'initial') + box_series if name not in properties]
+            if missing:
+                raise ValueError(f"missing entries of box {box}: {', '.join(missing)}")
+            missing = [var for var in state_vars if var not in properties['initial']]
+            if missing:
+                raise ValueError(f"missing initial concentrations of box {box}: {', '.join(missing)}")
+
+    @classmethod
+    def from_file(cls, file_name):
+        return cls(load_config(file_name), os.path.dirname(os.path.abspath(file_name)))
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name) if file_name else file_name
+
+    @property
+    def n_iter(self):
+        days = (np.datetime64(self.sim_end_date, 'D') - np.datetime64(self.sim_start_date, 'D')).astype(int)
+        return int(days / self.dt)
+
+# ============================== Run config / =============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ================================= Model \ ================================= #
+
+class Model:
+
+    def __init__(self, config):
+        # config: RunConfig or the name of its file
+        if not isinstance(config, RunConfig):
+            config = RunConfig.from_file(config)
+        c = self.config = config
+        for name in ('sim_start_date', 'sim_end_date', 'JDay_start_date', 'dt', 'Altitude', 'backend',
+                     'integrator', 'integrator_step', 'reaction_step', 'reaction_threads', 'output_format',
+                     'output_chunk_rows', 'output_series', 'observation_sampling', 'checkpoint_interval', 'n_iter'):
+            setattr(self, name, getattr(c, name))
+        self.kmc_file_name = c.path(c.kmc_file_name)
+        self.checkpoint_file_name = c.path(c.checkpoint_file_name)
+        self.restart_file_name = c.path(c.restart_file_name)
+        self.kmc = kmc_reader(self.kmc_file_name)
+        self.network = BoxNetwork(list(c.boxes), c.connections)
+        self.observation_times = (read_observation_times(c.path(c.observation_file_name))
+                                  if c.observation_file_name else None)
+
+        inputs = load_forcing(c.sim_start_date, c.sim_end_date, c.JDay_start_date, 1/c.dt,
+                              wDate_files={name: c.path(f) for name, f in c.wDate_files.items()},
+                              wJDay_files={name: c.path(f) for name, f in c.wJDay_files.items()},
+                              cache_dir=c.path(c.forcing_cache_dir))
+
+        def column(reference, where):
+            name, column_name = reference
+            if name not in inputs or column_name not in inputs[name]:
+                raise ValueError(f"{where}: no input column {column_name} in {name}")
+            return inputs[name][column_name]
+
+        boxes = [c.boxes[box] for box in self.network.boxes]
+        series = {name: np.column_stack([column(box[name], f'{name} of box {box_name}')
+                                         for box_name, box in zip(self.network.boxes, boxes)])
+                  for name in box_series}
+        missing = [flow for flow in self.network.flows if flow not in c.flows]
+        if missing:
+            raise ValueError(f"no input column of the flow(s): {', '.join(missing)}")
+        Q = {flow: column(c.flows[flow], f'flow {flow}') * c.flow_factor for flow in self.network.flows}
+        for boundary in self.network.boundaries:
+            if boundary not in inputs:
+                raise ValueError(f"no input of the boundary {boundary}")
+        flow_series = self.network.forcing_series(
+            Q, series.pop('V'), {boundary: boundary_array(inputs[boundary]) for boundary in self.network.boundaries})
+
+        # forcing series and flow matrix data packed once, as in the scripts
+        self.forcing = ForcingMatrix({**series, **flow_series})
+        self.H = np.array([box['H'] for box in boxes], dtype=float)
+        self.C_init = state_array(*[box['initial'] for box in boxes])
+        self.tables = TemperatureTables(self.forcing['T'], self.forcing['salinity'], self.Altitude)
+
+    def model_arrays(self):
+        return self.C_init, self.forcing, self.H, self.network
+
+    def initial_state(self, initial_state=None):
+        # None: the config values; {box: {var: value}} overrides single
+        # values; an array (n_boxes, 11) is taken as it is
+        if initial_state is None:
+            return self.C_init
+        if isinstance(initial_state, dict):
+            C_init = self.C_init.copy()
+            for box, values in initial_state.items():
+                for var, value in values.items():
+                    C_init[self.network.boxes.index(box), var_index[var]] = value
+            return C_init
+        C_init = np.asarray(initial_state, dtype=float)
+        if C_init.shape != self.C_init.shape:
+            raise ValueError(f"initial state of shape {C_init.shape}, expected {self.C_init.shape}")
+        return C_init
+
+    def run(self, params=None, initial_state=None, output=None, checkpoint=None, restart=None):
+        # params: CompiledKMC or {name: value} kmc overrides
+        # checkpoint / restart: checkpoint file names in place of the config
+        # ones, "" for none; a restarted run starts at the checkpoint row
+        # returns the SimulationResult of all boxes, or None when the run is
+        # streamed to output(first_row, C_chunk)
+        if params is None:
+            kmc = self.kmc
+        elif isinstance(params, CompiledKMC):
+            kmc = params
+        else:
+            kmc = self.kmc.replace(**params)
+        checkpoint = self.checkpoint_file_name if checkpoint is None else checkpoint
+        restart = self.restart_file_name if restart is None else restart
+        C = simulate_C(self.initial_state(initial_state), self.n_iter, self.dt, self.forcing, self.H,
+                       self.network, kmc, self.Altitude, self.tables, self.backend, self.integrator,
+                       self.integrator_step, output=output, chunk_rows=self.output_chunk_rows,
+                       checkpoint=checkpoint, checkpoint_interval=self.checkpoint_interval, restart=restart,
+                       threads=self.reaction_threads, reaction_step=self.reaction_step)
+        return None if C is None else SimulationResult(C, self.network.boxes, self.sim_start_date, self.dt,
+                                                       state_vars, self.n_iter + 1 - len(C))
+
+    def output_stage(self, name='output'):
+        return OutputStage(name, self.sim_start_date, self.dt, state_vars, self.output_format, self.output_series,
+                           self.observation_times, self.observation_sampling, self.network.boxes)
+
+
+def load_model(name):
+    # a Model of a config file, or the imported model script of that name
+    if os.path.splitext(name)[1].lower() in ('.toml', '.yaml', '.yml'):
+        return Model(name)
+    sys.path.insert(0, os.getcwd())
+    return importlib.import_module(name)
+
+# ================================= Model / ================================= #
+# =========================================================================== #
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CuLPy run of a configuration file')
+    parser.add_argument('config', help='.toml, .yaml or .yml configuration file')
+    parser.add_argument('--output', default='output', help='output file name without extension')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    print('\n# =================================================================== #')
+    print('\nmodel initialization...\n')
+    model = Model(args.config)
+    print(f'\tnumber of boxes                : {len(model.network.boxes)}')
+    print(f'\tpelagic constants file name    : {model.kmc_file_name}')
+    print(f'\tsimulation start date          : {model.sim_start_date}')
+    print(f'\tsimulation end date            : {model.sim_end_date}')
+    print(f'\tdt                             : {int(24*60*model.dt)} minute(s)')
+    print(f'\tbackend                        : {model.backend}')
+    print(f'\tintegrator                     : {model.integrator}')
+
+    stage = model.output_stage(args.output)
+    try:
+        model.run(output=stage)
+    finally:
+        stage.close()
+
+    elapsed_time = time.time() - start_time
+    print('\nsimulation took: %.2f seconds\n' % elapsed_time)
+    print('# =================================================================== #')
@@ -0,0 +1,155 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy Morris elementary effects screening of the kmc parameters """
+
+# Trajectories over the kmc parameters of a bounds table are run as one
+# ensemble of the model (see culpy_ensemble), every output column of the
+# reduced results is a metric with its own mu, mu* and sigma per parameter.
+#
+# usage, from the folder of the model script and its inputs:
+#   python culpy_morris.py CuLPy_0d morris_bounds.csv --trajectories 20 --metric Cam_CL
+# writes morris_runs.csv (parameter sets and results), morris_indices.csv
+# (all metrics) and data.csv (the metric read by culpy_pest/plot_sen_Morris.py)
+
+
+import argparse
+import numpy as np
+import pandas as pd
+from culpy_kmc import kmc_bounds_reader
+from culpy_model import load_model
+from culpy_ensemble import run_ensemble, RunMean, ObservationReduction
+
+
+# =========================================================================== #
+# ============================ Morris design \ ============================== #
+# A trajectory starts at a random point of the p-level grid of the unit cube
+# and moves every parameter once, in random order, by delta = p/(2(p-1))
+# (Morris, 1991). Unit values are mapped to the bounds (kmc_bounds_reader)
+# linearly, or linearly in log10 for transform "log".
+
+def morris_trajectories(n_parameters, n_trajectories, levels=4, seed=None):
+    # unit values (n_trajectories, n_parameters+1, n_parameters)
+    rng = np.random.default_rng(seed)
+    delta = levels / (2 * (levels - 1))
+    starts = np.arange(int(np.floor((1 - delta) * (levels - 1) + 1e-9)) + 1) / (levels - 1)
+    k = n_parameters
+    lower = np.tril(np.ones((k + 1, k)), -1)
+    trajectories = np.empty((n_trajectories, k + 1, k))
+    for r in range(n_trajectories):
+        x_start = rng.choice(starts, k)
+        directions = rng.choice([-1.0, 1.0], k)
+        order = rng.permutation(k)
+        # B* = x* + delta/2 * ((2B - 1) D* + 1) P*
+        B = x_start + (delta / 2) * ((2 * lower - 1) * directions + 1)
+        trajectories[r] = B[:, order]
+    return trajectories
+
+
+def parameter_values(unit, bounds):
+    lower = bounds['lower'].values
+    upper = bounds['upper'].values
+    log = (bounds['transform'] == 'log').values
+    values = lower + unit * (upper - lower)
+    log_values = 10 ** (np.log10(np.where(log, lower, 1.0)) +
+                        unit * (np.log10(np.where(log, upper, 1.0)) - np.log10(np.where(log, lower, 1.0))))
+    return np.where(log, log_values, values)
+
+
+def morris_table(trajectories, bounds):
+    # parameter table of all trajectory points, one realisation per row
+    n_trajectories, n_points, _ = trajectories.shape
+    index = pd.Index([f't{r+1}_{j}' for r in range(n_trajectories) for j in range(n_points)],
+                     name='realisation')
+    return pd.DataFrame(parameter_values(trajectories.reshape(-1, len(bounds)), bounds),
+                        index=index, columns=bounds.index)
+
+# ============================ Morris design / ============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# =========================== Morris indices \ ============================== #
+
+def elementary_effects(trajectories, Y):
+    # Y (n_trajectories*(k+1), n_metrics) of the trajectory points, returns
+    # (n_trajectories, k, n_metrics) with the effects in parameter order
+    n_trajectories, n_points, k = trajectories.shape
+    Y = np.asarray(Y, dtype=float).reshape(n_trajectories, n_points, -1)
+    steps = np.diff(trajectories, axis=1)  # one nonzero entry per step
+    moved = np.argmax(np.abs(steps), axis=2)
+    step = np.take_along_axis(steps, moved[:, :, None], axis=2)
+    effects = np.diff(Y, axis=1) / step
+    ee = np.empty((n_trajectories, k, Y.shape[2]))
+    np.put_along_axis(ee, moved[:, :, None], effects, axis=1)
+    return ee
+
+
+def morris_indices(trajectories, results, parameters):
+    # mu, mu* and sigma of every metric (column of results) per parameter
+    ee = elementary_effects(trajectories, results.values)
+    indices = []
+    for m, metric in enumerate(results.columns):
+        indices.append(pd.DataFrame({'metric': metric, 'parameters': list(parameters),
+                                     'mu': ee[:, :, m].mean(axis=0),
+                                     'mu_star': np.abs(ee[:, :, m]).mean(axis=0),
+                                     'sigma': ee[:, :, m].std(axis=0, ddof=1) if len(ee) > 1 else np.nan}))
+    return pd.concat(indices, ignore_index=True)
+
+
+def write_morris_data(indices, metric, file_name='data.csv'):
+    # the parameters, mu_star, sigma table of plot_sen_Morris.py
+    if metric not in set(indices['metric']):
+        raise ValueError(f"unknown metric: {metric}")
+    data = indices[indices['metric'] == metric]
+    data[['parameters', 'mu', 'mu_star', 'sigma']].to_csv(file_name, index=False)
+
+# =========================== Morris indices / ============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================= Morris runs \ =============================== #
+
+def run_morris(model, bounds, n_trajectories, levels=4, seed=None, processes=None, reduction=None):
+    # model: the imported model script; reduction defaults to the observation
+    # times of its first box when it reads observations, else run means
+    if reduction is None:
+        if model.observation_times is not None:
+            reduction = ObservationReduction(model.sim_start_date, model.dt, model.observation_times,
+                                             model.observation_sampling)
+        else:
+            reduction = RunMean(model.network.boxes)
+    trajectories = morris_trajectories(len(bounds), n_trajectories, levels, seed)
+    table = morris_table(trajectories, bounds)
+    C_init, forcing, H, network = model.model_arrays()
+    results = run_ensemble(table, C_init, model.n_iter, model.dt, forcing, H, network, model.kmc,
+                           model.Altitude, reduction, model.backend, model.integrator, model.integrator_step,
+                           processes, model.output_chunk_rows, model.restart_file_name,
+                           reaction_step=model.reaction_step)
+    return table, results, morris_indices(trajectories, results, bounds.index)
+
+# ============================= Morris runs / =============================== #
+# =========================================================================== #
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CuLPy Morris elementary effects screening')
+    parser.add_argument('model', help='model script name without extension, e.g. CuLPy_0d, or a config file')
+    parser.add_argument('bounds', help='csv with the columns parameter, lower, upper (and transform)')
+    parser.add_argument('--trajectories', type=int, default=10)
+    parser.add_argument('--levels', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='process pool size (default: one per core), 0 steps the runs stacked')
+    parser.add_argument('--metric', default=None, help='metric written to data.csv (default: the first)')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    bounds = kmc_bounds_reader(args.bounds)
+    table, results, indices = run_morris(model, bounds, args.trajectories, args.levels, args.seed,
+                                         args.processes)
+    table.join(results).to_csv('morris_runs.csv')
+    indices.to_csv('morris_indices.csv', index=False)
+    write_morris_data(indices, args.metric or results.columns[0])
@@ -0,0 +1,106 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy box network: connectivity table and sparse advective flow matrices """
+
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+# =========================================================================== #
+# ============================== Box network \ ============================== #
+# The network is given by its boxes and a connectivity table with one row per
+# flow: (from, to, flow). A name that is not a box is a boundary; a boundary
+# in "from" is an inflow with a (n_iter+1, 11) concentration series of that
+# name, a boundary in "to" is an outflow. Flow series are in m3/day.
+#
+# Advection of all boxes is one sparse product per time step
+#     dC/dt = exchange @ C + inflow @ C_boundary
+# exchange (n_boxes, n_boxes) holds +Q/V_to for box to box flows and -Q/V_from
+# on the diagonal for every flow leaving a box, inflow (n_boxes, n_boundaries)
+# holds +Q/V_to for boundary inflows. The sparsity pattern is fixed, only the
+# CSR data changes per step and is read from the forcing matrix columns
+# "exchange" and "inflow".
+
+def read_connections(file_name):
+    # connectivity table csv with the columns from, to, flow
+    table = pd.read_csv(file_name, dtype=str)
+    return list(table[['from', 'to', 'flow']].itertuples(index=False, name=None))
+
+
+def csr_pattern(rows, cols, shape):
+    # CSR matrix with one explicit zero per unique (row, col), rows and
+    # columns sorted, and the data position of every given entry
+    keys = np.unique(np.column_stack([rows, cols]), axis=0)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(keys[:, 0], minlength=shape[0]))])
+    matrix = sp.csr_matrix((np.zeros(len(keys)), keys[:, 1], indptr), shape=shape)
+    position = {(row, col): k for k, (row, col) in enumerate(map(tuple, keys))}
+    return matrix, [position[(row, col)] for row, col in zip(rows, cols)]
+
+
+class BoxNetwork:
+
+    def __init__(self, boxes, connections):
+        self.boxes = list(boxes)
+        self.connections = [tuple(connection) for connection in connections]
+        box_index = {box: i for i, box in enumerate(self.boxes)}
+        if len(box_index) != len(self.boxes):
+            raise ValueError("box names must be unique")
+
+        self.boundaries = []
+        for source, target, flow in self.connections:
+            if source not in box_index and target not in box_index:
+                raise ValueError(f"flow {flow} connects no box: {source} -> {target}")
+            if source not in box_index and source not in self.boundaries:
+                self.boundaries.append(source)
+        boundary_index = {boundary: i for i, boundary in enumerate(self.boundaries)}
+        self.flows = list(dict.fromkeys(flow for _, _, flow in self.connections))
+
+        # one contribution per matrix entry a flow adds to:
+        # (matrix, row, col, flow, box of the volume, sign)
+        contributions = []
+        for source, target, flow in self.connections:
+            if target in box_index and source in box_index:
+                contributions.append(('exchange', box_index[target], box_index[source],
+                                      flow, box_index[target], 1.0))
+            elif target in box_index:
+                contributions.append(('inflow', box_index[target], boundary_index[source],
+                                      flow, box_index[target], 1.0))
+            if source in box_index:
+                contributions.append(('exchange', box_index[source], box_index[source],
+                                      flow, box_index[source], -1.0))
+
+        n_boxes = len(self.boxes)
+        self.contributions = {}
+        for name, n_cols in (('exchange', n_boxes), ('inflow', len(self.boundaries))):
+            entries = [c[1:] for c in contributions if c[0] == name]
+            rows = np.array([e[0] for e in entries], dtype=np.int64)
+            cols = np.array([e[1] for e in entries], dtype=np.int64)
+            matrix, positions = csr_pattern(rows, cols, (n_boxes, n_cols))
+            setattr(self, name, matrix)
+            self.contributions[name] = [(position, flow, box, sign) for position, (_, _, flow, box, sign)
+                                        in zip(positions, entries)]
+
+    def forcing_series(self, Q, V, boundary_C):
+        # Q: {flow: (n_iter+1,) m3/day}, V: (n_iter+1, n_boxes),
+        # boundary_C: {boundary: (n_iter+1, 11)}
+        # returns the ForcingMatrix series "exchange", "inflow" and "boundary"
+        V = np.asarray(V, dtype=float)
+        series = {}
+        for name in ('exchange', 'inflow'):
+            data = np.zeros((len(V), getattr(self, name).nnz))
+            for position, flow, box, sign in self.contributions[name]:
+                data[:, position] += sign * (Q[flow] / V[:, box])
+            series[name] = data
+        series['boundary'] = np.zeros((len(V), len(self.boundaries), 11))
+        for i, boundary in enumerate(self.boundaries):
+            series['boundary'][:, i] = boundary_C[boundary]
+        return series
+
+# ============================== Box network / ============================== #
+# =========================================================================== #
@@ -0,0 +1,422 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy streaming output: state chunks and chunked csv/parquet/hdf5/netcdf writers """
+
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# =========================================================================== #
+# ============================= State chunks \ ============================== #
+# Rows of the state array as a simulation fills them. Without an output all
+# n_iter+1 rows are kept and returned; with an output only chunk_rows rows
+# are held, row t lives at t % chunk_rows, and every completed chunk is passed
+# to output(first_row, C_chunk) before it is overwritten, so memory stays
+# flat for runs of any length. A checkpoint writer, if given, is handed
+# every filled row.
+
+class StateChunks:
+
+    def __init__(self, n_iter, shape, output=None, chunk_rows=10000, checkpoint=None):
+        self.n_iter = n_iter
+        self.output = output
+        self.checkpoint = checkpoint
+        self.n_rows = n_iter + 1 if output is None else min(int(chunk_rows), n_iter + 1)
+        self.C = np.zeros((self.n_rows,) + tuple(shape))
+        self.next_row = 0
+
+    def row(self, t):
+        return t % self.n_rows
+
+    def stored(self, t):
+        # row t is filled
+        self.next_row = t + 1
+        if self.checkpoint is not None:
+            self.checkpoint(t, self.C[t % self.n_rows])
+        if self.output is not None and (t % self.n_rows == self.n_rows - 1 or t == self.n_iter):
+            i = t % self.n_rows
+            self.output(t - i, self.C[:i + 1])
+
+    def result(self):
+        return self.C if self.output is None else None
+
+
+def write_chunks(C, output, chunk_rows=10000):
+    # a complete state array passed on to output in chunks
+    for first_row in range(0, len(C), int(chunk_rows)):
+        output(first_row, C[first_row:first_row + int(chunk_rows)])
+
+# ============================= State chunks / ============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================== Checkpoints \ ============================== #
+# A checkpoint is the full state of one row of the dt grid in an npz file:
+# C ((n_boxes, 11), or (N, n_boxes, 11) for an ensemble), its row and dt.
+# CheckpointWriter saves the rows at multiples of the interval and the last
+# row of the run; a file name with {row} keeps one file per checkpoint,
+# otherwise the file holds the latest. A run restarted from a checkpoint
+# continues at its row (see culpy_engine.simulate_C), rows are counted from
+# sim_start_date in both runs.
+
+class CheckpointWriter:
+
+    def __init__(self, file_name, dt, interval=None, last_row=None, first_row=0):
+        # interval in days, None or 0 saves the last row only; t of a call
+        # is counted from first_row, the row a restarted run begins at
+        self.file_name = file_name
+        self.dt = float(dt)
+        self.interval = max(int(round(interval / dt)), 1) if interval else None
+        self.last_row = last_row
+        self.first_row = first_row
+
+    def __call__(self, t, C_t):
+        row = self.first_row + t
+        if t > 0 and (row == self.last_row or (self.interval and row % self.interval == 0)):
+            save_checkpoint(self.file_name.format(row=row), C_t, row, self.dt)
+
+
+def save_checkpoint(file_name, C, row, dt):
+    # written to a temporary file first, a run stopped while writing keeps
+    # the previous checkpoint
+    directory, name = os.path.split(os.path.abspath(file_name))
+    tmp = os.path.join(directory, f'.{name}.{os.getpid()}.npz')
+    np.savez(tmp, C=C, row=row, dt=dt)
+    os.replace(tmp, file_name)
+
+
+def load_checkpoint(file_name):
+    # (C, row, dt) of a checkpoint file
+    with np.load(file_name) as data:
+        return data['C'], int(data['row']), float(data['dt'])
+
+# ============================== Checkpoints / ============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================ Output writers \ ============================= #
+# One writer per output file, the format follows the file extension. Chunks
+# of rows (k, n_columns) are appended with their dates: write() takes them
+# from a date_range on the dt grid, append() is given them (reduced series).
+# parquet needs pyarrow, hdf5 needs PyTables (tables) and netcdf needs
+# netCDF4; csv has no extra requirement.
+# With boxes given, rows are (k, n_boxes, n_columns) and all boxes go to the
+# one file: csv/parquet/hdf5 tables get a "box" column after Date (rows
+# ordered by date, then box), netcdf variables get a (time, box) shape.
+output_formats = {'.csv': 'csv', '.parquet': 'parquet', '.h5': 'hdf5', '.hdf5': 'hdf5', '.nc': 'netcdf'}
+
+def output_dates(sim_start_date, dt, first_row, n_rows):
+    step = pd.Timedelta(hours=dt*24)
+    return pd.date_range(start=pd.Timestamp(sim_start_date) + first_row * step, periods=n_rows, freq=step)
+
+
+class OutputWriter:
+
+    def __init__(self, file_name, sim_start_date, dt, columns, date_format=None, boxes=None):
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension not in output_formats:
+            raise ValueError(f"unknown output format of {file_name}, use one of: {', '.join(output_formats)}")
+        self.file_name = file_name
+        self.format = output_formats[extension]
+        self.sim_start_date = sim_start_date
+        self.dt = dt
+        self.columns = list(columns)
+        self.boxes = None if boxes is None else [str(box) for box in boxes]
+        # csv dates as the whole-run DataFrame.to_csv wrote them
+        if date_format is None:
+            date_format = '%Y-%m-%d' if float(dt) % 1 == 0 else '%Y-%m-%d %H:%M:%S'
+        self.date_format = date_format
+        self.handle = None
+        self.n_written = 0
+
+        if self.format == 'hdf5':
+            import tables  # noqa: F401, pandas HDFStore requires PyTables
+            self.handle = pd.HDFStore(file_name, mode='w', complevel=5, complib='zlib')
+        elif self.format == 'netcdf':
+            import netCDF4
+            self.handle = netCDF4.Dataset(file_name, 'w')
+            self.handle.createDimension('time', None)
+            time = self.handle.createVariable('time', 'f8', ('time',))
+            time.units = f'days since {pd.Timestamp(sim_start_date)}'
+            dimensions = ('time',)
+            if self.boxes is not None:
+                self.handle.createDimension('box', len(self.boxes))
+                box = self.handle.createVariable('box', str, ('box',))
+                for i, name in enumerate(self.boxes):
+                    box[i] = name
+                dimensions = ('time', 'box')
+            for column in self.columns:
+                self.handle.createVariable(column, 'f8', dimensions, zlib=True)
+
+    def write(self, first_row, values):
+        self.append(output_dates(self.sim_start_date, self.dt, first_row, len(values)), values)
+
+    def append(self, dates, values):
+        n_boxes = 1 if self.boxes is None else len(self.boxes)
+        values = np.asarray(values, dtype=float).reshape(len(dates), n_boxes, len(self.columns))
+
+        if self.format == 'netcdf':
+            rows = slice(self.n_written, self.n_written + len(values))
+            self.handle['time'][rows] = (pd.DatetimeIndex(dates) - pd.Timestamp(self.sim_start_date)) / pd.Timedelta(days=1)
+            for j, column in enumerate(self.columns):
+                self.handle[column][rows] = values[..., j] if self.boxes is not None else values[:, 0, j]
+        else:
+            df = pd.DataFrame(values.reshape(-1, len(self.columns)), columns=self.columns)
+            if self.boxes is not None:
+                df.insert(0, 'box', np.tile(self.boxes, len(values)))
+            df.insert(0, 'Date', np.repeat(pd.DatetimeIndex(dates), n_boxes))
+            if self.format == 'csv':
+                df.to_csv(self.file_name, mode='w' if self.n_written == 0 else 'a',
+                          header=self.n_written == 0, index=False, date_format=self.date_format)
+            elif self.format == 'parquet':
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if self.handle is None:
+                    self.handle = pq.ParquetWriter(self.file_name, table.schema, compression='zstd')
+                self.handle.write_table(table)
+            else:
+                self.handle.append('C', df, index=False)
+        self.n_written += len(values)
+
+    def close(self):
+        if self.format == 'csv' and self.n_written == 0:
+            pd.DataFrame(columns=['Date'] + (['box'] if self.boxes is not None else []) +
+                         self.columns).to_csv(self.file_name, index=False)
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+# ============================ Output writers / ============================= #
+# =========================================================================== #
+
+# =========================================================================== #
+# ========================== Output reductions \ ============================ #
+# Reductions of the state computed chunk by chunk while the run advances, so
+# that only the reduced series reach the disk. They take the same
+# (first_row, C_chunk) calls as a writer and pass their finished rows on to
+# output(dates, values), e.g. OutputWriter.append.
+#   PeriodMean : daily or monthly means, as DataFrame.resample('D'/'MS')
+#                .mean() gives them (NaN rows are skipped); with times given
+#                only the periods of these times are passed on, one row per
+#                time
+#   TimeSampler: the state at the given times, linear between dt grid rows
+period_freqs = {'daily': 'D', 'monthly': 'M'}
+
+def read_observation_times(file_name):
+    # times of an observation csv with a Date column
+    return pd.DatetimeIndex(pd.to_datetime(pd.read_csv(file_name)['Date'], format='mixed'))
+
+
+class PeriodMean:
+
+    def __init__(self, sim_start_date, dt, period, output, times=None):
+        if period not in period_freqs:
+            raise ValueError(f"unknown period: {period}, use one of: {', '.join(period_freqs)}")
+        self.sim_start_date = sim_start_date
+        self.dt = dt
+        self.freq = period_freqs[period]
+        self.output = output
+        self.times = None
+        if times is not None:
+            times = pd.DatetimeIndex(times)
+            self.times = pd.Series(times, index=times.to_period(self.freq).to_timestamp())
+        self.label = None
+        self.sum = None
+        self.count = None
+
+    def emit(self, labels, sums, counts):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        labels = pd.DatetimeIndex(labels)
+        if self.times is None:
+            self.output(labels, means)
+            return
+        selected = self.times[self.times.index.isin(labels)]
+        if len(selected):
+            self.output(pd.DatetimeIndex(selected.values), means[labels.get_indexer(selected.index)])
+
+    def __call__(self, first_row, C_chunk):
+        dates = output_dates(self.sim_start_date, self.dt, first_row, len(C_chunk))
+        labels = dates.to_period(self.freq).to_timestamp()
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        valid = ~np.isnan(C_chunk)
+        sums = np.add.reduceat(np.where(valid, C_chunk, 0.0), starts, axis=0)
+        counts = np.add.reduceat(valid.astype(float), starts, axis=0)
+        labels = labels[starts]
+
+        if self.label is not None:
+            if labels[0] == self.label:
+                sums[0] += self.sum
+                counts[0] += self.count
+            else:
+                self.emit([self.label], self.sum[None], self.count[None])
+        # the last period may continue in the next chunk
+        if len(labels) > 1:
+            self.emit(labels[:-1], sums[:-1], counts[:-1])
+        self.label, self.sum, self.count = labels[-1], sums[-1], counts[-1]
+
+    def close(self):
+        if self.label is not None:
+            self.emit([self.label], self.sum[None], self.count[None])
+            self.label = None
+
+
+class TimeSampler:
+
+    def __init__(self, sim_start_date, dt, times, output):
+        self.times = pd.DatetimeIndex(times).sort_values()
+        step = pd.Timedelta(hours=dt*24)
+        # positions of the times on the dt grid (row numbers)
+        self.positions = np.asarray((self.times - pd.Timestamp(sim_start_date)) / step, dtype=float)
+        self.output = output
+        self.next = int(np.searchsorted(self.positions, 0.0))
+        self.previous = None  # last row of the previous chunk
+
+    def __call__(self, first_row, C_chunk):
+        last_row = first_row + len(C_chunk) - 1
+        stop = int(np.searchsorted(self.positions, last_row, side='right'))
+        if stop > self.next:
+            positions = self.positions[self.next:stop]
+            rows = np.concatenate([self.previous[None], C_chunk]) if self.previous is not None else C_chunk
+            offset = first_row - (1 if self.previous is not None else 0)
+            lower = np.floor(positions).astype(int) - offset
+            upper = np.minimum(lower + 1, len(rows) - 1)
+            w = (positions - np.floor(positions)).reshape((-1,) + (1,) * (C_chunk.ndim - 1))
+            values = np.where(w == 0, rows[lower], rows[lower] + w * (rows[upper] - rows[lower]))
+            self.output(self.times[self.next:stop], values)
+            self.next = stop
+        self.previous = np.array(C_chunk[-1])
+
+    def close(self):
+        pass
+
+# ========================== Output reductions / ============================ #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================== Output stage \ ============================= #
+# The files of one output (one box of one run), given by the run settings:
+#   series   : "dt" writes every dt step to <name><format>, "daily" or
+#              "monthly" writes period means to <name>_<series><format>,
+#              "" writes no series
+#   times    : optional observation times, the state is written at these
+#              times to <name>_obs<format>
+#   sampling : "instant" samples the state at the times, "daily" or
+#              "monthly" the mean of the period around each time
+#   boxes    : box names when the chunks hold all boxes (k, n_boxes, 11)
+
+class OutputStage:
+
+    def __init__(self, name, sim_start_date, dt, columns, output_format=".csv", series="dt",
+                 times=None, sampling="instant", boxes=None):
+        self.writers = []
+        self.outputs = []
+
+        if series == "dt":
+            writer = OutputWriter(f"{name}{output_format}", sim_start_date, dt, columns, boxes=boxes)
+            self.writers.append(writer)
+            self.outputs.append(writer.write)
+        elif series:
+            writer = OutputWriter(f"{name}_{series}{output_format}", sim_start_date, dt, columns,
+                                  date_format='%Y-%m-%d', boxes=boxes)
+            self.writers.append(writer)
+            self.outputs.append(PeriodMean(sim_start_date, dt, series, writer.append))
+
+        if times is not None:
+            writer = OutputWriter(f"{name}_obs{output_format}", sim_start_date, dt, columns,
+                                  date_format='%Y-%m-%d %H:%M:%S', boxes=boxes)
+            self.writers.append(writer)
+            if sampling == "instant":
+                self.outputs.append(TimeSampler(sim_start_date, dt, times, writer.append))
+            else:
+                self.outputs.append(PeriodMean(sim_start_date, dt, sampling, writer.append, times))
+
+    def __call__(self, first_row, C_chunk):
+        for output in self.outputs:
+            output(first_row, C_chunk)
+
+    def close(self):
+        for output in self.outputs:
+            if hasattr(output, 'close'):
+                output.close()
+        for writer in self.writers:
+            writer.close()
+
+# ============================== Output stage / ============================= #
+# =========================================================================== #
+
+# =========================================================================== #
+# ========================== Simulation results \ =========================== #
+# The state of one run indexed by time, box and variable, with the dates of
+# the dt grid and the box names of the network. save() writes all boxes to
+# one file, read_output() reads such a file back, for all boxes or one.
+
+class SimulationResult:
+
+    def __init__(self, C, boxes, sim_start_date, dt, columns, first_row=0):
+        self.C = C  # (n_iter+1, n_boxes, n_columns), from first_row of a restarted run
+        self.boxes = [str(box) for box in boxes]
+        self.sim_start_date = sim_start_date
+        self.dt = dt
+        self.columns = list(columns)
+        self.first_row = first_row
+        self.dates = output_dates(sim_start_date, dt, first_row, len(C))
+
+    def box(self, box):
+        # one box (name or number) as a Date indexed DataFrame
+        i = self.boxes.index(str(box)) if str(box) in self.boxes else int(box)
+        return pd.DataFrame(self.C[:, i], index=pd.Index(self.dates, name='Date'), columns=self.columns)
+
+    def to_frame(self):
+        df = pd.DataFrame(self.C.reshape(-1, len(self.columns)), columns=self.columns)
+        df.insert(0, 'box', np.tile(self.boxes, len(self.C)))
+        df.insert(0, 'Date', np.repeat(self.dates, len(self.boxes)))
+        return df
+
+    def save(self, file_name, chunk_rows=10000):
+        writer = OutputWriter(file_name, self.sim_start_date, self.dt, self.columns, boxes=self.boxes)
+        try:
+            write_chunks(self.C, lambda row, C_chunk: writer.write(self.first_row + row, C_chunk), chunk_rows)
+        finally:
+            writer.close()
+
+
+def read_output(file_name, box=None):
+    # output file as a DataFrame with Date (and box) columns, or the Date
+    # indexed series of one box
+    extension = os.path.splitext(file_name)[1].lower()
+    if output_formats.get(extension) == 'netcdf':
+        import netCDF4
+        with netCDF4.Dataset(file_name) as nc:
+            times = pd.Timestamp(nc['time'].units.split('since ')[1]) + pd.to_timedelta(nc['time'][:], unit='D')
+            columns = [name for name in nc.variables if name not in ('time', 'box')]
+            if 'box' in nc.variables:
+                boxes = [str(name) for name in nc['box'][:]]
+                df = pd.DataFrame({column: np.asarray(nc[column][:]).reshape(-1) for column in columns})
+                df.insert(0, 'box', np.tile(boxes, len(times)))
+                df.insert(0, 'Date', np.repeat(times.round('us'), len(boxes)))
+            else:
+                df = pd.DataFrame({column: np.asarray(nc[column][:]) for column in columns})
+                df.insert(0, 'Date', times.round('us'))
+    elif output_formats.get(extension) == 'parquet':
+        df = pd.read_parquet(file_name)
+    elif output_formats.get(extension) == 'hdf5':
+        df = pd.read_hdf(file_name, 'C')
+    else:
+        df = pd.read_csv(file_name, parse_dates=['Date'], float_precision='round_trip')
+        if 'box' in df:
+            df['box'] = df['box'].astype(str)
+
+    if box is None:
+        return df
+    return df[df['box'] == str(box)].drop(columns='box').set_index('Date')
+
+# ========================== Simulation results / =========================== #
+# =========================================================================== #
@@ -0,0 +1,237 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy in-process model server for PEST/PEST++ agents """
+
+# The server imports the model script once (inputs are read, interpolated and
+# packed once) and then runs the model for every parameter file PEST++ writes
+# in an agent folder, returning pest.out in that folder. The model command
+# of the agents is a small client that hands its folder to the server: it
+# still starts a python interpreter, but imports no numpy or model modules,
+# reads no csv files and needs no copy of the manager folder with its
+# inputs, so a run costs the integration and a bare interpreter start-up.
+# The r2/re/pbias files and metrics.csv (see culpy_metrics) are written next
+# to pest.out.
+#
+# The runs of the agents are served at the same time: the socket server
+# forks a process per run where the platform has fork (the loaded model is
+# shared copy-on-write) and starts a thread per run otherwise. The threads
+# of one server share the python interpreter, so on Windows start one
+# server per group of agents (--port) to use more cores; several queue
+# servers may watch one queue folder, every request is taken by one of them.
+#
+# usage, from the folder of the model script, its inputs and observation.csv:
+#   python culpy_model_server.py serve CuLPy_0d             (socket, port 4005)
+#   python culpy_model_server.py serve CuLPy_0d --queue runs (file queue)
+#   python culpy_model_server.py serve CuLPy.toml           (model of a config file)
+#   python culpy_model_server.py agents 20                  (agent_1..agent_20)
+# model command line of the pst (run in each agent folder):
+#   python culpy_model_server.py run                        (or --queue ..\runs)
+
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import socket
+import argparse
+import socketserver
+
+
+default_port = 4005
+
+# a process per run where fork is available, a thread per run otherwise
+TCPServer = getattr(socketserver, 'ForkingTCPServer', socketserver.ThreadingTCPServer)
+
+
+# =========================================================================== #
+# ============================== Model server \ ============================= #
+
+class ModelServer:
+
+    def __init__(self, model_name, observation_file='observation.csv', parameter_file=None, box=None):
+        sys.path.insert(0, os.getcwd())
+        from culpy_engine import TemperatureTables
+        from culpy_metrics import read_observations, ObservationIndex
+        from culpy_model import load_model
+
+        self.model = load_model(model_name)
+        m = self.model
+        self.C_init, self.forcing, self.H, self.network = m.model_arrays()
+        self.tables = TemperatureTables(self.forcing['T'], self.forcing['salinity'], m.Altitude)
+        self.parameter_file = parameter_file or os.path.basename(m.kmc_file_name)
+        self.box = self.network.boxes.index(box) if box is not None else 0
+
+        # observations are compared with daily means of their dates, as
+        # generate_pest_out.write_out does; they are aligned once with the
+        # dt grid of the run
+        self.index = ObservationIndex(read_observations(observation_file), m.sim_start_date, m.dt, m.n_iter)
+
+    def run(self, run_dir):
+        from culpy_kmc import kmc_values_reader
+        from culpy_engine import simulate_C
+        from culpy_metrics import write_pest_outputs
+        m = self.model
+
+        kmc = m.kmc.replace(**kmc_values_reader(os.path.join(run_dir, self.parameter_file)))
+        daily = self.index.reduction()
+        simulate_C(self.C_init, m.n_iter, m.dt, self.forcing, self.H, self.network, kmc, m.Altitude,
+                   self.tables, m.backend, m.integrator, m.integrator_step,
+                   output=lambda first_row, C_chunk: daily(first_row, C_chunk[:, self.box]),
+                   chunk_rows=m.output_chunk_rows, restart=m.restart_file_name,
+                   reaction_step=m.reaction_step)
+        write_pest_outputs(self.index, daily.means(), run_dir)
+
+    def handle(self, run_dir):
+        try:
+            self.run(run_dir)
+            return 'ok'
+        except Exception as error:
+            return f'error: {error!r}'
+
+    def socket_server(self, port=default_port):
+        # TCP server of the runs, one process (or thread) per connection
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                run_dir = self.rfile.readline().decode().strip()
+                self.wfile.write((server.handle(run_dir) + '\n').encode())
+        return TCPServer(('127.0.0.1', port), Handler)
+
+    def serve_socket(self, port=default_port):
+        with self.socket_server(port) as tcp_server:
+            print(f'\tmodel server listening on 127.0.0.1:{port}')
+            tcp_server.serve_forever()
+
+    def serve_queue(self, queue_dir, poll=0.05):
+        # <id>.req holds the folder of a run, the reply is written to <id>.done
+        os.makedirs(queue_dir, exist_ok=True)
+        print(f'\tmodel server watching {queue_dir}')
+        while True:
+            if not self.serve_requests(queue_dir):
+                time.sleep(poll)
+
+    def serve_requests(self, queue_dir):
+        # the queued requests, first in first out; a request is renamed to
+        # <id>.run before its run, so another server does not take it too.
+        # returns the number of runs served
+        n_served = 0
+        for name in queued_requests(queue_dir):
+            request = os.path.join(queue_dir, name)
+            running = request[:-4] + '.run'
+            try:
+                os.replace(request, running)
+            except FileNotFoundError:
+                continue  # taken by another server
+            with open(running, 'r') as f:
+                run_dir = f.read().strip()
+            reply = self.handle(run_dir)
+            tmp = request[:-4] + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(reply)
+            os.replace(tmp, request[:-4] + '.done')
+            os.remove(running)
+            n_served += 1
+        return n_served
+
+
+def queued_requests(queue_dir):
+    # .req files of a queue folder, the oldest first
+    requests = []
+    for name in os.listdir(queue_dir):
+        if name.endswith('.req'):
+            try:
+                requests.append((os.stat(os.path.join(queue_dir, name)).st_mtime_ns, name))
+            except FileNotFoundError:
+                continue
+    return [name for mtime, name in sorted(requests)]
+
+# ============================== Model server / ============================= #
+# =========================================================================== #
+
+# =========================================================================== #
+# ================================ Clients \ ================================ #
+
+def request_socket(run_dir, port=default_port):
+    with socket.create_connection(('127.0.0.1', port)) as connection:
+        connection.sendall((run_dir + '\n').encode())
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = connection.recv(4096)
+            if not data:
+                break
+            reply += data
+    return reply.decode().strip()
+
+
+def request_queue(run_dir, queue_dir, poll=0.01):
+    request = os.path.join(queue_dir, f'{uuid.uuid4().hex}')
+    with open(request + '.tmp', 'w') as f:
+        f.write(run_dir)
+    os.replace(request + '.tmp', request + '.req')
+    while not os.path.exists(request + '.done'):
+        time.sleep(poll)
+    with open(request + '.done', 'r') as f:
+        reply = f.read().strip()
+    os.remove(request + '.done')
+    return reply
+
+
+def make_agent_folders(n, manager='.', files=('*.pst', '*.bat', '*.tpl', '*.ins', 'culpy_model_server.py'),
+                       folders=('template', 'instruction')):
+    # agent_1..agent_n with the PEST exchange files only, the inputs stay
+    # with the server
+    import glob
+    for i in range(1, n + 1):
+        agent = f'agent_{i}'
+        os.makedirs(agent, exist_ok=True)
+        for pattern in files:
+            for file_name in glob.glob(os.path.join(manager, pattern)):
+                shutil.copy2(file_name, agent)
+        for folder in folders:
+            if os.path.isdir(os.path.join(manager, folder)):
+                shutil.copytree(os.path.join(manager, folder), os.path.join(agent, folder), dirs_exist_ok=True)
+        print(f'{agent} folder is set up from "{manager}" folder')
+
+# ================================ Clients / ================================ #
+# =========================================================================== #
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CuLPy model server for PEST/PEST++ agents')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='load the model once and serve runs')
+    serve.add_argument('model', help='model script name without extension, e.g. CuLPy_0d, or a config file')
+    serve.add_argument('--observations', default='observation.csv')
+    serve.add_argument('--parameters', default=None, help='parameter file of the runs (default: kmc_file_name)')
+    serve.add_argument('--box', default=None, help='box compared with the observations (default: first box)')
+    serve.add_argument('--port', type=int, default=default_port)
+    serve.add_argument('--queue', default=None, help='serve a file queue folder instead of a socket')
+    run = commands.add_parser('run', help='model command of an agent: run the model in this folder')
+    run.add_argument('--port', type=int, default=default_port)
+    run.add_argument('--queue', default=None)
+    agents = commands.add_parser('agents', help='set up agent folders with the PEST exchange files')
+    agents.add_argument('n', type=int)
+    agents.add_argument('--manager', default='.')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = ModelServer(args.model, args.observations, args.parameters, args.box)
+        if args.queue:
+            server.serve_queue(args.queue)
+        else:
+            server.serve_socket(args.port)
+    elif args.command == 'run':
+        if args.queue:
+            reply = request_queue(os.getcwd(), args.queue)
+        else:
+            reply = request_socket(os.getcwd(), args.port)
+        if reply != 'ok':
+            print(reply)
+            sys.exit(1)
+    else:
+        make_agent_folders(args.n, args.manager)
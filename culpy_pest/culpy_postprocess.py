@@ -0,0 +1,138 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy postprocessing of observation ensembles (PEST++ IES or culpy_ies) """
+
+# An observation ensemble csv has one realisation per row (first column
+# real_name) and one observation per column, named <variable>_<mm>_<dd>_<yy>
+# (e.g. nh4_01_28_15). The names are parsed once into a (variable, month,
+# day, year) MultiIndex, cleaning is done with whole-table masks and the box
+# plot statistics of all observations come from one quantile call. The
+# statistics are cached next to the ensemble file (one cache file per
+# ensemble), a repeated plot of the same file and options reads the cache only.
+
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+observation_levels = ('variable', 'month', 'day', 'year')
+band_names = ('whislo', 'q1', 'med', 'q3', 'whishi', 'count')
+
+
+# =========================================================================== #
+# ========================== Observation ensembles \ ======================== #
+
+def parse_observation_names(names):
+    parts = pd.Index(names).str.split('_', expand=True)
+    return parts.set_names(observation_levels)
+
+
+def read_ensemble(file_name):
+    ensemble = pd.read_csv(file_name, index_col=0, float_precision='round_trip')
+    ensemble.columns = parse_observation_names(ensemble.columns)
+    return ensemble.astype(float)
+
+
+def read_measurements(file_name, date_format='%m/%d/%Y'):
+    # observation.csv as one series over the (variable, month, day, year)
+    # index of the ensembles, missing values left out
+    measurements = pd.read_csv(file_name)
+    dates = pd.to_datetime(measurements.pop('Date'), format=date_format)
+    measurements.columns = measurements.columns.str.lower()
+    measurements.index = pd.MultiIndex.from_arrays([dates.dt.strftime('%m'), dates.dt.strftime('%d'),
+                                                    dates.dt.strftime('%y')], names=observation_levels[1:])
+    series = measurements.stack()
+    series.index = series.index.reorder_levels([3, 0, 1, 2]).set_names(observation_levels)
+    return series.astype(float)
+
+
+def clean_ensemble(ensemble, thresholds=None, delete_rows=False, drop_negative=False,
+                   negatives_to_zero=False):
+    # thresholds: {variable: value or None}, values above it are set to NaN
+    # or, with delete_rows, their realisations are dropped; drop_negative
+    # sets negative values to NaN, negatives_to_zero clips them to zero
+    # returns the cleaned ensemble and the number of dropped realisations
+    values = ensemble.to_numpy(dtype=float, copy=True)
+    if drop_negative:
+        values[values < 0] = np.nan
+    if negatives_to_zero:
+        np.maximum(values, 0, out=values, where=~np.isnan(values))
+    limits = np.full(values.shape[1], np.inf)
+    if thresholds:
+        variables = ensemble.columns.get_level_values('variable')
+        for variable, threshold in thresholds.items():
+            if threshold is not None:
+                limits[variables == variable] = threshold
+    exceeds = values > limits
+    cleaned = pd.DataFrame(values, index=ensemble.index, columns=ensemble.columns)
+    if delete_rows:
+        keep = ~exceeds.any(axis=1)
+        return cleaned[keep], int((~keep).sum())
+    cleaned = cleaned.mask(exceeds)
+    return cleaned, 0
+
+# ========================== Observation ensembles / ======================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ============================= Quantile bands \ ============================ #
+# Box plot statistics of every observation, as matplotlib boxplot computes
+# them without fliers: quartiles and median (linear quantiles) and whiskers
+# at the furthest values within 1.5 IQR of the box; NaN is left out.
+
+def quantile_bands(ensemble, whisker=1.5):
+    q1, med, q3 = ensemble.quantile([0.25, 0.5, 0.75]).to_numpy()
+    iqr = q3 - q1
+    values = ensemble.to_numpy()
+    with np.errstate(invalid='ignore'):
+        inside = (values >= q1 - whisker * iqr) & (values <= q3 + whisker * iqr)
+    whislo = np.where(inside, values, np.inf).min(axis=0)
+    whishi = np.where(inside, values, -np.inf).max(axis=0)
+    count = ensemble.notna().sum().to_numpy()
+    bands = pd.DataFrame({'whislo': whislo, 'q1': q1, 'med': med, 'q3': q3, 'whishi': whishi,
+                          'count': count}, index=ensemble.columns)
+    bands.loc[bands['count'] == 0, ['whislo', 'whishi']] = np.nan
+    return bands
+
+
+def ensemble_bands(file_name, thresholds=None, delete_rows=False, drop_negative=False,
+                   negatives_to_zero=False, cache=True):
+    # quantile bands of a cleaned ensemble file and its dropped realisations;
+    # one cache file per ensemble, <file>.bands.csv, its first line holds a
+    # key of the file state and the options and it is rewritten when the
+    # key changes
+    options = (thresholds, delete_rows, drop_negative, negatives_to_zero)
+    status = os.stat(file_name)
+    key = hashlib.md5(repr((status.st_mtime_ns, status.st_size, options)).encode()).hexdigest()
+    cache_file = f'{os.path.splitext(file_name)[0]}.bands.csv'
+    if cache and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            if f.readline().strip() == f'# {key}':
+                bands = pd.read_csv(f, dtype={level: str for level in observation_levels},
+                                    float_precision='round_trip')
+                dropped = int(bands.pop('dropped').iloc[0]) if len(bands) else 0
+                return bands.set_index(list(observation_levels)), dropped
+
+    ensemble, dropped = clean_ensemble(read_ensemble(file_name), thresholds, delete_rows, drop_negative,
+                                       negatives_to_zero)
+    bands = quantile_bands(ensemble)
+    if cache:
+        with open(cache_file, 'w', newline='') as f:
+            f.write(f'# {key}\n')
+            bands.assign(dropped=dropped).to_csv(f)
+    return bands, dropped
+
+
+def box_stats(bands, observation):
+    # the dict of matplotlib Axes.bxp for one observation
+    row = bands.loc[observation]
+    return {name: row[name] for name in band_names[:-1]}
+
+# ============================= Quantile bands / ============================ #
+# =========================================================================== #
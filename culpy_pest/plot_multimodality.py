@@ -11,26 +11,17 @@ Created on Sun Jun  2 17:18:12 2024
 @author: burak
 """
 
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import griddata
 
 
-# Load the CSV file
-file_path = 'data.csv'  # Change this to your actual file path
-data = pd.read_csv(file_path)
+# Load the objective surface scanned by culpy_scan.py (regular grids)
+file_path = 'scan.npz'  # Change this to your actual file path
+scan = np.load(file_path)
 
-# Extracting the data
-x = data['k_pel_42']
-y = data['k_pel_01']
-z = data['total']
-
-# Creating a grid for contour plot
-x_unique = np.linspace(x.min(), x.max(), 1000)
-y_unique = np.linspace(y.min(), y.max(), 1000)
-x_grid, y_grid = np.meshgrid(x_unique, y_unique)
-z_grid = griddata((x, y), z, (x_grid, y_grid), method='cubic')
+# The first level spans the scanned ranges, finer levels zoom into minima
+x_grid, y_grid = np.meshgrid(scan['x_0'], scan['y_0'])
+z_grid = scan['phi_0']
 
 # Creating a combined 3D and 2D plot
 fig = plt.figure(figsize=(12, 10), dpi=300)
@@ -45,6 +36,11 @@ contour = ax.contourf(x_grid, y_grid, z_grid, zdir='z', offset=-50, levels=100,
 # Adding 2D contour lines on the 3D plot
 ax.contour(x_grid, y_grid, z_grid, zdir='z', offset=-50, levels=30, cmap='viridis')
 
+# Refined levels drawn over the contour lines of their area
+for level in range(1, int(scan['levels'])):
+    x_fine, y_fine = np.meshgrid(scan[f'x_{level}'], scan[f'y_{level}'])
+    ax.contour(x_fine, y_fine, scan[f'phi_{level}'], zdir='z', offset=-50, levels=15, cmap='viridis')
+
 # Prolonging the z-axis to -50
 ax.set_zlim(-50, 100)
 
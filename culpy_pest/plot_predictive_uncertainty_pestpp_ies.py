@@ -3,12 +3,12 @@
 # A copy of the MIT License can be found at 
 # https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
 
-import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
 import matplotlib.lines as mlines
 import os
 import calendar
+from culpy_postprocess import ensemble_bands, read_measurements, box_stats
 
 ############################# INPUTS ##########################################
 
@@ -64,104 +64,27 @@ output_fig_path = r'C:\Ecoological_Informatics_uncertainty'
 
 ###############################################################################
 
-# Read "Measurements" file separately (keep the first column)
-measurements_df = pd.read_csv(file_paths["Measurements"])
-
-# Read other files, discarding the first column
-data_frames = {
-    name: pd.read_csv(path).iloc[:, 1:]
-    for name, path in file_paths.items()
-    if name != "Measurements"
-}
-
-# Add the measurements DataFrame back into the dictionary
-data_frames["Measurements"] = measurements_df
-
-# Drop all values below zero in the DataFrames
-if drop_zero:
-    for file_name, df in data_frames.items():
-        data_frames[file_name] = df.applymap(lambda x: x if x >= 0 else None)
-       
-if convert_negatives_to_zero:
-    for file_name, df in data_frames.items():
-        data_frames[file_name] = df.applymap(lambda x: max(x, 0) if pd.notnull(x) else x)
-
-# Track dropped rows for each file
-rows_dropped = {}
-
-# Drop rows where any value exceeds the threshold for all variables (excepth measurement data)
-for file_name, df in data_frames.items():
-   
+# Box plot statistics of every observation of the ensembles (cleaned with
+# the options above, cached next to the files; see culpy_postprocess)
+bands = {}
+for file_name, path in file_paths.items():
     if file_name == "Measurements":
-        # No threshold filtering for measurements
-        rows_dropped[file_name] = 0
         continue
-   
-    # Keep track of the original number of rows
-    original_row_count = len(df)
-   
-    # Build a boolean mask for rows to drop
-    rows_to_drop = pd.Series([False] * len(df), index=df.index)
-
-    for variable, threshold in variable_thresholds.items():
-        if threshold is not None:  # Apply filtering only if a threshold is set
-            # Identify columns for the specific variable
-            variable_columns = [col for col in df.columns if col.startswith(variable)]
-            # Find rows where any value in these columns exceeds the threshold
-            rows_to_drop |= df[variable_columns].gt(threshold).any(axis=1)
-
-    # Drop the rows where any threshold condition is met
-    data_frames[file_name] = df.drop(rows_to_drop[rows_to_drop].index)
-   
-    # Calculate and store the number of rows dropped
-    rows_dropped[file_name] = original_row_count - len(data_frames[file_name])
-
-# Print summary of dropped rows
-for file_name, count in rows_dropped.items():
-    print(f"File: {file_name}, Rows dropped: {count}")
-
-# Extract unique variable names
-def extract_variable_names(df):
-    return sorted(set(col.split('_')[0] for col in df.columns))
-
-variables = extract_variable_names(next(iter(data_frames.values())))
+    bands[file_name], rows_dropped = ensemble_bands(
+        path,
+        variable_thresholds if threshold_application.get(file_name, False) else None,
+        delete_row_if_exceeds, drop_zero, convert_negatives_to_zero)
+    # Print summary of dropped rows
+    print(f"File: {file_name}, Rows dropped: {rows_dropped}")
+print("File: Measurements, Rows dropped: 0")
+
+variables = sorted(set(variable for file_bands in bands.values()
+                       for variable in file_bands.index.get_level_values('variable')))
 if 'dox' in variables:
     variables.remove('dox')
-   
-   
-# Process measurements data
-# We assume it has a "Date" column and uppercase variable names (NH4, PO4, NO3).
-measurements_df = data_frames["Measurements"]
-measurements_df["Date"] = pd.to_datetime(measurements_df["Date"], format="%m/%d/%Y")
-measurements_df["Month"] = measurements_df["Date"].dt.month.astype(str)
-measurements_df["Day"] = measurements_df["Date"].dt.day.astype(str)
 
-# Build a dictionary: measurement_dict[variable][(month,day)] = measurement_value
-measurement_dict = {}
-for var in ["NH4", "PO4", "NO3"]:
-    var_lower = var.lower()
-    if var in measurements_df.columns:
-        measurement_dict[var_lower] = {
-            (m, d): v for m, d, v in zip(
-                measurements_df["Month"],
-                measurements_df["Day"],
-                measurements_df[var]
-            ) if pd.notna(v)
-        }
-
-# Build measurement_dict with zero-padded month and day for ALL variables
-measurement_dict = {}
-for var in ["NH4", "PO4", "NO3"]:
-    var_lower = var.lower()
-    if var in measurements_df.columns:
-        measurement_dict[var_lower] = {
-            (f"{int(m):02d}", f"{int(d):02d}"): v
-            for m, d, v in zip(
-                measurements_df["Month"],
-                measurements_df["Day"],
-                measurements_df[var]
-            ) if pd.notna(v)
-        }
+# Measurements over the same (variable, month, day, year) index
+measurements = read_measurements(file_paths["Measurements"])
 
 
 # Define colors for the files
@@ -182,63 +105,40 @@ if len(variables) == 1:
 for i, variable in enumerate(variables):
     ax = axes[i]
 
-    variable_df = pd.DataFrame()
-    all_columns = []
-    for file_name in file_order:
-        df = data_frames[file_name]
-        filtered_cols = [col for col in df.columns if col.startswith(variable)]
-        renamed_cols = {col: f"{col}_{file_name}" for col in filtered_cols}
-        temp_df = df[filtered_cols].rename(columns=renamed_cols)
-        all_columns.extend(temp_df.columns)
-        variable_df = pd.concat([variable_df, temp_df], axis=1)
-   
-    variable_df = variable_df[
-        sorted(
-            all_columns,
-            key=lambda x: (
-                x.split('_')[1],  # Month
-                x.split('_')[2],  # Day
-                file_order.index(x.split('_')[-1])  # File order
-            )
-        )
-    ]
-   
-    month_day_list = sorted(set(
-        (col.split('_')[1], col.split('_')[2]) for col in variable_df.columns
-    ), key=lambda x: (x[0], x[1]))
-   
+    # (month, day, year) of the variable in any file, in date order
+    dates = sorted(set(observation[1:] for file_name in file_order
+                       for observation in bands[file_name].index if observation[0] == variable),
+                   key=lambda date: (date[2], date[0], date[1]))
+    
     cluster_width = len(file_order) + 1
     labels = []
-    for idx, (month, day) in enumerate(month_day_list):
+    for idx, (month, day, year) in enumerate(dates):
         # Plot the boxplots
         for file_idx, file_name in enumerate(file_order):
-            col_name = f"{variable}_{month}_{day}_15_{file_name}"
-            if col_name in variable_df.columns:
-                data = variable_df[col_name].dropna().values
-                if len(data) > 0:
-                    pos = idx * cluster_width + file_idx
-                    ax.boxplot(
-                        data,
-                        showfliers=False,
-                        positions=[pos],
-                        widths=0.8,
-                        patch_artist=True,
-                        boxprops=dict(facecolor=colors[file_idx]),
-                        medianprops=dict(color='black'),
-                        flierprops=dict(marker='o', markersize=4, linestyle='none', markeredgecolor='#7e7e7e', markeredgewidth = 0.5)
-                    )
+            observation = (variable, month, day, year)
+            if observation in bands[file_name].index and bands[file_name].loc[observation, 'count'] > 0:
+                pos = idx * cluster_width + file_idx
+                ax.bxp(
+                    [box_stats(bands[file_name], observation)],
+                    showfliers=False,
+                    positions=[pos],
+                    widths=0.8,
+                    patch_artist=True,
+                    boxprops=dict(facecolor=colors[file_idx]),
+                    medianprops=dict(color='black'),
+                    flierprops=dict(marker='o', markersize=4, linestyle='none', markeredgecolor='#7e7e7e', markeredgewidth = 0.5)
+                )
                    
-        # Check if there's a measurement for this variable, month, and day
-        meas_var_dict = measurement_dict.get(variable, {})
-        if (month, day) in meas_var_dict:
-            val = meas_var_dict[(month, day)]
+        # Check if there's a measurement for this variable and date
+        if observation in measurements.index:
+            val = measurements[observation]
             x_pos = idx * cluster_width + (len(file_order) - 2)
             ax.plot(x_pos, val, marker='o', color='red', markersize=4)
        
         month_name = calendar.month_abbr[int(month)]
         labels.append(f"{month_name} {day}")
    
-    ax.set_xticks([idx * cluster_width + (len(file_order) - 1) / 2 for idx in range(len(month_day_list))])
+    ax.set_xticks([idx * cluster_width + (len(file_order) - 1) / 2 for idx in range(len(dates))])
     ax.set_xticklabels(labels, rotation=0)
    
     #ax.set_ylabel(f"$\\mathrm{{{variable[:-1].upper()}}}_{{\\mathrm{{{variable[-1]}}}}}$")
@@ -155,11 +155,13 @@ def plot_all_variables(df_output, df_observation, plot_start_date, plot_end_date
 
 option = 1
 if option == 1:
-    output_file_name = "output_1.csv"
+    output_file_name = "output.csv"
+    output_box = "CL1"
     observation_name = 'observation_2014_15'
 
 
 df_output = pd.read_csv(output_file_name, parse_dates=[0], index_col=0)
+df_output = df_output[df_output['box'].astype(str) == output_box].drop(columns='box')
 df_observation = pd.read_csv(f'{observation_name}.csv', parse_dates=[0], index_col=0)
 
 
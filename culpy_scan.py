@@ -0,0 +1,123 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy objective surface scan over a grid of two kmc parameters """
+
+# The objective (phi, as in culpy_ies) is evaluated on a regular grid of two
+# kmc parameters, all grid points run as one ensemble of the model (see
+# culpy_ensemble). Every refinement level puts a grid of the same size around
+# the minimum of the previous one, its span shrunk by the zoom factor.
+#
+# usage, from the folder of the model script, its inputs and observation.csv:
+#   python culpy_scan.py CuLPy_0d k_nitrification 0.01 0.5 k_growth 1 4 --points 41 --levels 3
+# writes scan.npz with the names x_name, y_name and per level i the grid
+# x_i (nx,), y_i (ny,) and phi_i (ny, nx), as contoured by
+# culpy_pest/plot_multimodality.py; failed runs are NaN in phi, a level where
+# all runs failed is the last one written (with a RuntimeWarning)
+
+
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from culpy_kmc import kmc_names
+from culpy_metrics import read_observations, ObservationIndex
+from culpy_model import load_model
+from culpy_ensemble import run_ensemble, ObservationValues
+from culpy_ies import objective
+
+
+# =========================================================================== #
+# =============================== Grid scan \ =============================== #
+
+def grid_table(x_name, x, y_name, y):
+    # one realisation per grid point, rows of the (ny, nx) grid in order
+    x_grid, y_grid = np.meshgrid(x, y)
+    index = pd.Index([f'{j}_{i}' for j in range(len(y)) for i in range(len(x))], name='realisation')
+    return pd.DataFrame({x_name: x_grid.ravel(), y_name: y_grid.ravel()}, index=index)
+
+
+def refine(x, y, phi, zoom, x_range, y_range):
+    # grid of the same size around the minimum of phi, span times zoom,
+    # shifted to stay within the scanned ranges
+    if np.isnan(phi).all():
+        raise ValueError("no finite phi on the grid, all of its runs failed")
+    j, i = np.unravel_index(np.nanargmin(phi), phi.shape)
+    grids = []
+    for values, centre, (lower, upper) in ((x, x[i], x_range), (y, y[j], y_range)):
+        half_span = (values[-1] - values[0]) * zoom / 2
+        start = min(max(centre - half_span, lower), upper - 2 * half_span)
+        grids.append(np.linspace(start, start + 2 * half_span, len(values)))
+    return grids
+
+
+def run_scan(model, x_name, x_range, y_name, y_range, points=21, levels=1, zoom=0.25, relative_noise=0.1,
+             noise_floor=1e-3, processes=0, box=None, observation_file='observation.csv', file_name='scan.npz'):
+    # model: the imported model script; phi of the daily means of one box
+    # (default: the first) at the observation dates, noise as in culpy_ies
+    unknown = [name for name in (x_name, y_name) if name not in kmc_names]
+    if unknown:
+        raise ValueError(f"unknown kmc parameter(s): {', '.join(unknown)}")
+    index = ObservationIndex(read_observations(observation_file), model.sim_start_date, model.dt, model.n_iter)
+    reduction = ObservationValues(index, model.network.boxes.index(box) if box is not None else 0)
+    observed = index.observed_values()
+    noise_std = np.maximum(relative_noise * np.abs(observed), noise_floor)
+    C_init, forcing, H, network = model.model_arrays()
+
+    scan = {'x_name': x_name, 'y_name': y_name}
+    x = np.linspace(*x_range, points)
+    y = np.linspace(*y_range, points)
+    for level in range(levels):
+        results = run_ensemble(grid_table(x_name, x, y_name, y), C_init, model.n_iter, model.dt, forcing, H,
+                               network, model.kmc, model.Altitude, reduction, model.backend, model.integrator,
+                               model.integrator_step, processes, model.output_chunk_rows,
+                               model.restart_file_name, reaction_step=model.reaction_step)
+        # failed runs (non-finite outputs) are NaN on the grid
+        phi = objective(results.values, observed, noise_std)
+        phi[~np.isfinite(phi)] = np.nan
+        phi = phi.reshape(len(y), len(x))
+        scan.update({f'x_{level}': x, f'y_{level}': y, f'phi_{level}': phi})
+        if np.isnan(phi).all():
+            # no minimum to refine around, the levels scanned so far are kept
+            warnings.warn(f"all runs of level {level} failed, the scan stops at this level", RuntimeWarning)
+            levels = level + 1
+            break
+        j, i = np.unravel_index(np.nanargmin(phi), phi.shape)
+        print(f'\tlevel {level}: minimum phi {phi[j, i]:.6g} at {x_name} = {x[i]:.6g}, {y_name} = {y[j]:.6g}')
+        x, y = refine(x, y, phi, zoom, x_range, y_range)
+
+    np.savez(file_name, levels=levels, **scan)
+    return scan
+
+# =============================== Grid scan / =============================== #
+# =========================================================================== #
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CuLPy objective surface scan of two kmc parameters')
+    parser.add_argument('model', help='model script name without extension, e.g. CuLPy_0d, or a config file')
+    parser.add_argument('x_name', help='kmc parameter of the x axis')
+    parser.add_argument('x_min', type=float)
+    parser.add_argument('x_max', type=float)
+    parser.add_argument('y_name', help='kmc parameter of the y axis')
+    parser.add_argument('y_min', type=float)
+    parser.add_argument('y_max', type=float)
+    parser.add_argument('--points', type=int, default=21, help='grid points per axis')
+    parser.add_argument('--levels', type=int, default=1, help='number of grids, each one around the last minimum')
+    parser.add_argument('--zoom', type=float, default=0.25, help='span of a refined grid relative to the last')
+    parser.add_argument('--noise', type=float, default=0.1, help='observation noise relative to the values')
+    parser.add_argument('--noise-floor', type=float, default=1e-3, help='smallest observation noise')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='process pool size, 0 (default) steps the runs stacked')
+    parser.add_argument('--box', default=None, help='box compared with the observations (default: first box)')
+    parser.add_argument('--observations', default='observation.csv')
+    parser.add_argument('--output', default='scan.npz')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    run_scan(model, args.x_name, (args.x_min, args.x_max), args.y_name, (args.y_min, args.y_max), args.points,
+             args.levels, args.zoom, args.noise, args.noise_floor, args.processes, args.box, args.observations,
+             args.output)
@@ -0,0 +1,369 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy higher-order and adaptive integrators resampled onto the dt grid """
+
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from scipy.linalg import expm
+from culpy_engine import pelagic_process_rates, box_product, n_vars, ThetaFactors
+from culpy_output import StateChunks
+
+
+integrators = ("euler", "rk4", "rk45", "imex", "lie", "strang")
+
+# largest network whose transport is split off as an exact step, larger
+# networks take an implicit one
+exact_transport_boxes = 200
+
+
+# =========================================================================== #
+# ============================ Rate function \ ============================== #
+# dC/dt of the network at a time s given in dt grid units (row s of the
+# forcing). Between grid rows the forcing, theta factors and O2 saturation
+# are interpolated linearly; on a grid row they are read as they are, the
+# same as the euler loop of culpy_engine.simulate_C.
+
+class RateFunction:
+
+    def __init__(self, forcing, H, network, kmc, tables, n_iter, rates=pelagic_process_rates):
+        self.F = forcing.values
+        self.theta_T = ThetaFactors(tables, kmc)
+        self.O2_sat = tables.O2_sat
+        self.H = H
+        self.kmc = kmc
+        self.n_iter = n_iter
+        self.I_a = forcing.index['I_a']
+        self.salinity = forcing.index['salinity']
+        self.f_day = forcing.index['f_day']
+        self.exchange = network.exchange.copy()
+        self.inflow = network.inflow.copy()
+        self.exchange_data = forcing.index['exchange']
+        self.inflow_data = forcing.index['inflow']
+        self.boundary = forcing.index['boundary']
+        self.n_boundaries = len(network.boundaries)
+        self.rates = rates
+        self.n_evaluations = 0
+
+    def rows(self, s):
+        k = int(s)
+        if k == s:
+            return self.F[k], self.theta_T[k], self.O2_sat[k]
+        k = min(k, self.n_iter - 1)
+        w = s - k
+        return (self.F[k] + w * (self.F[k+1] - self.F[k]),
+                self.theta_T[k] + w * (self.theta_T[k+1] - self.theta_T[k]),
+                self.O2_sat[k] + w * (self.O2_sat[k+1] - self.O2_sat[k]))
+
+    def reaction(self, s, C_s):
+        self.n_evaluations += 1
+        F_s, theta_s, O2_s = self.rows(s)
+        return self.rates(C_s, theta_s, O2_s, self.H,
+                          F_s[self.I_a], F_s[self.salinity], F_s[self.f_day], self.kmc)
+
+    def transport(self, s):
+        # flow matrices and boundary inflow rates (n_boxes, 11) at s
+        F_s = self.rows(s)[0]
+        self.exchange.data[:] = F_s[self.exchange_data]
+        self.inflow.data[:] = F_s[self.inflow_data]
+        return self.exchange, self.inflow @ F_s[self.boundary].reshape(self.n_boundaries, n_vars)
+
+    def __call__(self, s, C_s):
+        R_s = self.reaction(s, C_s)
+        exchange, inflow_rate = self.transport(s)
+        return (box_product(exchange, C_s) + inflow_rate) + R_s
+
+# ============================ Rate function / ============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ================================ Steppers \ =============================== #
+# Each stepper advances C from s by h grid units (h*dt days) and returns the
+# new state with its rate, or None when only linear resampling is possible.
+
+def rk4_step(f, s, C_s, f_s, h, dt):
+    h_days = h * dt
+    k1 = f_s
+    k2 = f(s + h/2, C_s + (h_days/2) * k1)
+    k3 = f(s + h/2, C_s + (h_days/2) * k2)
+    k4 = f(s + h, C_s + h_days * k3)
+    C_h = C_s + (h_days/6) * (k1 + 2*k2 + 2*k3 + k4)
+    return C_h, f(s + h, C_h)
+
+
+# Dormand-Prince 5(4) tableau, the 7th stage is the rate at the new state
+dp_c = (0, 1/5, 3/10, 4/5, 8/9, 1, 1)
+dp_a = ((),
+        (1/5,),
+        (3/40, 9/40),
+        (44/45, -56/15, 32/9),
+        (19372/6561, -25360/2187, 64448/6561, -212/729),
+        (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+        (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84))
+dp_e = (71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40)
+
+def rk45_step(f, s, C_s, f_s, h, dt):
+    # returns the 5th order state, its rate and the error estimate
+    h_days = h * dt
+    k = [f_s]
+    for i in range(1, 7):
+        C_i = C_s + h_days * sum(a * k_j for a, k_j in zip(dp_a[i], k) if a != 0)
+        k.append(f(s + dp_c[i] * h, C_i))
+    error = h_days * sum(e * k_j for e, k_j in zip(dp_e, k) if e != 0)
+    return C_i, k[6], error
+
+
+def imex_step(f, s, C_s, h, dt):
+    # reactions explicit at s, transport implicit (backward Euler) at s+h:
+    # (I - h*exchange) C_h = C_s + h*(R(C_s) + inflow @ C_boundary)
+    h_days = h * dt
+    R_s = f.reaction(s, C_s)
+    exchange, inflow_rate = f.transport(s + h)
+    lhs = (sp.identity(exchange.shape[0], format='csc') - h_days * exchange).tocsc()
+    rhs = C_s + h_days * (R_s + inflow_rate)
+    rhs_boxes = np.moveaxis(rhs, -2, 0)
+    C_boxes = spla.splu(lhs).solve(np.ascontiguousarray(rhs_boxes.reshape(rhs_boxes.shape[0], -1)))
+    return np.moveaxis(C_boxes.reshape(rhs_boxes.shape), 0, -2), None
+
+# ================================ Steppers / =============================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# =========================== Operator splitting \ ========================== #
+# Reactions and transport are advanced one after the other over an outer step
+# of whole grid rows, the longer of the transport step (step) and the
+# reaction step (reaction_step); the faster of the two sub-cycles within it.
+# Transport is linear, dC/dt = exchange @ C + inflow @ C_boundary; with the
+# flows held at one time it is solved exactly over tau days,
+#     C = E @ C + Phi @ inflow_rate,  E = expm(tau A), Phi = int_0^tau expm(u A) du
+# (both from one expm of the block matrix [[tau A, tau I], [0, 0]]), so the
+# outer step is not limited by the flushing time and a box loses exactly what
+# its neighbours and outflows gain. TransportPath composes these over the
+# grid rows (lie) or half rows (strang) of an outer step, with one expm per
+# transport sub-step; a transport step below one row is taken as that many
+# sub-steps per row, each with its flows. Networks above
+# exact_transport_boxes boxes take implicit (backward Euler) steps of a row,
+# half row or sub-step instead.
+# Reactions sub-cycle in explicit Euler steps of reaction_step days or, with
+# reaction_step 0, in steps adapted to a local error of reaction_rtol
+# relative to the concentrations (not shorter than dt). A reaction_step longer
+# than step is the reverse: reactions take one Euler step over the outer
+# step and transport sub-cycles in steps of step days, each with its flows.
+#   lie   : reactions over h, then transport over h, the flows at the start
+#           of each transport sub-step
+#   strang: transport h/2, reactions h, transport h/2, the flows at the
+#           middle of each transport sub-step
+# A grid row within an outer step is the splitting over the part of the step
+# up to the row, with the reaction state of the sub-cycle at the row (linear
+# between sub-steps); for strang the first transport half is taken as
+# reached in proportion, so a row without reactions is the exact transport.
+
+reaction_rtol = 3e-3
+
+
+class TransportPath:
+    # transport over the first k rows of an outer step in steps of tau days,
+    # per_row steps per row, step i with the flows at flow_times[i]: path(k, C)
+
+    def __init__(self, f, flow_times, tau, per_row=1):
+        self.tau = tau
+        self.per_row = per_row
+        self.n_boxes = f.exchange.shape[0]
+        self.exact = self.n_boxes <= exact_transport_boxes
+        steps = []
+        for i, s in enumerate(flow_times):
+            steps.append(steps[-1] if i and s == flow_times[i-1] else self.transport(f, s))
+        if self.exact:
+            # C -> E[k] @ C + b[k], composed once per outer step
+            self.E, self.b = [np.eye(self.n_boxes)], [np.zeros((self.n_boxes, n_vars))]
+            for E, Phi, inflow_rate in steps:
+                self.E.append(E @ self.E[-1])
+                self.b.append(E @ self.b[-1] + Phi @ inflow_rate)
+        else:
+            self.steps = steps
+
+    def transport(self, f, s):
+        exchange, inflow_rate = f.transport(s)
+        n_boxes = self.n_boxes
+        if not self.exact:
+            lhs = (sp.identity(n_boxes, format='csc') - self.tau * exchange).tocsc()
+            return spla.splu(lhs), self.tau * inflow_rate
+        block = np.zeros((2 * n_boxes, 2 * n_boxes))
+        block[:n_boxes, :n_boxes] = self.tau * exchange.toarray()
+        block[:n_boxes, n_boxes:] = self.tau * np.eye(n_boxes)
+        M = expm(block)
+        return M[:n_boxes, :n_boxes], M[:n_boxes, n_boxes:], inflow_rate
+
+    def __call__(self, k, C):
+        k = k * self.per_row
+        if self.exact:
+            return box_product(self.E[k], C) + self.b[k]
+        for lu, inflow in self.steps[:k]:
+            rhs_boxes = np.moveaxis(C + inflow, -2, 0)
+            C_boxes = lu.solve(np.ascontiguousarray(rhs_boxes.reshape(self.n_boxes, -1)))
+            C = np.moveaxis(C_boxes.reshape(rhs_boxes.shape), 0, -2)
+        return C
+
+
+def reaction_steps(f, s, C_s, h, dt, h_reaction, atol):
+    # explicit Euler from s to s+h in steps of h_reaction grid units, or
+    # adaptive with h_reaction 0; times and states of the sub-steps
+    times, states = [s], [C_s]
+    s_end = s + h
+    if h_reaction:
+        n_steps = max(1, int(round(h / h_reaction)))
+        for i in range(1, n_steps + 1):
+            C_s = C_s + f.reaction(times[-1], C_s) * (h / n_steps * dt)
+            times.append(s + i * h / n_steps)
+            states.append(C_s)
+        return times, states
+    # the error of a step is estimated from the rate at its end, which is
+    # the rate of the next step
+    k = 1.0
+    R_s = f.reaction(s, C_s)
+    while s < s_end - 1e-9:
+        k = min(k, s_end - s)
+        C_k = C_s + R_s * (k * dt)
+        R_k = f.reaction(s + k, C_k)
+        error = np.max(np.abs(R_k - R_s) * (k * dt / 2) / (reaction_rtol * np.abs(C_k) + atol))
+        factor = min(4.0, max(0.2, 0.9 / np.sqrt(error))) if error > 0 else 4.0
+        if error > 1 and k > 1.0:
+            k = max(k * factor, 1.0)
+            continue
+        s, C_s, R_s = s + k, C_k, R_k
+        times.append(s)
+        states.append(C_s)
+        k = max(k * factor, 1.0)
+    return times, states
+
+
+def sub_step_rows(times, states, s, h):
+    # sub-cycle states at the grid rows s+1 .. s+h
+    i = 0
+    for g in range(s + 1, s + h + 1):
+        while times[i + 1] < g - 1e-9:
+            i += 1
+        x = min((g - times[i]) / (times[i + 1] - times[i]), 1.0)
+        yield states[i] + x * (states[i + 1] - states[i])
+
+
+def split_step(f, s, C_s, h, dt, scheme, h_transport, h_reaction, atol):
+    # states of the grid rows s+1 .. s+h of one outer step of h rows, with
+    # transport sub-steps of h_transport grid units; below one row, m
+    # sub-steps of 1/m row each
+    m = max(1, int(round(1 / h_transport))) if h_transport < 1 else 1
+    n_transport = h * m if m > 1 else max(1, int(round(h / h_transport)))
+    length = h / n_transport
+    if scheme == "lie":
+        path = TransportPath(f, [s + np.floor(i / m / length + 1e-9) * length for i in range(h * m)], dt / m, m)
+        times, states = reaction_steps(f, s, C_s, h, dt, h_reaction, atol)
+        return [path(j, C_j) for j, C_j in enumerate(sub_step_rows(times, states, s, h), 1)]
+
+    def flow_times(start):
+        return [s + (np.floor((start + i / (2 * m)) / length + 1e-9) + 0.5) * length for i in range(h * m)]
+    first = TransportPath(f, flow_times(0), dt / (2 * m), m)
+    second = first if n_transport == 1 else TransportPath(f, flow_times(h / 2), dt / (2 * m), m)
+    C_half = first(h, C_s)
+    times, states = reaction_steps(f, s, C_half, h, dt, h_reaction, atol)
+    return [second(j, C_j + first(j, C_s) - C_half)
+            for j, C_j in enumerate(sub_step_rows(times, states, s, h), 1)]
+
+
+def split_integrate(f, chunks, n_iter, dt, scheme, h_transport, h_reaction, atol):
+    # h_transport, h_reaction in grid units, h_reaction 0: adaptive
+    reverse = h_reaction > h_transport
+    h_outer = max(1, int(round(h_reaction if reverse else h_transport)))
+    s, C_s = 0, np.array(chunks.C[0], dtype=float)
+    while s < n_iter:
+        h = min(h_outer, n_iter - s)
+        if reverse:
+            rows = split_step(f, s, C_s, h, dt, scheme, h_transport, h, atol)
+        else:
+            rows = split_step(f, s, C_s, h, dt, scheme, min(h_transport, h), h_reaction, atol)
+        for g, C_g in enumerate(rows, s + 1):
+            chunks.C[chunks.row(g)] = C_g
+            chunks.stored(g)
+        s, C_s = s + h, rows[-1]
+
+# =========================== Operator splitting / ========================== #
+# =========================================================================== #
+
+# =========================================================================== #
+# ======================= Integration on the dt grid \ ====================== #
+
+def resample(chunks, s0, C0, f0, s1, C1, f1, dt):
+    # fills the grid rows up to s1 by cubic Hermite interpolation of the
+    # step, or linearly when the rates are not known
+    h = s1 - s0
+    C = chunks.C
+    for g in range(chunks.next_row, min(int(np.floor(s1 + 1e-9)), chunks.n_iter) + 1):
+        x = (g - s0) / h
+        if x >= 1:
+            C[chunks.row(g)] = C1
+        elif f0 is None or f1 is None:
+            C[chunks.row(g)] = (1 - x) * C0 + x * C1
+        else:
+            C[chunks.row(g)] = ((2*x**3 - 3*x**2 + 1) * C0 + (x**3 - 2*x**2 + x) * (h * dt) * f0 +
+                                (-2*x**3 + 3*x**2) * C1 + (x**3 - x**2) * (h * dt) * f1)
+        chunks.stored(g)
+
+
+def integrate(C_init, n_iter, dt, forcing, H, network, kmc, tables, integrator,
+              step=None, rtol=1e-6, atol=1e-8, output=None, chunk_rows=10000, checkpoint=None,
+              rates=pelagic_process_rates, reaction_step=None):
+    # step: fixed step of rk4/imex, transport step of lie/strang and largest
+    # step of rk45 in days, defaults to dt; rk45 starts from min(step, dt)
+    # reaction_step: lie/strang reaction sub-step in days, 0 or None adapts
+    # it to the reaction rates (see Operator splitting)
+    if integrator not in integrators[1:]:
+        raise ValueError(f"unknown integrator: {integrator}")
+
+    f = RateFunction(forcing, H, network, kmc, tables, n_iter, rates)
+    h_max = (step if step else dt) / dt  # in grid units
+    h = min(h_max, 1.0)
+
+    chunks = StateChunks(n_iter, np.shape(C_init), output, chunk_rows, checkpoint)
+    chunks.C[0] = C_init
+    chunks.stored(0)
+    if integrator in ("lie", "strang"):
+        split_integrate(f, chunks, n_iter, dt, integrator, h_max, (reaction_step or 0) / dt, atol)
+        return chunks.result()
+    s, C_s = 0.0, np.array(C_init, dtype=float)
+    f_s = f(s, C_s) if integrator in ("rk4", "rk45") else None
+
+    while s < n_iter - 1e-9:
+        if integrator == "rk45":
+            h = min(h, n_iter - s)
+            C_h, f_h, error = rk45_step(f, s, C_s, f_s, h, dt)
+            scale = atol + rtol * np.maximum(np.abs(C_s), np.abs(C_h))
+            error_norm = np.sqrt(np.mean((error / scale) ** 2))
+            if not np.isfinite(error_norm):
+                raise RuntimeError(f"rk45: non-finite error estimate at step {s:.3f} of the dt grid")
+            factor = min(5.0, max(0.2, 0.9 * error_norm ** -0.2)) if error_norm > 0 else 5.0
+            if error_norm > 1:
+                h = h * factor
+                if h < 1e-8:
+                    raise RuntimeError(f"rk45: step size underflow at step {s:.3f} of the dt grid")
+                continue
+            h_next = min(h * factor, h_max)
+        else:
+            h = min(h_max, n_iter - s)
+            if integrator == "rk4":
+                C_h, f_h = rk4_step(f, s, C_s, f_s, h, dt)
+            else:
+                C_h, f_h = imex_step(f, s, C_s, h, dt)
+            h_next = h_max
+
+        resample(chunks, s, C_s, f_s, s + h, C_h, f_h, dt)
+        s, C_s, f_s = s + h, C_h, f_h
+        h = h_next
+
+    return chunks.result()
+
+# ======================= Integration on the dt grid / ====================== #
+# =========================================================================== #
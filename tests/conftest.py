@@ -0,0 +1,189 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" CuLPy test set up: a small synthetic 2-box case, in arrays and as model input files """
+
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from culpy_engine import state_array, ForcingMatrix
+from culpy_kmc import CompiledKMC
+from culpy_network import BoxNetwork
+
+
+kmc_values = {
+    'K_be': 0.8, 'I_s': 250, 'K_SN': 0.025, 'K_SP': 0.005, 'a_C_chl': 40,
+    'k_mortality': 0.05, 'theta_mortality': 1.05, 'k_salt_death': 0.1, 'K_Sl_salt': 5,
+    'k_growth': 2.5, 'theta_growth': 1.066, 'K_Sl_ox_Cpy': 0.5,
+    'k_resipration': 0.1, 'theta_resipration': 1.08, 'k_excration': 0.05, 'theta_excration': 1.07,
+    'v_set_Cpy': 0.1,
+    'k_c_decomp': 0.1, 'theta_c_decomp': 1.08, 'K_Sl_Cpoc_decomp': 0.5, 'v_set_Cpoc': 0.2,
+    'k_n_decomp': 0.1, 'theta_n_decomp': 1.08, 'K_Sl_Cpon_decomp': 0.05, 'v_set_Cpon': 0.2,
+    'k_p_decomp': 0.1, 'theta_p_decomp': 1.08, 'K_Sl_Cpop_decomp': 0.01, 'v_set_Cpop': 0.2,
+    'a_N_C': 0.176, 'a_P_C': 0.024, 'a_O2_C': 2.67,
+    'k_c_mnr_ox': 0.1, 'theta_c_mnr_ox': 1.08, 'K_Sl_ox_mnr_c': 0.5, 'K_Sl_c_mnr_ox': 0.5,
+    'k_n_mnr_ox': 0.1, 'theta_n_mnr_ox': 1.08, 'K_Sl_ox_mnr_n': 0.5, 'K_Sl_n_mnr_ox': 0.5,
+    'k_p_mnr_ox': 0.1, 'theta_p_mnr_ox': 1.08, 'K_Sl_ox_mnr_p': 0.5, 'K_Sl_p_mnr_ox': 0.5,
+    'k_c_mnr_ni': 0.05, 'theta_c_mnr_ni': 1.05, 'K_Si_ox_mnr_c': 0.5, 'K_Sl_ni_mnr_c': 0.1, 'K_Sl_c_mnr_ni': 0.5,
+    'k_n_mnr_ni': 0.05, 'theta_n_mnr_ni': 1.05, 'K_Si_ox_mnr_n': 0.5, 'K_Sl_ni_mnr_n': 0.1, 'K_Sl_n_mnr_ni': 0.5,
+    'k_p_mnr_ni': 0.05, 'theta_p_mnr_ni': 1.05, 'K_Si_ox_mnr_p': 0.5, 'K_Sl_ni_mnr_p': 0.1, 'K_Sl_p_mnr_ni': 0.5,
+    'k_nitrification': 0.1, 'theta_nitr': 1.08, 'K_Sl_nitr_ox': 1.0, 'K_Sl_nitr': 0.1,
+    'k_denitrification': 0.1, 'theta_denitr': 1.045, 'K_Si_denitr_ox': 0.1, 'K_Sl_denitr': 0.1,
+    'k_raer': 0.5, 'theta_rear': 1.024,
+}
+
+initial = {'Cpy': 0.5, 'Cpoc': 1.0, 'Cpon': 0.15, 'Cpop': 0.02, 'Cdoc': 5.0, 'Cdon': 0.5, 'Cdop': 0.03,
+           'Cam': 0.05, 'Cni': 1.0, 'Cph': 0.02, 'Cox': 10.0}
+
+
+class Case:
+    # the 2-box network of CuLPy.py with smooth synthetic forcing
+
+    def __init__(self, n_iter=480, dt=1/24):
+        self.n_iter = n_iter
+        self.dt = dt
+        self.Altitude = 1.0
+        days = np.arange(n_iter + 1) * dt
+        daily = np.sin(2 * np.pi * days)
+        seasonal = np.sin(2 * np.pi * days / 60)
+        self.network = BoxNetwork(["CL1", "CL2"],
+                                  [("C01_NE", "CL1", "Q01_NE"),
+                                   ("C01_BS", "CL1", "Q01_BS"),
+                                   ("CL1",    "BS",  "Q10_BS"),
+                                   ("CL1",    "CL2", "Q12"),
+                                   ("CL2",    "CL1", "Q21"),
+                                   ("C02_RU", "CL2", "Q02_RU")])
+        Q = {"Q01_NE": 120 + 20 * seasonal, "Q01_BS": 15 + 3 * seasonal, "Q10_BS": 130 + 20 * seasonal,
+             "Q02_RU": 25 + 5 * seasonal, "Q12": 50 + 5 * daily, "Q21": 45 + 5 * daily}
+        Q = {flow: values * 86400 for flow, values in Q.items()}
+        V = np.column_stack([np.full(n_iter + 1, 2.5e8), np.full(n_iter + 1, 3.5e8)])
+        boundary = state_array(initial)[0] * (1 + 0.1 * seasonal[:, None])
+        boundaries = {"C01_NE": boundary, "C01_BS": 0.9 * boundary, "C02_RU": 1.1 * boundary}
+        flow_series = self.network.forcing_series(Q, V, boundaries)
+        # the series as the model scripts read them
+        self.Q, self.V, self.boundaries = Q, V, boundaries
+        two = lambda x: np.column_stack([x, x])
+        self.forcing = ForcingMatrix({
+            'T':        two(12 + 8 * seasonal + daily),
+            'I_a':      two(np.maximum(300 * daily, 0.0)),
+            'salinity': two(2 + 0.5 * seasonal),
+            'f_day':    two(np.full(n_iter + 1, 0.5)),
+            **flow_series})
+        self.H = np.array([2.5, 3.5])
+        self.C_init = state_array(initial, initial)
+        self.kmc = CompiledKMC(kmc_values)
+
+    def arrays(self):
+        return (self.C_init, self.n_iter, self.dt, self.forcing, self.H, self.network, self.kmc,
+                self.Altitude)
+
+
+@pytest.fixture
+def case():
+    return Case()
+
+
+# =========================================================================== #
+# ============================ Model case files \ =========================== #
+# The case of a config file run (culpy_model): the inputs, kmc file and
+# observations of a 10 day run of the CuLPy.py network, written to a folder
+
+model_config = """
+sim_start_date = "2020-01-01"
+sim_end_date = "2020-01-11"
+JDay_start_date = "2019-12-31"
+dt = "1/24"
+Altitude = 1.0
+kmc_file_name = "kmc.txt"
+observation_file_name = "observation.csv"
+connections = [["C01_NE", "CL1", "Q01_NE"],
+               ["C01_BS", "CL1", "Q01_BS"],
+               ["CL1",    "BS",  "Q10_BS"],
+               ["CL1",    "CL2", "Q12"],
+               ["CL2",    "CL1", "Q21"],
+               ["C02_RU", "CL2", "Q02_RU"]]
+
+[inputs.wDate]
+C01_NE = "bc_ne"
+C01_BS = "bc_bs"
+C02_RU = "bc_ru"
+
+[inputs.wJDay]
+Q = "flow"
+T = "temp"
+V = "vol"
+Ia = "light"
+fDay = "fday"
+Salt = "salt"
+
+[flows]
+Q01_NE = ["Q", "q1"]
+Q01_BS = ["Q", "q2"]
+Q10_BS = ["Q", "q3"]
+Q02_RU = ["Q", "q4"]
+Q12 = ["Q", "q5"]
+Q21 = ["Q", "q6"]
+"""
+
+model_box = """
+[boxes.{box}]
+H = {H}
+T = ["T", "t{i}"]
+V = ["V", "v{i}"]
+I_a = ["Ia", "i{i}"]
+f_day = ["fDay", "f{i}"]
+salinity = ["Salt", "s{i}"]
+
+[boxes.{box}.initial]
+"""
+
+def write_model_case(directory, config_name="case.toml"):
+    # returns the config file name
+    def write(name, data):
+        pd.DataFrame(data).to_csv(os.path.join(directory, f"{name}.csv"), index=False)
+
+    days = np.arange(0, 14, 0.25)
+    wave = np.sin(2 * np.pi * days)
+    write("flow", {"time": days, "q1": 120 + 20 * wave, "q2": 15 + 3 * wave, "q3": 130 + 20 * wave,
+                   "q4": 25 + 5 * wave, "q5": 50 + 5 * wave, "q6": 45 + 5 * wave})
+    write("temp", {"time": days, "t1": 12 + 2 * wave, "t2": 13 + 2 * wave})
+    write("vol", {"time": days, "v1": 1.0e9 + 1e7 * wave, "v2": 5.0e8 + 5e6 * wave})
+    write("light", {"time": days, "i1": np.maximum(300 * wave, 0.0), "i2": np.maximum(280 * wave, 0.0)})
+    write("fday", {"time": days, "f1": 0.5 + 0 * wave, "f2": 0.5 + 0 * wave})
+    write("salt", {"time": days, "s1": 2 + 0.5 * wave, "s2": 1 + 0.5 * wave})
+    dates = pd.date_range("2019-12-25", "2020-01-20", freq="D")
+    for k, name in enumerate(["bc_ne", "bc_bs", "bc_ru"]):
+        write(name, {"time": dates.strftime("%Y-%m-%d"),
+                     **{var: value * (0.9 + 0.1 * k) * np.ones(len(dates)) for var, value in initial.items()}})
+    with open(os.path.join(directory, "kmc.txt"), "w") as f:
+        for name, value in kmc_values.items():
+            f.write(f"{name} = {value}\n")
+    write("observation", {"Date": ["01/02/2020", "01/04/2020", "01/06/2020", "01/08/2020", "01/10/2020"],
+                          "NH4": [0.05, 0.04, 0.045, np.nan, 0.05],
+                          "NO3": [1.0, 0.95, 0.9, 0.92, 0.94],
+                          "PO4": [0.02, 0.018, 0.021, 0.019, 0.02]})
+
+    config = model_config
+    for i, (box, H) in enumerate([("CL1", 2.5), ("CL2", 3.5)], 1):
+        config += model_box.format(box=box, H=H, i=i)
+        config += "".join(f"{var} = {value}\n" for var, value in initial.items())
+    with open(os.path.join(directory, config_name), "w") as f:
+        f.write(config)
+    return os.path.join(directory, config_name)
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    return write_model_case(str(tmp_path))
+
+# ============================ Model case files / =========================== #
+# =========================================================================== #
@@ -0,0 +1,331 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the array-backed state engine against the dict implementation of the scripts """
+
+
+import math
+import numpy as np
+import pytest
+
+from culpy_engine import simulate_C, simulate_C_ensemble, state_vars, var_index
+from culpy_engine import TemperatureTables, ThetaFactors, theta_names, ForcingMatrix
+from culpy_engine import pelagic_process_rates, process_rates, BlockRates
+from culpy_output import save_checkpoint, load_checkpoint
+from conftest import kmc_values
+
+
+# =========================================================================== #
+# ======================= Dict implementation (1-d) \ ======================= #
+# simulate_C and pelagic_process_rates of CuLPy.py before the array engine,
+# for the 2-box network of the test case.
+
+def dict_process_rates(C_t_dict, T, H, I_a, salinity, f_day, kmc, Altitude):
+
+    Cpy, Cpoc, Cpon, Cpop, Cdoc, Cdon, Cdop, Cam, Cni, Cph, Cox = list(C_t_dict.values())
+
+    def calculate_light_limitation(ChlA, H, kmc, I_a):
+        K_e = kmc['K_be'] + (0.0088*ChlA) + (0.054*(ChlA**(2/3)))
+        constant_e = 2.718
+        X_I = (((constant_e*f_day)/(K_e*H)) *
+                (math.exp((-I_a/kmc['I_s'])*math.exp(-K_e*H)) -
+                 math.exp(-I_a/kmc['I_s'])))
+        return X_I
+
+    def calculate_nutrient_limitation(Cni, Cam, Cph, kmc):
+        X_N_N = (Cni+Cam)/(kmc['K_SN']+Cni+Cam)
+        X_N_P = Cph/(kmc['K_SP']+Cph)
+        return X_N_N*X_N_P
+
+    def calculate_O2_saturation(T, kmc, salinity):
+        TKelvin = T + 273.15
+        AltEffect = (100 - (0.0035 * 3.28083 * Altitude)) / 100
+        ln_stemp = (-139.34411 + (1.575701E+5 / TKelvin) -
+                    (6.642308E+7 / (TKelvin ** 2)) + (1.243800E+10 / (TKelvin ** 3))
+                    - (8.621949E+11 / (TKelvin ** 4)))
+        ln_ssalt = (salinity * ((1.7674E-2) - (1.754E+1 / TKelvin)
+                            + (2.1407E+3 / (TKelvin ** 2))))
+        O2_sat_fresh = math.exp(ln_stemp)
+        O2_sat_salt = math.exp(ln_ssalt)
+        return AltEffect * (O2_sat_fresh - O2_sat_salt)
+
+    ChlA = (Cpy / kmc['a_C_chl']) * 1000
+    X_I = calculate_light_limitation(ChlA, H, kmc, I_a)
+    X_N = calculate_nutrient_limitation(Cni, Cam, Cph, kmc)
+    r_Phyto_Death_Mortality = kmc['k_mortality'] * kmc['theta_mortality']**(T-20) * Cpy
+    r_Phyto_Death_Salinity = kmc['k_salt_death'] * (salinity/(salinity+kmc['K_Sl_salt'])) * Cpy
+    R_Cpy_Growth = (kmc['k_growth'] * (kmc['theta_growth']**(T - 20))
+                     *(Cox/(Cox+kmc['K_Sl_ox_Cpy'])) * X_I * X_N * Cpy)
+    R_Cpy_Respiration = kmc['k_resipration'] * kmc['theta_resipration']**(T-20) * Cpy
+    R_Cpy_Excration = kmc['k_excration'] * kmc['theta_excration']**(T-20) * Cpy
+    R_Cpy_Death = (r_Phyto_Death_Mortality + r_Phyto_Death_Salinity)
+    R_Cpy_Settling = (kmc['v_set_Cpy']/H) * Cpy
+    R_Cpy = (+R_Cpy_Growth
+             -R_Cpy_Respiration
+             -R_Cpy_Excration
+             -R_Cpy_Death
+             -R_Cpy_Settling)
+
+    R_Cpoc_Decomposition = kmc['k_c_decomp'] * (kmc['theta_c_decomp']**(T-20)) * (Cpoc/(Cpoc+kmc['K_Sl_Cpoc_decomp'])) * Cpoc
+    R_Cpoc_Settling = (kmc['v_set_Cpoc']/H) * Cpoc
+    R_Cpoc = (+R_Cpy_Death
+              -R_Cpoc_Decomposition
+              -R_Cpoc_Settling)
+
+    R_Cpon_Decomposition = kmc['k_n_decomp'] * (kmc['theta_n_decomp']**(T-20)) * (Cpon/(Cpon+kmc['K_Sl_Cpon_decomp'])) * Cpon
+    R_Cpon_Settling = (kmc['v_set_Cpon']/H) * Cpon
+    R_Cpon = (+kmc['a_N_C']*R_Cpy_Death
+             -R_Cpon_Decomposition
+             -R_Cpon_Settling)
+
+    R_Cpop_Decomposition = kmc['k_p_decomp'] * (kmc['theta_p_decomp']**(T-20)) * (Cpop/(Cpop+kmc['K_Sl_Cpop_decomp'])) * Cpop
+    R_Cpop_Settling = (kmc['v_set_Cpop']/H) * Cpop
+    R_Cpop = (+kmc['a_P_C']*R_Cpy_Death
+             -R_Cpop_Decomposition
+             -R_Cpop_Settling)
+
+    def mineralization_by_ox(var_name, var):
+        return kmc[f'k_{var_name}_mnr_ox'] * (kmc[f'theta_{var_name}_mnr_ox']**(T-20)) * \
+            Cox/(kmc[f'K_Sl_ox_mnr_{var_name}']+Cox) *\
+                (var/(var+kmc[f'K_Sl_{var_name}_mnr_ox'])) * var
+
+    def mineralization_by_ni(var_name, var):
+        return kmc[f'k_{var_name}_mnr_ni'] * (kmc[f'theta_{var_name}_mnr_ni']**(T-20)) * \
+            (1 - Cox/(kmc[f'K_Si_ox_mnr_{var_name}']+Cox)) * \
+                Cni/(kmc[f'K_Sl_ni_mnr_{var_name}']+Cni) * \
+                    (var/(var+kmc[f'K_Sl_{var_name}_mnr_ni'])) * var
+
+    R_Cdoc_Mineralization = mineralization_by_ox("c", Cdoc) + mineralization_by_ni("c", Cdoc)
+    R_Cdoc = (+R_Cpy_Excration
+             +R_Cpoc_Decomposition
+             -R_Cdoc_Mineralization)
+
+    R_Cdon_Mineralization = (mineralization_by_ox("n", Cdon) + mineralization_by_ni("n", Cdon))
+    R_Cdon = (+kmc['a_N_C']*R_Cpy_Excration
+             +R_Cpon_Decomposition
+             -R_Cdon_Mineralization)
+
+    R_Cdop_Mineralization = (mineralization_by_ox("p", Cdop) + mineralization_by_ni("p", Cdop))
+    R_Cdop = (+kmc['a_P_C']*R_Cpy_Excration
+             +R_Cpop_Decomposition
+             -R_Cdop_Mineralization)
+
+    prefam = (Cam * (Cni / ((kmc['K_SN']+Cam)*(kmc['K_SN']+Cni))) + Cam * (kmc['K_SN'] / ((Cam+Cni)*(kmc['K_SN']+Cni))))
+    R_Nitrification = (kmc['k_nitrification'] * (kmc['theta_nitr']**(T-20)) * (Cox/(Cox+kmc['K_Sl_nitr_ox'])) * (Cam/(Cam+kmc['K_Sl_nitr']))) * Cam
+    R_Cam = (+R_Cdon_Mineralization
+             +kmc['a_N_C']*R_Cpy_Respiration
+             -kmc['a_N_C']*prefam*R_Cpy_Growth
+             -R_Nitrification)
+
+    R_Denitrification = ((kmc['k_denitrification'] * (kmc['theta_denitr']**(T-20)) *
+                          (kmc['K_Si_denitr_ox']/(Cox+kmc['K_Si_denitr_ox'])) * (Cni/(Cni+kmc['K_Sl_denitr']))) * Cni)
+    R_Cni = (+R_Nitrification
+             -R_Denitrification
+             -kmc['a_N_C']*(1-prefam)*R_Cpy_Growth)
+
+    R_Cph = (+R_Cdop_Mineralization
+             +kmc['a_P_C']*R_Cpy_Respiration
+             -kmc['a_P_C']*R_Cpy_Growth)
+
+    O2_sat = calculate_O2_saturation(T, kmc, salinity)
+    R_Reaeration = kmc['k_raer'] * kmc['theta_rear'] * (O2_sat-Cox)
+    R_Cox = (+R_Reaeration
+            +kmc['a_O2_C']*R_Cpy_Growth
+            -kmc['a_O2_C']*R_Cpy_Respiration
+            -(32/12)*mineralization_by_ox("c", Cdoc)
+            -(64/14)*R_Nitrification
+            +(5/4)*(32/14)*R_Denitrification)
+
+    return dict(zip(state_vars, (R_Cpy, R_Cpoc, R_Cpon, R_Cpop, R_Cdoc, R_Cdon, R_Cdop,
+                                 R_Cam, R_Cni, R_Cph, R_Cox)))
+
+
+def dict_simulate_C(case):
+    n_iter, dt, kmc, Altitude = case.n_iter, case.dt, kmc_values, case.Altitude
+    T, I_a, salinity, f_day = (case.forcing[name] for name in ('T', 'I_a', 'salinity', 'f_day'))
+    Q, V = case.Q, case.V
+    C01_NE, C01_BS, C02_RU = (case.boundaries[name] for name in ('C01_NE', 'C01_BS', 'C02_RU'))
+    C1 = {var: np.zeros(n_iter + 1) for var in state_vars}
+    C2 = {var: np.zeros(n_iter + 1) for var in state_vars}
+    for var in state_vars:
+        C1[var][0], C2[var][0] = case.C_init[0, var_index[var]], case.C_init[1, var_index[var]]
+
+    for t in range(1, n_iter + 1):
+        C1t = {key: value[t-1] for key, value in C1.items()}
+        R1_t = dict_process_rates(C1t, T[t-1, 0], case.H[0], I_a[t-1, 0], salinity[t-1, 0], f_day[t-1, 0],
+                                  kmc, Altitude)
+        C2t = {key: value[t-1] for key, value in C2.items()}
+        R2_t = dict_process_rates(C2t, T[t-1, 1], case.H[1], I_a[t-1, 1], salinity[t-1, 1], f_day[t-1, 1],
+                                  kmc, Altitude)
+        V1, V2 = V[t-1, 0], V[t-1, 1]
+        for var in state_vars:
+            i = var_index[var]
+            C1[var][t] = + C1[var][t-1] + (
+                         + (Q['Q01_NE'][t-1] / V1) * C01_NE[t-1, i]
+                         + (Q['Q01_BS'][t-1] / V1) * C01_BS[t-1, i]
+                         - (Q['Q10_BS'][t-1] / V1) * C1[var][t-1]
+                         - (Q['Q12'][t-1] / V1) * C1[var][t-1]
+                         + (Q['Q21'][t-1] / V1) * C2[var][t-1]
+                         + R1_t[var]) * dt
+            C2[var][t] = + C2[var][t-1] + (
+                         + (Q['Q02_RU'][t-1] / V2) * C02_RU[t-1, i]
+                         + (Q['Q12'][t-1] / V2) * C1[var][t-1]
+                         - (Q['Q21'][t-1] / V2) * C2[var][t-1]
+                         + R2_t[var]) * dt
+
+    return np.stack([np.column_stack([C[var] for var in state_vars]) for C in (C1, C2)], axis=1)
+
+# ======================= Dict implementation (1-d) / ======================= #
+# =========================================================================== #
+
+
+def test_array_engine_matches_dict_implementation(case):
+    # equal to rounding: the flow matrices sum the fluxes of a box in another
+    # order, and vectorized exp/pow may differ from libm in the last bit
+    C_dict = dict_simulate_C(case)
+    C = simulate_C(*case.arrays())
+    assert C.shape == C_dict.shape == (case.n_iter + 1, 2, 11)
+    scale = np.abs(C_dict).max(axis=(0, 1))
+    assert np.all(np.abs(C - C_dict) <= 1e-12 * scale)
+
+
+def test_ensemble_matches_single_runs(case):
+    # N parameter sets stepped in one batched run give the runs of each set,
+    # with a shared or a per realisation initial state
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    kmc_list = [kmc, kmc.replace(k_growth=1.5, theta_growth=1.04), kmc.replace(k_raer=2.0)]
+    C = simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude)
+    assert C.shape == (n_iter + 1, 3, 2, 11)
+    for i, kmc_i in enumerate(kmc_list):
+        C_i = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc_i, Altitude)
+        assert np.allclose(C[:, i], C_i, rtol=1e-12, atol=0.0)
+    C_inits = np.stack([C_init, 0.5 * C_init, 2 * C_init])
+    C = simulate_C_ensemble(C_inits, n_iter, dt, forcing, H, network, kmc_list, Altitude)
+    assert np.allclose(C[:, 1], simulate_C(C_inits[1], n_iter, dt, forcing, H, network, kmc_list[1], Altitude),
+                       rtol=1e-12, atol=0.0)
+
+
+def test_theta_factors_by_block(case):
+    # blocks of rows, read in the order of a run and with the step back of
+    # the interpolating integrators, equal the factors of the whole series
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    tables = TemperatureTables(forcing['T'], forcing['salinity'], Altitude)
+    theta_T = tables.theta_factors(kmc)
+    assert theta_T.shape == (n_iter + 1, 15, 2)
+    assert np.array_equal(theta_T[:, theta_names.index('theta_growth')], kmc.theta_growth ** (forcing['T'] - 20))
+    blocks = ThetaFactors(tables, kmc, block_rows=100)
+    for t in list(range(n_iter + 1)) + [250, 199, 200, 0]:
+        assert np.array_equal(blocks[t], theta_T[t])
+    assert len(blocks.block) <= 100
+
+
+def test_forcing_matrix():
+    # named series of one or more columns packed into one matrix
+    T = np.arange(10.0)
+    boundary = np.arange(10.0 * 2 * 3).reshape(10, 2, 3)
+    forcing = ForcingMatrix({'T': T, 'I_a': np.column_stack([T, 2 * T]), 'boundary': boundary})
+    assert forcing.values.shape == (10, 1 + 2 + 6)
+    assert forcing.values.flags['C_CONTIGUOUS']
+    assert forcing.index['T'] == 0 and forcing.index['I_a'] == slice(1, 3)
+    assert np.array_equal(forcing['T'], T)
+    assert np.array_equal(forcing['I_a'][:, 1], 2 * T)
+    assert np.array_equal(forcing['boundary'], boundary)
+    assert np.array_equal(forcing.values[4, forcing.index['boundary']], boundary[4].ravel())
+    assert 'T' in forcing and 'Q' not in forcing
+
+
+def test_numba_fallback_warns(case, monkeypatch):
+    # without numba the python backend runs, with a warning instead of output
+    import culpy_jit
+    monkeypatch.setattr(culpy_jit, "jit_available", False)
+    with pytest.warns(RuntimeWarning, match="numba is not installed"):
+        C = simulate_C(*case.arrays(), backend="numba")
+    assert np.array_equal(C, simulate_C(*case.arrays(), backend="python"))
+
+
+@pytest.mark.parametrize("integrator", ["euler", "rk4"])
+def test_checkpoint_restart(case, tmp_path, integrator):
+    # a run restarted from a checkpoint gives the rows of the full run
+    # after it, streamed as well as returned
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    checkpoint = str(tmp_path / "checkpoint_{row}.npz")
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, integrator=integrator,
+                   checkpoint=checkpoint, checkpoint_interval=5.0)
+    for row in (120, 240, 360, 480):
+        C_row, checkpoint_row, checkpoint_dt = load_checkpoint(checkpoint.format(row=row))
+        assert (checkpoint_row, checkpoint_dt) == (row, dt)
+        assert np.array_equal(C_row, C[row])
+    C_restart = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, integrator=integrator,
+                           restart=checkpoint.format(row=240))
+    assert np.array_equal(C_restart, C[240:])
+
+    chunks = []
+    simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, integrator=integrator,
+               restart=checkpoint.format(row=120), output=lambda row, C_chunk: chunks.append((row, np.array(C_chunk))),
+               chunk_rows=100)
+    assert [row for row, C_chunk in chunks] == [120, 220, 320, 420]
+    assert np.array_equal(np.concatenate([C_chunk for row, C_chunk in chunks]), C[120:])
+
+
+def test_checkpoint_restart_of_an_ensemble(case, tmp_path):
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    kmc_list = [kmc, kmc.replace(k_growth=1.5)]
+    checkpoint = str(tmp_path / "ensemble.npz")
+    C = simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude, checkpoint=checkpoint,
+                            checkpoint_interval=7.0)
+    C_row, row, checkpoint_dt = load_checkpoint(checkpoint)
+    assert row == n_iter and np.array_equal(C_row, C[-1])
+    save_checkpoint(checkpoint, C[168], 168, dt)
+    C_restart = simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude, restart=checkpoint)
+    assert np.array_equal(C_restart, C[168:])
+
+
+def test_checkpoint_errors(case, tmp_path):
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    checkpoint = str(tmp_path / "checkpoint.npz")
+    save_checkpoint(checkpoint, C_init, 100, 2 * dt)
+    with pytest.raises(ValueError, match="has dt"):
+        simulate_C(*case.arrays(), restart=checkpoint)
+    save_checkpoint(checkpoint, C_init, n_iter + 1, dt)
+    with pytest.raises(ValueError, match="after the end of the run"):
+        simulate_C(*case.arrays(), restart=checkpoint)
+    save_checkpoint(checkpoint, C_init[:1], 100, dt)
+    with pytest.raises(ValueError, match="has a state of shape"):
+        simulate_C(*case.arrays(), restart=checkpoint)
+
+
+def test_block_rates(case):
+    # rates of blocks of boxes in threads are the rates of one call, also
+    # for an ensemble state (N, n_boxes, 11) and uneven blocks
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    rng = np.random.default_rng(0)
+    n_boxes = 7
+    boxes = np.arange(n_boxes) % 2
+    tables = TemperatureTables(forcing['T'][:, boxes], forcing['salinity'][:, boxes], Altitude)
+    theta_T = ThetaFactors(tables, kmc)[100]
+    row = lambda name: forcing[name][100, boxes] * (1 + 0.1 * rng.random(n_boxes))
+    arguments = (tables.O2_sat[100], H[boxes], row('I_a'), row('salinity'), row('f_day'), kmc)
+    assert process_rates(n_boxes, 1) is pelagic_process_rates
+    for threads in (2, 3, 7, 16):
+        rates = process_rates(n_boxes, threads)
+        assert isinstance(rates, BlockRates) and len(rates.blocks) == min(threads, n_boxes)
+        C_t = C_init[boxes] * (1 + 0.5 * rng.random((n_boxes, 11)))
+        assert np.array_equal(rates(C_t, theta_T, *arguments), pelagic_process_rates(C_t, theta_T, *arguments))
+        C_t = C_init[boxes] * (1 + 0.5 * rng.random((4, n_boxes, 11)))
+        assert np.array_equal(rates(C_t, theta_T, *arguments), pelagic_process_rates(C_t, theta_T, *arguments))
+
+
+def test_threaded_runs(case):
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)
+    assert np.array_equal(simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, threads=2), C)
+    C_rk4 = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, integrator="rk4")
+    assert np.array_equal(simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, integrator="rk4",
+                                     threads=2), C_rk4)
+    kmc_list = [kmc, kmc.replace(k_growth=1.5)]
+    C = simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude)
+    assert np.array_equal(simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude,
+                                              threads=2), C)
@@ -0,0 +1,63 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the parallel ensemble executor and its reductions """
+
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from culpy_engine import simulate_C, state_vars
+from culpy_ensemble import run_ensemble, RunMean, ObservationReduction, ObservationValues
+from culpy_metrics import ObservationIndex
+
+
+sim_start_date = "2020-01-01"
+parameter_table = pd.DataFrame({'k_growth': [2.5, 1.5, 2.0], 'theta_nitr': [1.08, 1.05, 1.1]},
+                               index=pd.Index(['r0', 'r1', 'r2'], name='real'))
+
+
+def single_run(case, overrides):
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    return simulate_C(C_init, n_iter, dt, forcing, H, network, kmc.replace(**overrides), Altitude)
+
+
+def test_pool_matches_serial_runs(case):
+    # the pool runs every realisation as a single run, the stacked run
+    # agrees with them to rounding
+    reduction = RunMean(case.network.boxes)
+    pool = run_ensemble(parameter_table, *case.arrays(), reduction, processes=2, chunk_rows=100)
+    stacked = run_ensemble(parameter_table, *case.arrays(), reduction, processes=0, chunk_rows=100)
+    assert list(pool.index) == ['r0', 'r1', 'r2'] and pool.index.name == 'real'
+    assert list(pool.columns) == [f'{var}_{box}' for box in ['CL1', 'CL2'] for var in state_vars]
+    for name, overrides in zip(parameter_table.index, parameter_table.to_dict(orient='records')):
+        expected = single_run(case, overrides).mean(axis=0).ravel()
+        assert np.allclose(pool.loc[name], expected, rtol=1e-14, atol=0.0)
+        assert np.allclose(stacked.loc[name], expected, rtol=1e-12, atol=0.0)
+
+
+def test_observation_reductions(case):
+    times = pd.DatetimeIndex(["2020-01-03 06:00", "2020-01-08", "2020-03-01"])
+    instant = run_ensemble(parameter_table, *case.arrays(),
+                           ObservationReduction(sim_start_date, case.dt, times, box=1), processes=0)
+    C = single_run(case, parameter_table.iloc[1].to_dict())
+    assert instant.loc['r1', 'Cox_2020-01-03T06:00'] == C[54, 1, 10]
+    assert instant.loc['r1', 'Cam_2020-01-08'] == C[168, 1, 7]
+    assert np.isnan(instant.loc['r1', 'Cam_2020-03-01'])
+
+    observations = pd.DataFrame({'NH4': [0.05, np.nan], 'NO3': [1.0, 0.9]},
+                                index=pd.DatetimeIndex(["2020-01-03", "2020-01-08"]))
+    index = ObservationIndex(observations, sim_start_date, case.dt, case.n_iter)
+    values = run_ensemble(parameter_table, *case.arrays(), ObservationValues(index), processes=2)
+    assert list(values.columns) == ['nh4_01_03_20', 'no3_01_03_20', 'no3_01_08_20']
+    assert np.allclose(values.loc['r1'], [C[48:72, 0, 7].mean(), C[48:72, 0, 8].mean(), C[168:192, 0, 8].mean()],
+                       rtol=1e-12, atol=0.0)
+
+
+def test_unknown_parameter(case):
+    with pytest.raises(ValueError, match="unknown kmc parameter"):
+        run_ensemble(pd.DataFrame({'k_unknown': [1.0]}), *case.arrays(), RunMean(case.network.boxes))
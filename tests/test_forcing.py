@@ -0,0 +1,102 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the forcing input interpolation and the binary forcing cache """
+
+
+import os
+import numpy as np
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+
+import culpy_forcing
+from culpy_forcing import load_forcing, forcing_cache_key
+
+
+sim_start_date, sim_end_date, JDay_start_date = "2020-01-01", "2020-01-11", "2019-12-30"
+
+
+@pytest.fixture
+def input_files(tmp_path):
+    # a Julian day input with irregular times and a gap, and a daily dated one
+    rng = np.random.default_rng(1)
+    jday = np.sort(np.concatenate([[0.0, 14.5], rng.uniform(0, 14.5, 40)]))
+    flow = pd.DataFrame({'time': jday, 'Q1': 100 + 10 * np.sin(jday), 'Q2': 50 + jday})
+    flow.loc[5:8, 'Q2'] = np.nan
+    flow.to_csv(tmp_path / "flow.csv", index=False)
+    dates = pd.date_range("2019-12-31", "2020-01-15", freq="D")
+    boundary = pd.DataFrame({'time': dates.strftime('%Y-%m-%d'), 'Cpy': np.linspace(0.1, 0.5, len(dates)),
+                             'Cox': np.linspace(9, 11, len(dates))})
+    boundary.to_csv(tmp_path / "boundary.csv", index=False)
+    return str(tmp_path / "flow"), str(tmp_path / "boundary")
+
+
+def interpolate_wJDay(sim_start_date, sim_end_date, JDay_start_date, time_step_per_day, file_name):
+    # the pandas interpolation of the model scripts before load_forcing
+    dt_minutes = 24 * 60 / time_step_per_day
+    inputF = pd.read_csv(f'{file_name}.csv')
+    start_date = datetime.strptime(JDay_start_date, "%Y-%m-%d")
+    inputF['datetime'] = inputF['time'].apply(lambda x: start_date + timedelta(days=x))
+    inputF.set_index('datetime', inplace=True)
+    new_time_index = pd.date_range(start=sim_start_date, end=sim_end_date, freq=f'{int(dt_minutes)}min')
+    return inputF.reindex(inputF.index.union(new_time_index)).interpolate(method='time').loc[new_time_index]
+
+
+def interpolate_wDate(sim_start_date, sim_end_date, time_step_per_day, file_name):
+    dt_minutes = 24 * 60 / time_step_per_day
+    inputF = pd.read_csv(f'{file_name}.csv')
+    inputF['time'] = pd.to_datetime(inputF['time'])
+    inputF.set_index('time', inplace=True)
+    new_time_index = pd.date_range(start=sim_start_date, end=sim_end_date, freq=f'{int(dt_minutes)}min')
+    return inputF.reindex(inputF.index.union(new_time_index)).interpolate(method='time').loc[new_time_index]
+
+
+def load(input_files, cache_dir=None):
+    flow, boundary = input_files
+    return load_forcing(sim_start_date, sim_end_date, JDay_start_date, 24,
+                        wDate_files={'C01': boundary}, wJDay_files={'Q': flow}, cache_dir=cache_dir)
+
+
+def test_interpolation_matches_pandas(input_files):
+    # one np.interp pass per column gives the series of the pandas
+    # interpolators, the gap in Q2 included
+    flow, boundary = input_files
+    inputs = load(input_files)
+    expected = {'Q': interpolate_wJDay(sim_start_date, sim_end_date, JDay_start_date, 24, flow),
+                'C01': interpolate_wDate(sim_start_date, sim_end_date, 24, boundary)}
+    for name, frame in expected.items():
+        for column in inputs[name]:
+            assert len(inputs[name][column]) == 10 * 24 + 1
+            assert np.array_equal(inputs[name][column], frame[column].to_numpy(), equal_nan=True)
+
+
+def test_forcing_cache(input_files, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    inputs = load(input_files, cache_dir)
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 2
+
+    # a second load reads the memory-mapped cache without interpolating
+    def no_interpolation(*args):
+        raise AssertionError("the cache was not used")
+    monkeypatch.setattr(culpy_forcing, "interpolate_input", no_interpolation)
+    cached = load(input_files, cache_dir)
+    for name in inputs:
+        for column, values in inputs[name].items():
+            assert isinstance(cached[name][column], np.memmap)
+            assert np.array_equal(cached[name][column], values, equal_nan=True)
+    monkeypatch.undo()
+
+    # a changed input file or time step has another key
+    flow, boundary = input_files
+    key = forcing_cache_key(flow, sim_start_date, sim_end_date, JDay_start_date, 24)
+    assert key != forcing_cache_key(flow, sim_start_date, sim_end_date, JDay_start_date, 48)
+    data = pd.read_csv(f'{flow}.csv')
+    data['Q1'] *= 2
+    data.to_csv(f'{flow}.csv', index=False)
+    assert forcing_cache_key(flow, sim_start_date, sim_end_date, JDay_start_date, 24) != key
+    changed = load(input_files, cache_dir)
+    assert np.allclose(changed['Q']['Q1'], 2 * inputs['Q']['Q1'])
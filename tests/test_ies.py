@@ -0,0 +1,80 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the ensemble smoother calibration (ES-MDA) """
+
+
+import os
+import numpy as np
+import pandas as pd
+
+from culpy_ies import transform, back_transform, prior_ensemble, es_mda_update, objective, run_ies
+from culpy_model import Model
+from conftest import Case
+
+
+bounds = pd.DataFrame({'lower': [1.0, 0.01], 'upper': [3.0, 1.0], 'transform': ['none', 'log']},
+                      index=pd.Index(['k_growth', 'k_raer'], name='parameter'))
+
+
+def test_prior_ensemble():
+    # Gaussian around the base values in the transformed space, in bounds
+    # (a quarter of the range: 1 for both, the bounds are centred on them)
+    centred = pd.DataFrame({'lower': [0.5, 0.005], 'upper': [4.5, 50.0], 'transform': ['none', 'log']},
+                           index=bounds.index)
+    X = prior_ensemble(Case().kmc, centred, 4000, np.random.default_rng(0))
+    values = back_transform(X, centred)
+    assert np.allclose(transform(values, centred), X)
+    assert (X >= transform(centred['lower'].values, centred)).all()
+    assert (X <= transform(centred['upper'].values, centred)).all()
+    base = np.array([2.5, np.log10(0.5)])
+    assert np.allclose(X.mean(axis=0), base, atol=0.05)
+    assert np.allclose((np.abs(X - base) < 1.0).mean(axis=0), 0.683, atol=0.03)
+
+
+def test_update_of_a_linear_gaussian_problem():
+    # one update with alpha 1 of a large ensemble gives the analytic
+    # posterior mean of a linear model with Gaussian prior and noise
+    rng = np.random.default_rng(1)
+    G = np.array([[1.0, 0.5], [0.2, 1.0], [1.0, -1.0]])
+    prior_mean, prior_var = np.array([1.0, 2.0]), np.array([0.5, 0.3])
+    noise_var = np.array([0.1, 0.2, 0.1])
+    observed = G @ np.array([1.4, 1.5])
+    X = prior_mean + np.sqrt(prior_var) * rng.standard_normal((20000, 2))
+    D = X @ G.T
+    D_obs = observed + np.sqrt(noise_var) * rng.standard_normal(D.shape)
+    X_post = es_mda_update(X, D, D_obs, noise_var, 1.0)
+
+    C = np.diag(prior_var)
+    K = C @ G.T @ np.linalg.inv(G @ C @ G.T + np.diag(noise_var))
+    assert np.allclose(X_post.mean(axis=0), prior_mean + K @ (observed - G @ prior_mean), atol=0.02)
+    assert np.allclose(np.cov(X_post.T), C - K @ G @ C, atol=0.02)
+    assert np.array_equal(objective(D[:2], observed, np.sqrt(noise_var)),
+                          (((D[:2] - observed) / np.sqrt(noise_var)) ** 2).sum(axis=1))
+
+
+def test_run_ies(model_file):
+    # observations of a run with k_growth 1.5: the ensemble moves towards
+    # it and phi falls; the files have the PEST++ IES layout
+    directory = os.path.dirname(model_file)
+    model = Model(model_file)
+    truth = model.run({'k_growth': 1.5}).box('CL1').resample('D').mean()
+    truth = truth.loc['2020-01-02':'2020-01-10', ['Cam', 'Cni', 'Cph']]
+    observation_file = os.path.join(directory, 'synthetic.csv')
+    truth.set_axis(['NH4', 'NO3', 'PO4'], axis=1).rename_axis('Date').to_csv(observation_file)
+
+    posterior, phi = run_ies(model, bounds.iloc[:1], n_reals=24, n_iterations=2, relative_noise=0.02,
+                             seed=2, observation_file=observation_file, directory=directory)
+    assert list(phi['iteration']) == [0, 1, 2] and (phi['failed_runs'] == 0).all()
+    assert phi['mean'].iloc[-1] < 0.1 * phi['mean'].iloc[0]
+    assert abs(posterior['k_growth'].mean() - 1.5) < 0.1
+    assert posterior.index.name == 'real_name'
+
+    for name in ('obs+noise', '0.par', '0.obs', '2.par', '2.obs'):
+        table = pd.read_csv(os.path.join(directory, f'culpy.{name}.csv'))
+        assert table.columns[0] == 'real_name' and len(table) == 24
+    observed = pd.read_csv(os.path.join(directory, 'culpy.0.obs.csv'), index_col=0)
+    assert list(observed.columns[:2]) == ['nh4_01_02_20', 'nh4_01_03_20'] and len(observed.columns) == 27
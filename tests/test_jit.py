@@ -0,0 +1,71 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Regression tests of the compiled (numba) backend against the python engine """
+
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+
+import culpy_jit
+import culpy_engine
+from culpy_engine import TemperatureTables
+from culpy_output import load_checkpoint
+
+
+def test_jit_matches_python(case):
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    tables = TemperatureTables(forcing['T'], forcing['salinity'], Altitude)
+    C_jit = culpy_jit.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, tables)
+    C_python = culpy_engine.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, backend="python")
+    assert C_jit.shape == C_python.shape
+    assert np.isfinite(C_python).all()
+    assert np.allclose(C_jit, C_python, rtol=1e-9, atol=0.0)
+
+
+def test_jit_matches_python_ensemble(case):
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    kmc_list = [kmc, kmc.replace(k_growth=1.5, theta_growth=1.04), kmc.replace(k_nitrification=0.3)]
+    C_jit = culpy_engine.simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude,
+                                             backend="numba")
+    C_python = culpy_engine.simulate_C_ensemble(C_init, n_iter, dt, forcing, H, network, kmc_list, Altitude,
+                                                backend="python")
+    assert C_jit.shape == (n_iter + 1, 3) + C_init.shape
+    assert np.allclose(C_jit, C_python, rtol=1e-9, atol=0.0)
+
+
+def test_jit_streams_output_and_checkpoints(case, tmp_path):
+    # the compiled run in segments: output chunks and checkpoints as with the
+    # python backend, and a run restarted from a checkpoint continues it
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C_python = culpy_engine.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, backend="python")
+    chunks = []
+    checkpoint = str(tmp_path / "checkpoint_{row}.npz")
+    result = culpy_engine.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, backend="numba",
+                                     output=lambda row, C_chunk: chunks.append((row, C_chunk.copy())),
+                                     chunk_rows=100, checkpoint=checkpoint, checkpoint_interval=7.0)
+    assert result is None
+    assert [row for row, C_chunk in chunks] == list(range(0, n_iter + 1, 100))
+    assert np.allclose(np.concatenate([C_chunk for row, C_chunk in chunks]), C_python, rtol=1e-9, atol=0.0)
+    for row in (168, 336, n_iter):
+        C_row, checkpoint_row, checkpoint_dt = load_checkpoint(checkpoint.format(row=row))
+        assert checkpoint_row == row
+        assert np.allclose(C_row, C_python[row], rtol=1e-9, atol=0.0)
+
+    C_restart = culpy_engine.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, backend="numba",
+                                        restart=checkpoint.format(row=168))
+    assert np.allclose(C_restart, C_python[168:], rtol=1e-9, atol=0.0)
+
+
+def test_jit_theta_blocks(case, monkeypatch):
+    # the compiled loop over several theta blocks continues across them
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    tables = TemperatureTables(forcing['T'], forcing['salinity'], Altitude)
+    C_jit = culpy_jit.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, tables)
+    monkeypatch.setattr(culpy_jit, "theta_block_rows", 100)
+    assert np.array_equal(culpy_jit.simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, tables), C_jit)
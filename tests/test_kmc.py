@@ -0,0 +1,54 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the compiled kmc parameters and their readers """
+
+
+import numpy as np
+import pytest
+
+from culpy_kmc import CompiledKMC, kmc_names, kmc_reader, kmc_values_reader, stack_kmc
+from conftest import kmc_values
+
+
+def write_kmc_file(path, values):
+    # "name = value" lines as in the kmc files of the model scripts
+    with open(path, 'w') as f:
+        for name, value in values.items():
+            f.write(f"{name} = {value}\n")
+        f.write("\n")
+
+
+def test_kmc_reader(tmp_path):
+    write_kmc_file(tmp_path / "kmc.txt", kmc_values)
+    kmc = kmc_reader(str(tmp_path / "kmc.txt"))
+    assert kmc.as_dict() == {name: float(kmc_values[name]) for name in kmc_names}
+    assert kmc.k_raer_theta_rear == kmc_values['k_raer'] * kmc_values['theta_rear']
+    assert kmc_values_reader(str(tmp_path / "kmc.txt"))['I_s'] == 250.0
+
+
+def test_missing_and_unknown_parameters():
+    values = dict(kmc_values)
+    del values['K_be']
+    with pytest.raises(ValueError, match="missing kmc parameter"):
+        CompiledKMC(values)
+    with pytest.raises(ValueError, match="unknown kmc parameter"):
+        CompiledKMC({**kmc_values, 'k_unknown': 1.0})
+
+
+def test_replace_keeps_derived_constants():
+    kmc = CompiledKMC(kmc_values).replace(k_raer=2.0)
+    assert kmc.k_raer == 2.0
+    assert kmc.k_raer_theta_rear == 2.0 * kmc_values['theta_rear']
+    assert CompiledKMC(kmc_values).k_raer == kmc_values['k_raer']
+
+
+def test_stack_kmc():
+    kmc = CompiledKMC(kmc_values)
+    stacked = stack_kmc([kmc, kmc.replace(k_growth=1.5)])
+    assert stacked.k_growth.shape == (2, 1)
+    assert np.array_equal(stacked.k_growth[:, 0], [kmc_values['k_growth'], 1.5])
+    assert np.array_equal(stacked.k_raer_theta_rear[:, 0], [kmc.k_raer_theta_rear] * 2)
@@ -0,0 +1,177 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the metrics engine, the observation index and the PEST output files """
+
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import scipy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'culpy_pest'))
+
+from culpy_engine import simulate_C, state_vars
+from culpy_metrics import metrics, metrics_table, metric_names, ObservationIndex, load_observation_index
+from culpy_output import SimulationResult, output_dates
+import generate_pest_out
+
+
+# =========================================================================== #
+# ======================= generate_pest_out baseline \ ====================== #
+# The metrics and write_out of generate_pest_out before the metrics engine,
+# on the output of one box
+
+def relative_error(y_true, y_pred):
+    return np.sum(np.abs(y_true - y_pred) / np.sum(y_true))
+
+
+def r2_score(y_true, y_pred):
+    slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(y_true, y_pred)
+    return r_value**2
+
+
+def pbias(y_true, y_pred):
+    return (np.sum(y_true - y_pred)/np.sum(y_true))*100
+
+
+def baseline_write_out():
+    simulation_df = pd.read_csv('output_1.csv')
+    observation_df = pd.read_csv('observation.csv')
+    simulation_df['Date'] = pd.to_datetime(simulation_df['Date'], format='mixed')
+    observation_df['Date'] = pd.to_datetime(observation_df['Date'], format='%m/%d/%Y')
+    simulation_daily_df = simulation_df.set_index('Date').resample('D').mean().reset_index()
+    aligned_df = pd.merge(simulation_daily_df, observation_df, on='Date', suffixes=('_sim', '_obs'))
+    values, pest_out = {'r2': [], 're': [], 'pbias': []}, []
+    for column in ['NH4', 'NO3', 'PO4']:
+        sim_column = column + '_sim'
+        obs_column = column + '_obs'
+        valid_idx = ~aligned_df[[sim_column, obs_column]].isnull().any(axis=1)
+        observed, simulated = aligned_df.loc[valid_idx, obs_column], aligned_df.loc[valid_idx, sim_column]
+        values['r2'].append(r2_score(observed, simulated))
+        values['re'].append(relative_error(observed, simulated))
+        values['pbias'].append(pbias(observed, simulated))
+        pest_out.extend(simulated)
+    return values, pest_out
+
+# ======================= generate_pest_out baseline / ====================== #
+# =========================================================================== #
+
+
+def random_pairs(seed, shape=(40, 3)):
+    rng = np.random.default_rng(seed)
+    observed = 1 + rng.random(shape)
+    simulated = observed * (1 + 0.2 * rng.standard_normal(shape))
+    observed[[3, 7], 0] = np.nan
+    simulated[[5], 1] = np.nan
+    return observed, simulated
+
+
+def test_metrics_match_the_baseline():
+    observed, simulated = random_pairs(0)
+    values = metrics(observed, simulated)
+    assert set(values) == set(metric_names)
+    for j in range(3):
+        valid = ~(np.isnan(observed[:, j]) | np.isnan(simulated[:, j]))
+        o, s = observed[valid, j], simulated[valid, j]
+        assert np.isclose(values['r2'][j], r2_score(o, s), rtol=1e-12)
+        assert np.isclose(values['re'][j], relative_error(o, s), rtol=1e-12)
+        assert np.isclose(values['pbias'][j], pbias(o, s), rtol=1e-12)
+        assert np.isclose(values['rmse'][j], np.sqrt(np.mean((o - s)**2)), rtol=1e-12)
+        assert np.isclose(values['nse'][j], 1 - np.sum((o - s)**2) / np.sum((o - o.mean())**2), rtol=1e-12)
+        r = np.corrcoef(o, s)[0, 1]
+        kge = 1 - np.sqrt((r - 1)**2 + (s.std() / o.std() - 1)**2 + (s.mean() / o.mean() - 1)**2)
+        assert np.isclose(values['kge'][j], kge, rtol=1e-12)
+
+
+def test_metrics_of_an_ensemble():
+    # the members (leading axis) give the metrics of their single runs
+    observed, simulated = random_pairs(1)
+    members = np.stack([simulated, 0.9 * simulated, simulated + 0.1])
+    values = metrics(observed, members)
+    for i, member in enumerate(members):
+        for name, value in metrics(observed, member).items():
+            assert np.allclose(values[name][i], value, rtol=1e-14, atol=0.0, equal_nan=True)
+    table = metrics_table(observed, members, ['NH4', 'NO3', 'PO4'], members=['r0', 'r1', 'r2'])
+    assert list(table.columns) == ['member', 'column', *metric_names]
+    assert list(table['member'][:4]) == ['r0', 'r0', 'r0', 'r1']
+    assert table['r2'].iloc[4] == values['r2'][1, 1]
+
+
+def test_write_out_matches_the_baseline(case, tmp_path, monkeypatch):
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)
+    result = SimulationResult(C, network.boxes, "2020-01-01", dt, state_vars)
+    monkeypatch.chdir(tmp_path)
+    result.save('output.csv')
+    # the compared columns named as the observations, as the baseline reads them
+    result.box('CL1').rename(columns={'Cam': 'NH4', 'Cni': 'NO3', 'Cph': 'PO4'}).to_csv(
+        'output_1.csv', date_format='%Y-%m-%d %H:%M:%S')
+    pd.DataFrame({'Date': ['01/02/2020', '01/05/2020', '01/09/2020', '01/12/2020', '02/01/2020'],
+                  'NH4': [0.05, 0.04, np.nan, 0.05, 0.05], 'NO3': [1.0, 0.95, 0.9, 0.92, 0.9],
+                  'PO4': [0.02, 0.018, 0.021, 0.019, 0.02]}).to_csv('observation.csv', index=False)
+
+    generate_pest_out.write_out('CL1')
+    values, pest_out = baseline_write_out()
+    assert np.allclose(np.loadtxt('pest.out'), pest_out, rtol=1e-12, atol=0.0)
+    for name in ('r2', 're', 'pbias'):
+        with open(f'{name}_values.txt') as f:
+            lines = [line.split(': ') for line in f.read().splitlines()]
+        assert [column for column, value in lines] == ['NH4', 'NO3', 'PO4']
+        assert np.allclose([float(value) for column, value in lines], values[name], rtol=1e-10, atol=0.0)
+    assert list(pd.read_csv('metrics.csv')['column']) == ['NH4', 'NO3', 'PO4']
+
+
+def test_observation_index(case, tmp_path):
+    # windows of the observation days on the dt grid, days outside the run
+    # left out, in pest.out order; the index survives a save and load
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)[:, 0]
+    observations = pd.DataFrame({'NH4': [0.05, 0.04, np.nan, 0.05], 'PO4': [0.02, 0.018, 0.021, 0.02],
+                                 'Other': [1.0, 2.0, 3.0, 4.0]},
+                                index=pd.DatetimeIndex(['2020-01-02', '2020-01-05 12:00', '2020-01-09', '2020-02-01'],
+                                                       name='Date'))
+    index = ObservationIndex(observations, "2020-01-01", dt, n_iter)
+    assert index.names == ['NH4', 'PO4']
+    assert list(index.starts) == [24, 96, 192, 481] and list(index.stops) == [48, 120, 216, 481]
+    assert index.observation_names == ['nh4_01_02_20', 'nh4_01_05_20', 'po4_01_02_20', 'po4_01_05_20',
+                                       'po4_01_09_20']
+    assert np.array_equal(index.observed_values(), [0.05, 0.04, 0.02, 0.018, 0.021])
+
+    daily = pd.DataFrame(C, index=output_dates("2020-01-01", dt, 0, n_iter + 1), columns=state_vars)
+    daily = daily.resample('D').mean()
+    means = index.window_means(C)
+    expected = [daily.loc[day, var] for var, day in [('Cam', '2020-01-02'), ('Cam', '2020-01-05'),
+                                                     ('Cph', '2020-01-02'), ('Cph', '2020-01-05'),
+                                                     ('Cph', '2020-01-09')]]
+    assert np.allclose(index.pest_values(means), expected, rtol=1e-12, atol=0.0)
+    assert index.simulated(means).shape == (3, 2)
+
+    # streamed chunk by chunk as in a run
+    reduction = index.reduction()
+    for first_row in range(0, n_iter + 1, 50):
+        reduction(first_row, C[first_row:first_row + 50])
+    assert np.allclose(reduction.means(), means, rtol=1e-12, atol=0.0, equal_nan=True)
+
+    index.save(str(tmp_path / 'index.npz'))
+    loaded = load_observation_index(str(tmp_path / 'index.npz'))
+    assert loaded.matches("2020-01-01", dt, n_iter) and not loaded.matches("2020-01-02", dt, n_iter)
+    assert loaded.observation_names == index.observation_names
+    assert np.array_equal(loaded.pest_values(loaded.window_means(C)), index.pest_values(means))
+
+
+def test_observation_index_file(case, tmp_path, monkeypatch):
+    # generate_pest_out keeps the saved index until observation.csv changes
+    monkeypatch.chdir(tmp_path)
+    pd.DataFrame({'Date': ['01/02/2020'], 'NH4': [0.05]}).to_csv('observation.csv', index=False)
+    simulation_df = pd.DataFrame(index=output_dates("2020-01-01", case.dt, 0, case.n_iter + 1))
+    assert generate_pest_out.observation_index(simulation_df).observation_names == ['nh4_01_02_20']
+    pd.DataFrame({'Date': ['01/03/2020'], 'NH4': [0.05]}).to_csv('other.csv', index=False)
+    os.replace('other.csv', 'observation.csv')
+    os.utime('observation_index.npz', (0, 0))
+    assert generate_pest_out.observation_index(simulation_df).observation_names == ['nh4_01_03_20']
@@ -0,0 +1,99 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the run configuration and the model API """
+
+
+import os
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+
+from culpy_engine import simulate_C, var_index
+from culpy_model import RunConfig, Model, load_config, load_model
+from culpy_output import read_output
+from conftest import initial
+
+
+def test_run_config(model_file):
+    config = load_config(model_file)
+    c = RunConfig(config, os.path.dirname(model_file))
+    assert c.dt == 1/24 and c.n_iter == 240
+    assert c.path('kmc.txt') == os.path.join(os.path.dirname(model_file), 'kmc.txt')
+    assert c.connections[3] == ('CL1', 'CL2', 'Q12')
+    assert (c.backend, c.integrator, c.output_series) == ('python', 'euler', 'dt')
+
+    with pytest.raises(ValueError, match="unknown config entries: time_step"):
+        RunConfig({**config, 'time_step': 1})
+    with pytest.raises(ValueError, match="missing config entries: dt"):
+        RunConfig({name: value for name, value in config.items() if name != 'dt'})
+    boxes = {'CL1': {name: value for name, value in config['boxes']['CL1'].items() if name != 'H'},
+             'CL2': config['boxes']['CL2']}
+    with pytest.raises(ValueError, match="missing entries of box CL1: H"):
+        RunConfig({**config, 'boxes': boxes})
+    boxes = {'CL1': config['boxes']['CL1'],
+             'CL2': {**config['boxes']['CL2'], 'initial': {'Cpy': 0.5}}}
+    with pytest.raises(ValueError, match="missing initial concentrations of box CL2"):
+        RunConfig({**config, 'boxes': boxes})
+    with pytest.raises(ValueError, match="unknown config file type"):
+        load_config('case.json')
+
+
+def test_connections_file(model_file):
+    directory = os.path.dirname(model_file)
+    config = load_config(model_file)
+    pd.DataFrame(config['connections'], columns=['from', 'to', 'flow']).to_csv(
+        os.path.join(directory, 'connections.csv'), index=False)
+    c = RunConfig({**config, 'connections': 'connections.csv'}, directory)
+    assert c.connections == [tuple(connection) for connection in config['connections']]
+
+
+def test_model_run(model_file):
+    # a run is the simulation of the prepared arrays; parameters and initial
+    # state are overridden per run
+    model = load_model(model_file)
+    assert isinstance(model, Model) and model.network.boxes == ['CL1', 'CL2']
+    C_init, forcing, H, network = model.model_arrays()
+    assert forcing.values.shape[0] == 241 and list(H) == [2.5, 3.5]
+    result = model.run()
+    assert np.array_equal(result.C, simulate_C(C_init, model.n_iter, model.dt, forcing, H, network, model.kmc,
+                                               model.Altitude))
+    assert result.dates[0] == pd.Timestamp('2020-01-01') and result.dates[-1] == pd.Timestamp('2020-01-11')
+
+    kmc = model.kmc.replace(k_growth=1.5)
+    assert np.array_equal(model.run({'k_growth': 1.5}).C, model.run(kmc).C)
+    assert np.array_equal(model.run({'k_growth': 1.5}).C,
+                          simulate_C(C_init, model.n_iter, model.dt, forcing, H, network, kmc, model.Altitude))
+    C = model.run(initial_state={'CL2': {'Cam': 0.2}}).C
+    assert C[0, 1, var_index['Cam']] == 0.2 and C[0, 0, var_index['Cam']] == initial['Cam']
+    assert np.array_equal(model.run(initial_state=C[0]).C, C)
+    with pytest.raises(ValueError, match="initial state of shape"):
+        model.run(initial_state=np.zeros(11))
+
+
+def test_yaml_config(model_file):
+    yaml = pytest.importorskip('yaml')
+    directory = os.path.dirname(model_file)
+    with open(os.path.join(directory, 'case.yaml'), 'w') as f:
+        yaml.safe_dump(load_config(model_file), f)
+    assert np.array_equal(Model(os.path.join(directory, 'case.yaml')).run().C, Model(model_file).run().C)
+
+
+def test_command_line(model_file):
+    # python culpy_model.py <config> writes the output of all boxes
+    directory = os.path.dirname(model_file)
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'culpy_model.py')
+    subprocess.run([sys.executable, script, model_file, '--output', os.path.join(directory, 'run')],
+                   check=True, capture_output=True)
+    result = Model(model_file).run()
+    df = read_output(os.path.join(directory, 'run.csv'))
+    assert list(df['box'][:2]) == ['CL1', 'CL2']
+    assert np.array_equal(read_output(os.path.join(directory, 'run.csv'), 'CL2').to_numpy(), result.C[:, 1])
+    # the observation times of the config are sampled too
+    obs = read_output(os.path.join(directory, 'run_obs.csv'), 'CL1')
+    assert len(obs) == 5 and np.array_equal(obs.iloc[0].to_numpy(), result.box('CL1').loc['2020-01-02'].iloc[0])
@@ -0,0 +1,107 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the model server of the PEST/PEST++ agents """
+
+
+import os
+import sys
+import time
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'culpy_pest'))
+
+from culpy_model_server import ModelServer, queued_requests, request_socket
+from culpy_metrics import read_observations, ObservationIndex
+from culpy_model import Model
+
+
+def test_run_writes_pest_outputs(model_file, tmp_path):
+    directory = os.path.dirname(model_file)
+    server = ModelServer(model_file, os.path.join(directory, 'observation.csv'))
+    agent = tmp_path / 'agent_1'
+    agent.mkdir()
+    with open(agent / 'kmc.txt', 'w') as f:
+        f.write("k_growth = 1.5\ntheta_nitr = 1.05\n")
+    assert server.handle(str(agent)) == 'ok'
+
+    # pest.out holds the daily means of the observation days of a model run
+    model = Model(model_file)
+    C = model.run({'k_growth': 1.5, 'theta_nitr': 1.05}).C[:, 0]
+    index = ObservationIndex(read_observations(os.path.join(directory, 'observation.csv')),
+                             model.sim_start_date, model.dt, model.n_iter)
+    pest_out = np.loadtxt(agent / 'pest.out')
+    assert len(pest_out) == 14
+    assert np.array_equal(pest_out, index.pest_values(index.window_means(C)))
+    for name in ('r2_values.txt', 're_values.txt', 'pbias_values.txt', 'metrics.csv'):
+        assert (agent / name).exists()
+
+    assert server.handle(str(tmp_path / 'agent_2')).startswith('error: ')
+
+
+class RecordingServer(ModelServer):
+    # a server without a model, its runs are the folder names
+
+    def __init__(self):
+        self.runs = []
+
+    def handle(self, run_dir):
+        self.runs.append(run_dir)
+        return f'ok {run_dir}'
+
+
+def test_queue_first_in_first_out(tmp_path):
+    # requests are served in the order they were queued, not by their names
+    queue = str(tmp_path)
+    for i, name in enumerate(['c', 'a', 'b']):
+        with open(os.path.join(queue, f'{name}.req'), 'w') as f:
+            f.write(f'run_{name}')
+        os.utime(os.path.join(queue, f'{name}.req'), ns=(10**18 + i, 10**18 + i))
+    assert queued_requests(queue) == ['c.req', 'a.req', 'b.req']
+
+    server = RecordingServer()
+    assert server.serve_requests(queue) == 3
+    assert server.runs == ['run_c', 'run_a', 'run_b']
+    assert sorted(os.listdir(queue)) == ['a.done', 'b.done', 'c.done']
+    with open(os.path.join(queue, 'a.done')) as f:
+        assert f.read() == 'ok run_a'
+
+
+class WaitingServer(ModelServer):
+    # the first run waits for the second one to start, which it only does
+    # when the runs are served at the same time
+
+    def __init__(self, flag):
+        self.flag = flag
+
+    def handle(self, run_dir):
+        if run_dir == 'second':
+            open(self.flag, 'w').close()
+            return 'ok'
+        for i in range(200):
+            if os.path.exists(self.flag):
+                return 'ok'
+            time.sleep(0.05)
+        return 'served one at a time'
+
+
+def test_socket_runs_at_the_same_time(tmp_path):
+    with WaitingServer(str(tmp_path / 'second_started')).socket_server(0) as tcp_server:
+        port = tcp_server.server_address[1]
+        serving = threading.Thread(target=tcp_server.serve_forever)
+        serving.start()
+        try:
+            replies = {}
+            first = threading.Thread(target=lambda: replies.update(first=request_socket('first', port)))
+            first.start()
+            time.sleep(0.1)
+            replies['second'] = request_socket('second', port)
+            first.join()
+        finally:
+            tcp_server.shutdown()
+            serving.join()
+    assert replies == {'first': 'ok', 'second': 'ok'}
@@ -0,0 +1,78 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the Morris elementary effects screening """
+
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from culpy_morris import morris_trajectories, parameter_values, morris_table, morris_indices
+from culpy_morris import write_morris_data, run_morris
+from culpy_model import Model
+
+
+bounds = pd.DataFrame({'lower': [1.0, 0.01, 1.02], 'upper': [3.0, 1.0, 1.1], 'transform': ['none', 'log', 'none']},
+                      index=pd.Index(['k_growth', 'k_raer', 'theta_nitr'], name='parameter'))
+
+
+def test_trajectories():
+    # every step of a trajectory moves one parameter by delta on the grid
+    trajectories = morris_trajectories(3, 5, levels=4, seed=1)
+    assert trajectories.shape == (5, 4, 3)
+    assert np.array_equal(trajectories, morris_trajectories(3, 5, levels=4, seed=1))
+    assert np.allclose(trajectories * 3, np.round(trajectories * 3))
+    assert trajectories.min() >= 0.0 and trajectories.max() <= 1.0
+    steps = np.diff(trajectories, axis=1)
+    assert np.array_equal(np.count_nonzero(steps, axis=2), np.ones((5, 3)))
+    assert np.allclose(np.abs(steps).sum(axis=2), 2 / 3)
+    assert np.array_equal(np.sort(np.argmax(np.abs(steps), axis=2), axis=1), np.tile([0, 1, 2], (5, 1)))
+
+
+def test_parameter_values():
+    values = parameter_values(np.array([[0.0, 0.0, 0.0], [0.5, 0.5, 0.5], [1.0, 1.0, 1.0]]), bounds)
+    assert np.allclose(values, [[1.0, 0.01, 1.02], [2.0, 0.1, 1.06], [3.0, 1.0, 1.1]])
+
+
+def test_indices_of_a_linear_function():
+    # the effects of sum(c * value) are c * (upper - lower) per unit step:
+    # mu = mu* = c (upper - lower), sigma = 0 for the linear parameters
+    trajectories = morris_trajectories(3, 6, seed=2)
+    table = morris_table(trajectories, bounds)
+    assert table.shape == (24, 3) and table.index[4] == 't2_0'
+    c = np.array([2.0, 0.0, -5.0])
+    results = pd.DataFrame({'y': table.values @ c, 'z': table['k_growth'] ** 2})
+    indices = morris_indices(trajectories, results, bounds.index).set_index(['metric', 'parameters'])
+    y = indices.loc['y']
+    assert np.allclose(y['mu'], c * (bounds['upper'] - bounds['lower']))
+    assert np.allclose(y['mu_star'], np.abs(c) * (bounds['upper'] - bounds['lower']))
+    assert np.allclose(y['sigma'], 0.0)
+    assert indices.loc[('z', 'k_growth'), 'mu_star'] > 0.0
+    assert indices.loc[('z', 'k_raer'), 'mu_star'] == 0.0
+
+
+def test_write_morris_data(tmp_path):
+    trajectories = morris_trajectories(3, 2, seed=3)
+    results = pd.DataFrame({'y': morris_table(trajectories, bounds)['k_growth'].values})
+    indices = morris_indices(trajectories, results, bounds.index)
+    write_morris_data(indices, 'y', str(tmp_path / 'data.csv'))
+    data = pd.read_csv(tmp_path / 'data.csv')
+    assert list(data.columns) == ['parameters', 'mu', 'mu_star', 'sigma']
+    assert list(data['parameters']) == list(bounds.index)
+    with pytest.raises(ValueError, match="unknown metric"):
+        write_morris_data(indices, 'Cam_CL', str(tmp_path / 'data.csv'))
+
+
+def test_run_morris(model_file):
+    # one run per trajectory point, the observation times of the first box
+    model = Model(model_file)
+    table, results, indices = run_morris(model, bounds.iloc[:2], 2, seed=4, processes=0)
+    assert len(table) == len(results) == 6
+    assert 'Cam_2020-01-02' in results.columns
+    assert len(indices) == 2 * len(results.columns)
+    first = model.run(table.iloc[0].to_dict()).box('CL1')
+    assert np.isclose(results.iloc[0]['Cam_2020-01-02'], first.loc[pd.Timestamp('2020-01-02'), 'Cam'], rtol=1e-12)
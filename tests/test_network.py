@@ -0,0 +1,60 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the box network and its sparse flow matrices """
+
+
+import numpy as np
+import pytest
+
+from culpy_engine import ForcingMatrix
+from culpy_network import BoxNetwork, read_connections
+
+
+connections = [("C01_NE", "CL1", "Q01_NE"),
+               ("C01_BS", "CL1", "Q01_BS"),
+               ("CL1",    "BS",  "Q10_BS"),
+               ("CL1",    "CL2", "Q12"),
+               ("CL2",    "CL1", "Q21"),
+               ("C02_RU", "CL2", "Q02_RU")]
+
+
+def test_flow_matrices():
+    # the advective terms of the 2-box script as exchange and inflow matrices
+    network = BoxNetwork(["CL1", "CL2"], connections)
+    assert network.boundaries == ["C01_NE", "C01_BS", "C02_RU"]
+    assert network.flows == ["Q01_NE", "Q01_BS", "Q10_BS", "Q12", "Q21", "Q02_RU"]
+    Q = {flow: np.full(3, 10.0 * (i + 1)) for i, flow in enumerate(network.flows)}
+    V = np.column_stack([np.full(3, 2.0), np.full(3, 5.0)])
+    boundary_C = {boundary: np.full((3, 11), i + 1.0) for i, boundary in enumerate(network.boundaries)}
+    forcing = ForcingMatrix(network.forcing_series(Q, V, boundary_C))
+
+    exchange, inflow = network.exchange.copy(), network.inflow.copy()
+    exchange.data[:] = forcing['exchange'][0]
+    inflow.data[:] = forcing['inflow'][0]
+    q = {flow: values[0] for flow, values in Q.items()}
+    assert np.allclose(exchange.toarray(), [[-(q['Q10_BS'] + q['Q12']) / 2, q['Q21'] / 2],
+                                            [q['Q12'] / 5, -q['Q21'] / 5]])
+    assert np.allclose(inflow.toarray(), [[q['Q01_NE'] / 2, q['Q01_BS'] / 2, 0],
+                                          [0, 0, q['Q02_RU'] / 5]])
+    assert np.array_equal(forcing['boundary'][0, 2], np.full(11, 3.0))
+
+    # box to box flows move mass without loss: V-weighted columns of the
+    # exchange matrix sum to minus the outflow of the box
+    assert np.allclose(V[0] @ exchange.toarray(), [-q['Q10_BS'], 0.0])
+
+
+def test_network_errors():
+    with pytest.raises(ValueError, match="unique"):
+        BoxNetwork(["CL1", "CL1"], connections)
+    with pytest.raises(ValueError, match="connects no box"):
+        BoxNetwork(["CL1", "CL2"], connections + [("A", "B", "Q_AB")])
+
+
+def test_read_connections(tmp_path):
+    with open(tmp_path / "connections.csv", "w") as f:
+        f.write("from,to,flow\n" + "".join(f"{a},{b},{q}\n" for a, b, q in connections))
+    assert read_connections(str(tmp_path / "connections.csv")) == connections
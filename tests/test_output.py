@@ -0,0 +1,202 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the streaming state chunks and the chunked output writers """
+
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from culpy_engine import simulate_C, state_vars
+from conftest import Case
+from culpy_output import StateChunks, write_chunks, OutputWriter, output_dates, PeriodMean, TimeSampler
+from culpy_output import OutputStage, SimulationResult, read_output
+
+
+sim_start_date = "2020-01-01"
+format_modules = {".csv": None, ".parquet": "pyarrow", ".h5": "tables", ".nc": "netCDF4"}
+
+
+def read_back(file_name):
+    # file of a one-box writer as a Date indexed DataFrame
+    if file_name.endswith(".nc"):
+        netCDF4 = pytest.importorskip("netCDF4")
+        with netCDF4.Dataset(file_name) as nc:
+            times = pd.Timestamp(sim_start_date) + pd.to_timedelta(nc["time"][:], unit="D")
+            return pd.DataFrame({column: np.asarray(nc[column][:]) for column in state_vars},
+                                index=times.round("us"))
+    if file_name.endswith(".parquet"):
+        df = pd.read_parquet(file_name)
+    elif file_name.endswith(".h5"):
+        df = pd.read_hdf(file_name, "C")
+    else:
+        df = pd.read_csv(file_name, parse_dates=["Date"], float_precision="round_trip")
+    return df.set_index("Date")
+
+
+def test_state_chunks(case):
+    # the chunks passed to the output are the rows of the whole-run array
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)
+    chunks = []
+    result = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude,
+                        output=lambda row, C_chunk: chunks.append((row, np.array(C_chunk))), chunk_rows=100)
+    assert result is None
+    assert [row for row, C_chunk in chunks] == list(range(0, n_iter + 1, 100))
+    assert [len(C_chunk) for row, C_chunk in chunks] == [100] * 4 + [81]
+    assert np.array_equal(np.concatenate([C_chunk for row, C_chunk in chunks]), C)
+
+
+def test_state_chunks_rows():
+    rows = []
+    chunks = StateChunks(9, (2, 11), output=lambda row, C_chunk: rows.append((row, len(C_chunk))), chunk_rows=4)
+    assert chunks.C.shape == (4, 2, 11)
+    for t in range(10):
+        chunks.C[chunks.row(t)] = t
+        chunks.stored(t)
+    assert rows == [(0, 4), (4, 4), (8, 2)]
+    assert chunks.result() is None
+    # without an output all rows are kept
+    assert StateChunks(9, (2, 11)).C.shape == (10, 2, 11)
+
+
+def test_write_chunks():
+    C = np.arange(50.0).reshape(25, 2)
+    chunks = []
+    write_chunks(C, lambda row, C_chunk: chunks.append((row, C_chunk)), chunk_rows=10)
+    assert [row for row, C_chunk in chunks] == [0, 10, 20]
+    assert np.array_equal(np.concatenate([C_chunk for row, C_chunk in chunks]), C)
+
+
+@pytest.mark.parametrize("extension", list(format_modules))
+def test_writer_round_trip(case, tmp_path, extension):
+    # all formats give back the dates and values of the run
+    if format_modules[extension]:
+        pytest.importorskip(format_modules[extension])
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)
+    file_name = str(tmp_path / f"CL1{extension}")
+    writer = OutputWriter(file_name, sim_start_date, dt, state_vars)
+    write_chunks(C[:, 0], writer.write, chunk_rows=128)
+    writer.close()
+
+    df = read_back(file_name)
+    assert np.array_equal(df.index, output_dates(sim_start_date, dt, 0, n_iter + 1))
+    assert list(df.columns) == list(state_vars)
+    assert np.array_equal(df.to_numpy(), C[:, 0])
+
+
+def test_writer_errors_and_empty_csv(tmp_path):
+    with pytest.raises(ValueError, match="unknown output format"):
+        OutputWriter(str(tmp_path / "CL1.xlsx"), sim_start_date, 1/24, state_vars)
+    writer = OutputWriter(str(tmp_path / "CL1.csv"), sim_start_date, 1/24, state_vars)
+    writer.close()
+    assert list(pd.read_csv(tmp_path / "CL1.csv").columns) == ["Date", *state_vars]
+
+
+def run_frame(case):
+    # state of CL1 as a Date indexed DataFrame
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)
+    return C, pd.DataFrame(C[:, 0], index=output_dates(sim_start_date, case.dt, 0, len(C)), columns=state_vars)
+
+
+class Collected:
+    # output(dates, values) calls of a reduction
+    def __init__(self):
+        self.dates, self.values = [], []
+
+    def __call__(self, dates, values):
+        self.dates.extend(dates)
+        self.values.append(np.asarray(values))
+
+    def frame(self):
+        return pd.DataFrame(np.concatenate(self.values)[:, 0], index=pd.DatetimeIndex(self.dates), columns=state_vars)
+
+
+@pytest.mark.parametrize("period, freq", [("daily", "D"), ("monthly", "MS")])
+def test_period_mean(period, freq):
+    # chunk by chunk means equal resample().mean() of the whole run,
+    # also with NaN rows and periods spanning chunks
+    case = Case(n_iter=1200, dt=1/12)
+    C, df = run_frame(case)
+    C[5:30, 0, 3] = np.nan
+    df.iloc[5:30, 3] = np.nan
+    collected = Collected()
+    mean = PeriodMean(sim_start_date, case.dt, period, collected)
+    write_chunks(C, mean, chunk_rows=37)
+    mean.close()
+    pd.testing.assert_frame_equal(collected.frame(), df.resample(freq).mean(), check_freq=False, rtol=1e-12)
+
+    with pytest.raises(ValueError, match="unknown period"):
+        PeriodMean(sim_start_date, case.dt, "weekly", collected)
+
+
+def test_period_mean_at_times(case):
+    # one row per time, the mean of the day of the time
+    C, df = run_frame(case)
+    times = pd.DatetimeIndex(["2020-01-02 06:00", "2020-01-02 18:00", "2020-01-05 12:00"])
+    collected = Collected()
+    mean = PeriodMean(sim_start_date, case.dt, "daily", collected, times)
+    write_chunks(C, mean, chunk_rows=50)
+    mean.close()
+    daily = df.resample("D").mean()
+    expected = daily.loc[times.normalize()].set_axis(times)
+    pd.testing.assert_frame_equal(collected.frame(), expected, check_freq=False, rtol=1e-12)
+
+
+def test_time_sampler(case):
+    # rows at grid times, linear interpolation between rows, also across
+    # chunk boundaries; times outside the run are dropped
+    C, df = run_frame(case)
+    times = pd.DatetimeIndex(["2019-12-31", "2020-01-01", "2020-01-02 03:00", "2020-01-03 01:30",
+                              "2020-01-05 03:20", "2020-01-21", "2020-02-01"])
+    collected = Collected()
+    sampler = TimeSampler(sim_start_date, case.dt, times, collected)
+    write_chunks(C, sampler, chunk_rows=52)
+    sampler.close()
+    expected = df.reindex(df.index.union(times)).interpolate(method="time").loc[times[1:-1]]
+    pd.testing.assert_frame_equal(collected.frame(), expected, check_freq=False, rtol=1e-12)
+    assert np.array_equal(collected.frame().loc["2020-01-02 03:00"], C[27, 0])
+
+
+@pytest.mark.parametrize("extension", list(format_modules))
+def test_multi_box_store(case, tmp_path, extension):
+    # all boxes in one file, read back for all boxes and for one box
+    if format_modules[extension]:
+        pytest.importorskip(format_modules[extension])
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)
+    result = SimulationResult(C, network.boxes, sim_start_date, dt, state_vars)
+    file_name = str(tmp_path / f"output{extension}")
+    result.save(file_name, chunk_rows=100)
+
+    df = read_output(file_name)
+    assert list(df.columns) == ["Date", "box", *state_vars]
+    assert list(df["box"][:4]) == ["CL1", "CL2", "CL1", "CL2"]
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), result.to_frame(), check_dtype=False)
+    for i, box in enumerate(network.boxes):
+        CL = read_output(file_name, box)
+        pd.testing.assert_frame_equal(CL, result.box(box), check_freq=False)
+        assert np.array_equal(CL.to_numpy(), C[:, i])
+
+
+def test_multi_box_stage(case, tmp_path):
+    # a streamed run writes the same store as the saved result
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude)
+    stage = OutputStage(str(tmp_path / "output"), sim_start_date, dt, state_vars, series="daily",
+                        boxes=network.boxes)
+    simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, output=stage, chunk_rows=64)
+    stage.close()
+    daily = read_output(str(tmp_path / "output_daily.csv"))
+    assert len(daily) == 2 * 21
+    for i, box in enumerate(network.boxes):
+        expected = pd.DataFrame(C[:, i], index=output_dates(sim_start_date, dt, 0, len(C)), columns=state_vars)
+        expected = expected.resample("D").mean().rename_axis("Date")
+        pd.testing.assert_frame_equal(read_output(str(tmp_path / "output_daily.csv"), box), expected,
+                                      check_freq=False, rtol=1e-12)
@@ -0,0 +1,117 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the observation ensemble postprocessing """
+
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'culpy_pest'))
+
+import culpy_postprocess
+from culpy_postprocess import read_ensemble, read_measurements, clean_ensemble, quantile_bands
+from culpy_postprocess import ensemble_bands, box_stats, band_names
+
+
+names = ['nh4_01_02_20', 'nh4_01_05_20', 'no3_01_02_20', 'po4_02_01_20']
+
+
+def write_ensemble(file_name, seed=0, n_reals=50):
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(0.0, 0.5, (n_reals, len(names)))
+    values[3, 0] = 40.0  # outside the whiskers
+    values[5, 1] = -0.2
+    values[[7, 8], 2] = np.nan
+    values[:, 3] = np.nan
+    pd.DataFrame(values, index=pd.Index([str(i) for i in range(n_reals)], name='real_name'),
+                 columns=names).to_csv(file_name)
+    return values
+
+
+def reference_bands(values, whisker=1.5):
+    # one observation at a time, NaN left out
+    rows = []
+    for column in values.T:
+        column = column[~np.isnan(column)]
+        if len(column) == 0:
+            rows.append([np.nan] * 5 + [0])
+            continue
+        q1, med, q3 = np.percentile(column, [25, 50, 75])
+        inside = column[(column >= q1 - whisker * (q3 - q1)) & (column <= q3 + whisker * (q3 - q1))]
+        rows.append([inside.min(), q1, med, q3, inside.max(), len(column)])
+    return np.array(rows, dtype=float)
+
+
+def test_read_ensemble_and_measurements(tmp_path):
+    values = write_ensemble(str(tmp_path / 'culpy.0.obs.csv'))
+    ensemble = read_ensemble(str(tmp_path / 'culpy.0.obs.csv'))
+    assert ensemble.columns.names == ['variable', 'month', 'day', 'year']
+    assert ensemble.columns[1] == ('nh4', '01', '05', '20')
+    assert np.array_equal(ensemble.to_numpy(), values, equal_nan=True)
+
+    pd.DataFrame({'Date': ['01/02/2020', '01/05/2020'], 'NH4': [0.05, np.nan],
+                  'NO3': [1.0, 0.9]}).to_csv(tmp_path / 'observation.csv', index=False)
+    measurements = read_measurements(str(tmp_path / 'observation.csv'))
+    assert list(measurements.index) == [('nh4', '01', '02', '20'), ('no3', '01', '02', '20'),
+                                        ('no3', '01', '05', '20')]
+    assert list(measurements) == [0.05, 1.0, 0.9]
+
+
+def test_clean_ensemble(tmp_path):
+    write_ensemble(str(tmp_path / 'culpy.0.obs.csv'))
+    ensemble = read_ensemble(str(tmp_path / 'culpy.0.obs.csv'))
+    cleaned, dropped = clean_ensemble(ensemble, {'nh4': 10.0, 'no3': None}, drop_negative=True)
+    assert dropped == 0 and np.isnan(cleaned.iloc[3, 0]) and np.isnan(cleaned.iloc[5, 1])
+    assert cleaned.iloc[:, 2].isna().sum() == 2
+    cleaned, dropped = clean_ensemble(ensemble, {'nh4': 10.0}, delete_rows=True, negatives_to_zero=True)
+    assert dropped == 1 and 3 not in cleaned.index and cleaned.loc[5].iloc[1] == 0.0
+
+
+def test_quantile_bands(tmp_path):
+    values = write_ensemble(str(tmp_path / 'culpy.0.obs.csv'))
+    bands = quantile_bands(read_ensemble(str(tmp_path / 'culpy.0.obs.csv')))
+    assert list(bands.columns) == list(band_names)
+    assert np.allclose(bands.to_numpy(), reference_bands(values), rtol=1e-14, atol=0.0, equal_nan=True)
+    assert bands.loc[('nh4', '01', '02', '20'), 'whishi'] < 40.0
+    assert box_stats(bands, ('no3', '01', '02', '20'))['med'] == np.nanmedian(values[:, 2])
+
+
+def test_quantile_bands_match_matplotlib(tmp_path):
+    cbook = pytest.importorskip('matplotlib.cbook')
+    values = write_ensemble(str(tmp_path / 'culpy.0.obs.csv'))
+    bands = quantile_bands(read_ensemble(str(tmp_path / 'culpy.0.obs.csv')))
+    for j in range(3):
+        stats = cbook.boxplot_stats(values[~np.isnan(values[:, j]), j])[0]
+        for name in band_names[:-1]:
+            assert np.isclose(bands.iloc[j][name], stats[name], rtol=1e-14)
+
+
+def test_bands_cache(tmp_path, monkeypatch):
+    # a repeated call reads the cache file, new options or a new file
+    # content rebuild it
+    file_name = str(tmp_path / 'culpy.0.obs.csv')
+    write_ensemble(file_name)
+    bands, dropped = ensemble_bands(file_name, {'nh4': 10.0}, delete_rows=True)
+    assert dropped == 1 and os.path.exists(tmp_path / 'culpy.0.obs.bands.csv')
+
+    read = culpy_postprocess.read_ensemble
+    def no_read(file_name):
+        raise AssertionError('the ensemble file was read')
+    monkeypatch.setattr(culpy_postprocess, 'read_ensemble', no_read)
+    cached, cached_dropped = ensemble_bands(file_name, {'nh4': 10.0}, delete_rows=True)
+    assert cached_dropped == 1
+    pd.testing.assert_frame_equal(cached, bands, check_dtype=False)
+
+    monkeypatch.setattr(culpy_postprocess, 'read_ensemble', read)
+    other, dropped = ensemble_bands(file_name)
+    assert dropped == 0 and other.loc[('nh4', '01', '02', '20'), 'count'] == 50
+    write_ensemble(file_name, seed=1, n_reals=60)
+    os.utime(file_name, ns=(os.stat(file_name).st_mtime_ns + 10**9,) * 2)
+    assert ensemble_bands(file_name)[0].loc[('nh4', '01', '02', '20'), 'count'] == 60
@@ -0,0 +1,80 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the objective surface scan """
+
+
+import os
+import numpy as np
+import pytest
+
+import culpy_scan
+from culpy_scan import grid_table, refine, run_scan
+from culpy_model import Model
+
+
+def test_grid_table():
+    table = grid_table('k_growth', np.array([1.0, 2.0, 3.0]), 'theta_nitr', np.array([1.0, 1.1]))
+    assert list(table.index) == ['0_0', '0_1', '0_2', '1_0', '1_1', '1_2']
+    assert list(table['k_growth']) == [1.0, 2.0, 3.0] * 2
+    assert list(table['theta_nitr']) == [1.0] * 3 + [1.1] * 3
+
+
+def test_refine():
+    # the refined grid is centred on the minimum and stays in the ranges
+    x, y = np.linspace(0.0, 4.0, 5), np.linspace(10.0, 20.0, 5)
+    phi = np.full((5, 5), 9.0)
+    phi[2, 0] = 1.0
+    phi[0, 0] = np.nan
+    x_new, y_new = refine(x, y, phi, 0.5, (0.0, 4.0), (10.0, 20.0))
+    assert np.allclose(x_new, np.linspace(0.0, 2.0, 5))
+    assert np.allclose(y_new, np.linspace(12.5, 17.5, 5))
+    with pytest.raises(ValueError, match="no finite phi"):
+        refine(x, y, np.full((5, 5), np.nan), 0.5, (0.0, 4.0), (10.0, 20.0))
+
+
+def write_synthetic_observations(model, directory):
+    # daily means of a run with k_growth 1.5 and k_nitrification 0.2
+    truth = model.run({'k_growth': 1.5, 'k_nitrification': 0.2}).box('CL1').resample('D').mean()
+    truth = truth.loc['2020-01-02':'2020-01-10', ['Cam', 'Cni', 'Cph']]
+    truth.set_axis(['NH4', 'NO3', 'PO4'], axis=1).rename_axis('Date').to_csv(os.path.join(directory, 'obs.csv'))
+    return os.path.join(directory, 'obs.csv')
+
+
+def test_run_scan(model_file):
+    # the minimum of the refined grid is at the parameters of the observations
+    directory = os.path.dirname(model_file)
+    model = Model(model_file)
+    observation_file = write_synthetic_observations(model, directory)
+    file_name = os.path.join(directory, 'scan.npz')
+    scan = run_scan(model, 'k_growth', (1.0, 3.0), 'k_nitrification', (0.0, 0.4), points=5, levels=2, zoom=0.5,
+                    observation_file=observation_file, file_name=file_name)
+    assert np.allclose(scan['x_0'], [1.0, 1.5, 2.0, 2.5, 3.0]) and scan['phi_0'].shape == (5, 5)
+    assert scan['phi_0'][2, 1] == np.min(scan['phi_0']) < 1e-6
+    assert np.allclose(scan['x_1'], np.linspace(1.0, 2.0, 5))
+    with np.load(file_name) as data:
+        assert int(data['levels']) == 2 and str(data['x_name']) == 'k_growth'
+        assert np.array_equal(data['phi_1'], scan['phi_1'])
+
+    with pytest.raises(ValueError, match="unknown kmc parameter"):
+        run_scan(model, 'k_unknown', (1.0, 3.0), 'k_growth', (1.0, 2.0), observation_file=observation_file)
+
+
+def test_scan_of_failed_runs(model_file, monkeypatch):
+    # a level without any finite phi is kept and ends the scan
+    directory = os.path.dirname(model_file)
+    model = Model(model_file)
+    observation_file = write_synthetic_observations(model, directory)
+    def failed_runs(parameter_table, *args, **kwargs):
+        return culpy_scan.pd.DataFrame(np.nan, index=parameter_table.index, columns=range(27))
+    monkeypatch.setattr(culpy_scan, 'run_ensemble', failed_runs)
+    file_name = os.path.join(directory, 'scan.npz')
+    with pytest.warns(RuntimeWarning, match="all runs of level 0 failed"):
+        scan = run_scan(model, 'k_growth', (1.0, 3.0), 'k_nitrification', (0.0, 0.4), points=3, levels=3,
+                        observation_file=observation_file, file_name=file_name)
+    assert np.isnan(scan['phi_0']).all() and 'x_1' not in scan
+    with np.load(file_name) as data:
+        assert int(data['levels']) == 1
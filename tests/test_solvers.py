@@ -0,0 +1,79 @@
+# This file is part of CuLPy
+# Copyright (c) 2024 Burak Kaynaroglu
+# This program is free software distributed under the MIT License
+# A copy of the MIT License can be found at
+# https://github.com/kaynarob/CuLPy/blob/main/LICENSE.md
+
+""" Tests of the operator-splitting integrators against a fine rk4 run """
+
+
+import numpy as np
+import pytest
+
+import culpy_solvers
+from culpy_engine import TemperatureTables, pelagic_process_rates, simulate_C
+
+
+def relative_error(C, C_ref):
+    return (np.abs(C - C_ref).max(axis=(0, 1)) / np.abs(C_ref).max(axis=(0, 1))).max()
+
+
+def test_higher_order_integrators(case):
+    # rk4 at dt as the reference: rk45 with a tight tolerance agrees with it,
+    # rk4 at twice dt and the euler and imex steps at dt stay close (the forcing
+    # is held over a row, so the steps do not reach their full order)
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    run = lambda **options: simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, **options)
+    C_ref = run(integrator="rk4")
+    assert np.isfinite(C_ref).all()
+    assert relative_error(run(integrator="rk45", step=0.25, rtol=1e-8, atol=1e-10), C_ref) < 1e-4
+    assert relative_error(run(integrator="rk4", step=2 * dt), C_ref) < 0.01
+    assert relative_error(run(integrator="euler"), C_ref) < 0.03
+    assert relative_error(run(integrator="imex"), C_ref) < 0.03
+
+
+def test_integrator_errors(case):
+    with pytest.raises(ValueError, match="unknown integrator"):
+        simulate_C(*case.arrays(), integrator="rk3")
+    with pytest.raises(ValueError, match="python backend"):
+        simulate_C(*case.arrays(), backend="numba", integrator="rk4")
+
+
+@pytest.mark.parametrize("integrator", ["lie", "strang"])
+@pytest.mark.parametrize("step, reaction_step", [(1.0, 0), (1.0, 1/24), (1/96, 1/24)])
+def test_split_steps(case, integrator, step, reaction_step):
+    # transport steps of a day with adaptive or hourly reactions, and the
+    # reverse (transport sub-cycling in an hourly reaction step): close to
+    # rk4 at dt, with no more rate evaluations than euler
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    C_ref = simulate_C(C_init, n_iter, dt, forcing, H, network, kmc, Altitude, integrator="rk4")
+    tables = TemperatureTables(forcing['T'], forcing['salinity'], Altitude)
+    evaluations = []
+    def rates(*args):
+        evaluations.append(1)
+        return pelagic_process_rates(*args)
+    C = culpy_solvers.integrate(C_init, n_iter, dt, forcing, H, network, kmc, tables, integrator, step,
+                                rates=rates, reaction_step=reaction_step)
+    assert C.shape == C_ref.shape
+    assert np.array_equal(C[0], C_init)
+    assert relative_error(C, C_ref) < 0.03
+    assert len(evaluations) <= (0.8 if reaction_step == 0 else 1) * n_iter
+
+
+@pytest.mark.parametrize("integrator, order", [("lie", 1), ("strang", 2)])
+def test_transport_below_one_row(case, integrator, order):
+    # transport steps of a quarter row take four sub-steps per row with
+    # their own flows: without reactions the error of transport alone falls
+    # with the order of the splitting (and reaction steps below the
+    # transport step keep it)
+    C_init, n_iter, dt, forcing, H, network, kmc, Altitude = case.arrays()
+    tables = TemperatureTables(forcing['T'], forcing['salinity'], Altitude)
+    no_reactions = lambda C_t, *args: np.zeros(np.shape(C_t))
+    def run(integrator, step, reaction_step=0):
+        return culpy_solvers.integrate(C_init, n_iter, dt, forcing, H, network, kmc, tables, integrator, step,
+                                       rates=no_reactions, reaction_step=reaction_step)
+    C_ref = run("rk4", dt / 16)
+    error_row = relative_error(run(integrator, dt), C_ref)
+    error_quarter = relative_error(run(integrator, dt / 4), C_ref)
+    assert 0 < error_quarter < error_row / 4 ** order * 1.2
+    assert np.array_equal(run(integrator, dt / 4, dt / 8), run(integrator, dt / 4))